@@ -0,0 +1,86 @@
+from log import Log
+from scheduler import FrameScheduler
+
+
+class WipeAnimation():
+    '''起動時のWipeアニメーション
+
+    全Channelの全路線のWipeをフレームごとに並行して進める.
+    路線は点灯順に少しずつ遅れて開始し，全体がdurationで終わるよう1路線の所要時間を決める.
+    1フレームにつき，変化したChannelごとに1回show()
+
+    Parameters
+    ----------
+    leds : list of LEDCtrl
+        ChannelごとのLED制御 (表示路線がないChannelは[])
+    order : list of tuple
+        点灯する順の(Channel, 路線記号)のリスト (Main.anim_order())
+    duration : float
+        アニメーション全体の所要時間[s]
+    overlap : float
+        次の路線を開始するまでに進める，1路線のWipeの割合 (0: 全路線同時, 1: 1路線ずつ)
+    frame_rate : float
+        アニメーションのフレームレート[fps]
+
+    Attributes
+    ----------
+    frame_count : int
+        描画したフレーム数
+    show_count : int
+        show()の回数 (全Channelの合計)
+    '''
+
+    def __init__(self, leds, order, duration=5, overlap=0.3, frame_rate=30):
+        self.leds = leds
+        self.order = order
+        self.duration = max(duration, 0)
+        self.overlap = min(max(overlap, 0), 1)
+        self.frame_rate = frame_rate
+        self.frame_count = 0
+        self.show_count = 0
+
+    def run(self):
+        '''アニメーションを行う (終了まで戻らない)
+        '''
+        # 路線ごとの点灯順の(LEDの番号, 色)
+        tracks = [(ch, self.leds[ch].wipe_pixels(line)) for ch, line in self.order if self.leds[ch]]
+        if not tracks:
+            return
+
+        # 1路線の所要時間と，次の路線を開始するまでの間隔
+        n = len(tracks)
+        wipe = self.duration / ((n - 1) * self.overlap + 1)
+        step = wipe * self.overlap
+        done = [0] * n
+
+        scheduler = FrameScheduler(self.frame_rate)
+        start = scheduler.start()
+        now = start
+        while True:
+            elapsed = now - start
+            frames = [[] for _ in self.leds]
+            finished = True
+            for i in range(n):
+                ch, pixels = tracks[i]
+                if wipe > 0:
+                    count = min(max(int((elapsed - i * step) / wipe * len(pixels)), 0), len(pixels))
+                else:
+                    count = len(pixels)
+                if count > done[i]:
+                    frames[ch].extend(pixels[done[i]:count])
+                    done[i] = count
+                if count < len(pixels):
+                    finished = False
+
+            for ch in range(len(self.leds)):
+                if frames[ch]:
+                    self.leds[ch].show_pixels(frames[ch])
+                    self.show_count += 1
+            self.frame_count += 1
+
+            if finished:
+                break
+            now = scheduler.wait()
+
+        Log.info(f"Finished animation. Frames: {self.frame_count}, Shows: {self.show_count}, "
+                 f"Time: {now - start:.1f}s")
@@ -0,0 +1,109 @@
+import random
+import time
+
+
+class ServiceUnavailable(Exception):
+    '''全てのサービスから取得できなかった場合の例外
+    '''
+    pass
+
+
+class CircuitBreaker():
+    '''サービスごとの再試行間隔の制御 (指数バックオフ + サーキットブレーカ)
+
+    失敗するたびに再試行までの間隔を倍にし(ジッタ付き), 連続でthreshold回失敗した場合は
+    少なくともcooldownの間リクエストを送らない(open). cooldown後の1回の試行(half-open)に成功すれば元に戻す
+
+    Parameters
+    ----------
+    base : float
+        初回の失敗後の再試行間隔[s]
+    max_delay : float
+        再試行間隔の上限[s]
+    threshold : int
+        ブレーカを開く連続失敗回数
+    cooldown : float
+        ブレーカを開いている時間[s]
+    jitter : float
+        ブレーカを開いている時間に加えるランダムな時間の上限[s]
+    rnd : random.Random
+        ジッタに使用する乱数 (Noneの場合は新規作成)
+
+    Attributes
+    ----------
+    state : str
+        "closed": 通常, "open": 停止中, "half_open": 試行中
+    failures : int
+        連続失敗回数
+    next_attempt : float
+        次に試行できる時刻 (time.monotonic())
+    '''
+
+    def __init__(self, base=2, max_delay=120, threshold=5, cooldown=60, jitter=5, rnd=None):
+        self.base = base
+        self.max_delay = max_delay
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.jitter = jitter
+
+        self.state = "closed"
+        self.failures = 0
+        self.next_attempt = 0.0
+
+        self.__rnd = rnd or random.Random()
+
+    def allow(self, now=None):
+        '''リクエストを送ってよいか判定する
+
+        Parameters
+        ----------
+        now : float
+            現在時刻 (time.monotonic()). Noneの場合は現在時刻
+
+        Returns
+        -------
+        allowed : bool
+            送ってよい場合はTrue
+        '''
+        now = time.monotonic() if now is None else now
+        if now < self.next_attempt:
+            return False
+
+        if self.state == "open":
+            self.state = "half_open"
+        return True
+
+    def success(self):
+        '''リクエストの成功を記録する
+        '''
+        self.state = "closed"
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def failure(self, now=None):
+        '''リクエストの失敗を記録する
+
+        Parameters
+        ----------
+        now : float
+            現在時刻 (time.monotonic()). Noneの場合は現在時刻
+
+        Returns
+        -------
+        delay : float
+            次に試行できるまでの時間[s]
+        '''
+        now = time.monotonic() if now is None else now
+        self.failures += 1
+
+        if self.state == "half_open" or self.failures >= self.threshold:
+            # cooldownより早く再試行しないよう，ずらす時間は後ろに加える
+            self.state = "open"
+            delay = self.cooldown + self.__rnd.uniform(0, self.jitter)
+        else:
+            # 複数の表示器が同時に再試行しないよう，間隔の半分をランダムにずらす
+            delay = min(self.base * 2 ** (self.failures - 1), self.max_delay)
+            delay = delay / 2 + self.__rnd.uniform(0, delay / 2)
+        self.next_attempt = now + delay
+
+        return delay
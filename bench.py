@@ -0,0 +1,286 @@
+import argparse
+import json
+import random
+import sys
+import time
+
+from odpt import ODPT
+from ledctrl import LEDCtrl
+from log import Log
+from capture import read_cycles
+from decode import decode_trains
+
+
+# 計測する構成 (Channelごとの表示路線, 駅数の倍率, 列車密度)
+CONFIGS = {
+    "1line": {"lines": [["G"], []], "scale": 1, "density": 1.0},
+    "4lines": {"lines": [["G", "M"], ["A", "E"]], "scale": 1, "density": 1.0},
+    "13lines": {"lines": [["H", "C", "F", "I", "N", "M"], ["A", "G", "Z", "S", "T", "Y", "E"]],
+                "scale": 1, "density": 1.0},
+    "synthetic": {"lines": [["H", "C", "F", "I", "N", "M"], ["A", "G", "Z", "S", "T", "Y", "E"]],
+                  "scale": 4, "density": 3.0},
+}
+
+# 計測値のうち，基準値との比較を行う項目
+METRICS = ["decode_ms", "partition_ms", "render_ms"]
+
+
+def scale_stations(stations, scale):
+    '''駅テーブルを"scale"倍の駅数に拡張する (合成データ用)
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    scale : int
+        駅数の倍率
+
+    Returns
+    -------
+    sta_table : dict
+        拡張した路線ごとの駅テーブル
+    '''
+    if scale == 1:
+        return stations
+
+    sta_table = {}
+    for line, sta in stations.items():
+        num = (len(sta) - 1) * scale + 1
+        sta_table[line] = {f"bench.Station:{line}.{i}": i for i in range(num)}
+
+    return sta_table
+
+
+class TrainGenerator():
+    '''合成した列車走行位置の生成
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    line_table : dict
+        路線記号のテーブル
+    lines : list of str
+        生成する路線のlineCodeのリスト
+    density : float
+        1駅あたりの列車数の目安
+    seed : int
+        乱数のシード
+    '''
+
+    def __init__(self, stations, line_table, lines, density=1.0, seed=0):
+        self.__rnd = random.Random(seed)
+        self.__line_table = line_table
+        self.__trains = {}
+
+        for line in lines:
+            index_sta = {v: k for k, v in stations[line].items() if v >= 0}
+            num = max(int(len(index_sta) * density / 2), 1)
+            self.__trains[line] = {
+                "index_sta": index_sta,
+                "trains": [{"number": f"B{line}{i:04d}",
+                            "index": self.__rnd.choice(list(index_sta.keys())),
+                            "direction": self.__rnd.choice([1, -1]),
+                            "moving": False} for i in range(num)]
+            }
+
+    def next(self):
+        '''列車を進め，全列車の走行位置を生成する
+
+        Returns
+        -------
+        data : list of dict
+            ODPT.get_lines_train()で分類する前の列車走行位置情報
+        '''
+        date = time.strftime("%Y-%m-%dT%H:%M:%S+09:00")
+        data = []
+
+        for line, v in self.__trains.items():
+            index_sta = v["index_sta"]
+            for t in v["trains"]:
+                # 停車 -> 駅間 -> 次駅に停車
+                if t["moving"]:
+                    t["index"] += t["direction"]
+                    t["moving"] = False
+                elif self.__rnd.random() < 0.6:
+                    if t["index"] + t["direction"] not in index_sta:
+                        t["direction"] = -t["direction"]
+                    t["moving"] = t["index"] + t["direction"] in index_sta
+
+                # APIのレスポンスと同程度の項目数
+                data.append({
+                    "@context": "http://vocab.odpt.org/context_odpt.jsonld",
+                    "@id": f"urn:ucode:_bench{line}{t['number']}",
+                    "@type": "odpt:Train",
+                    "dc:date": date,
+                    "dc:valid": date,
+                    "owl:sameAs": f"odpt.Train:{line}.{t['number']}",
+                    "odpt:frequency": 90,
+                    "odpt:operator": "odpt.Operator:Bench",
+                    "odpt:railway": self.__line_table[line],
+                    "odpt:railDirection": "odpt.RailDirection:Bench",
+                    "odpt:trainNumber": t["number"],
+                    "odpt:trainType": "odpt.TrainType:Bench.Local",
+                    "odpt:trainOwner": "odpt.TrainOwner:Bench",
+                    "odpt:originStation": [index_sta[min(index_sta)]],
+                    "odpt:destinationStation": [index_sta[max(index_sta)]],
+                    "odpt:fromStation": index_sta[t["index"]],
+                    "odpt:toStation": index_sta[t["index"] + t["direction"]] if t["moving"] else None,
+                    "odpt:delay": 0,
+                    "odpt:carComposition": 6,
+                })
+
+        return data
+
+
+def run_config(odpt, stations, name, config, cycles, led_config, capture=None):
+    '''1構成の計測
+
+    captureを指定した場合は，合成データの代わりに記録したレスポンスを使用する
+
+    Returns
+    -------
+    result : dict
+        計測結果
+    '''
+    sta_table = scale_stations(stations, config["scale"])
+    lines = [line for ch in config["lines"] for line in ch]
+    generator = TrainGenerator(sta_table, odpt.line_table, lines, config["density"])
+    records = read_cycles(capture) if capture else None
+
+    leds = []
+    for ch in range(len(config["lines"])):
+        if config["lines"][ch] == []:
+            continue
+        led = LEDCtrl(sta_table, config["lines"][ch], ch, odpt.update_freq, led_config,
+                      backend="sim", backend_options={"record": False})
+        led.setup_strip()
+        leds.append(led)
+
+    decode = 0.0
+    partition = 0.0
+    render = []
+    pixels = 0
+    payload = 0
+
+    count = 0
+    for _ in range(cycles):
+        if records is not None:
+            # 記録したレスポンス
+            cycle = next(records, None)
+            if cycle is None:
+                break
+            raws = [r["body"].encode("utf-8") for r in cycle]
+        else:
+            # 取得したデータの代わりにjsonを作成
+            raws = [json.dumps(generator.next()).encode()]
+        payload += sum(len(raw) for raw in raws)
+        count += 1
+
+        start = time.perf_counter()
+        all_trains = []
+        for raw in raws:
+            all_trains += decode_trains(raw)
+        decode += time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = odpt.partition_trains(all_trains)
+        partition += time.perf_counter() - start
+
+        for led in leds:
+            trains = [index.get(line, []) for line in led.use_lines]
+            for movingpos in range(led.distance - 1):
+                start = time.perf_counter()
+                led.render_frame(trains, movingpos)
+                render.append(time.perf_counter() - start)
+                pixels += led.changed_pixels
+            led.commit_cache()
+
+    render.sort()
+    return {
+        "leds": sum(led.num_pixels for led in leds),
+        "trains": len(all_trains),
+        "payload_kb": payload / count / 1024,
+        "decode_ms": decode / count * 1000,
+        "partition_ms": partition / count * 1000,
+        "render_ms": sum(render) / len(render) * 1000,
+        "render_p95_ms": render[int(len(render) * 0.95)] * 1000,
+        "pixels": pixels,
+        "shows": sum(led.strip.show_count for led in leds),
+        "frames": len(render),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ODPT -> LEDCtrlの処理時間の計測")
+    parser.add_argument("-c", "--config", action="store", nargs='*', choices=list(CONFIGS.keys()),
+                        help="計測する構成. Default: 全て", default=list(CONFIGS.keys()))
+    parser.add_argument("-n", "--cycles", action="store", type=int,
+                        help="計測するデータ更新の回数. Default: 20", default=20)
+    parser.add_argument("-l", "--led-config", action="store", type=str,
+                        help="LEDの設定ファイル. Default: ./config/led_config.json", default="./config/led_config.json")
+    parser.add_argument("--capture", action="store", type=str,
+                        help="合成データの代わりに使用する記録ファイル (main.py --captureで記録)", default=None)
+    parser.add_argument("--baseline", action="store", type=str,
+                        help="基準値のファイル. Default: ./data/bench_baseline.json", default="./data/bench_baseline.json")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="計測結果で基準値を更新する")
+    parser.add_argument("--tolerance", action="store", type=float,
+                        help="基準値から許容する悪化の割合. Default: 0.5", default=0.5)
+    parser.add_argument("--min-delta", action="store", type=float,
+                        help="悪化とみなす最小の差[ms] (計測誤差の除外). Default: 0.05", default=0.05)
+    args = parser.parse_args()
+
+    odpt = ODPT()
+    stations = odpt.get_stationtable()
+
+    results = {}
+    print(f"{'config':<10} {'leds':>6} {'trains':>6} {'payload':>8} {'decode':>8} {'partition':>9} "
+          f"{'render':>8} {'p95':>8} {'pixels':>8} {'shows':>6}")
+    for name in args.config:
+        if args.capture and CONFIGS[name]["scale"] != 1:
+            continue
+        r = run_config(odpt, stations, name, CONFIGS[name], args.cycles, args.led_config, args.capture)
+        results[name] = r
+        print(f"{name:<10} {r['leds']:>6} {r['trains']:>6} {r['payload_kb']:>6.1f}KB {r['decode_ms']:>6.2f}ms "
+              f"{r['partition_ms']:>7.2f}ms {r['render_ms']:>6.2f}ms {r['render_p95_ms']:>6.2f}ms "
+              f"{r['pixels']:>8} {r['shows']:>6}")
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({k: {m: round(v[m], 4) for m in METRICS} for k, v in results.items()}, f, indent=4)
+            f.write("\n")
+        print(f"{Log.INFO()}Updated baseline: {args.baseline}")
+        return 0
+
+    # 基準値は合成データで計測したもの
+    if args.capture:
+        return 0
+
+    try:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"{Log.WARN()}Not Found {args.baseline}! Skip regression check.")
+        return 0
+
+    # 基準値との比較
+    failed = False
+    for name, r in results.items():
+        for m in METRICS:
+            base = baseline.get(name, {}).get(m)
+            if base is None:
+                continue
+            if r[m] > base * (1 + args.tolerance) and r[m] - base > args.min_delta:
+                print(f"{Log.ERROR()}{name}: {m} regressed. {r[m]:.3f} > {base:.3f} (+{args.tolerance:.0%})")
+                failed = True
+
+    if failed:
+        return 1
+
+    print(f"{Log.INFO()}No regression against {args.baseline}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
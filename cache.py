@@ -0,0 +1,264 @@
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+from log import Log, describe_error
+from decode import loads
+
+
+# 作成したデータの保存先
+CACHE_DIR = "./cache"
+
+
+def source_signature(path):
+    '''元ファイルの更新時刻・サイズ・ハッシュ値
+
+    Parameters
+    ----------
+    path : str
+        元ファイルのパス
+
+    Returns
+    -------
+    signature : dict
+        path, mtime(ns), size, sha1
+    '''
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+
+    return {"path": path, "mtime": st.st_mtime_ns, "size": st.st_size, "sha1": digest}
+
+
+def write_json(path, data):
+    '''jsonファイルを書き込む
+
+    書き込み途中のファイルを読み込まないよう，同じディレクトリの一時ファイルから置き換える.
+    一時ファイルは名前が重ならないため，複数のスレッド・プロセスから同時に書き込んでよい
+
+    Parameters
+    ----------
+    path : str
+        書き込むファイルのパス
+    data : object
+        jsonに変換可能な値
+    '''
+    dirpath = os.path.dirname(path) or "."
+    os.makedirs(dirpath, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=dirpath, prefix=os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as f:
+        tmp = f.name
+        try:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        except BaseException:
+            f.close()
+            os.unlink(tmp)
+            raise
+    try:
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def intern_keys(table):
+    '''駅テーブルの駅名をinternする (デコードした列車走行位置の駅名と同じ文字列を共有する)
+    '''
+    return {sys.intern(line): {sys.intern(k): v for k, v in sta.items()} for line, sta in table.items()}
+
+
+class ArtifactCache():
+    '''設定ファイル等から作成したデータのキャッシュ
+
+    作成したデータを元ファイルの更新時刻・ハッシュ値とともにjsonで保存し，
+    元ファイルが変わらない限り，次回以降は作成処理を省略して読み込む.
+    更新時刻が変わった場合もハッシュ値が同じであれば再利用する.
+    読み込みでコードが実行されないよう，保存するデータはjsonに変換可能な値に限る
+
+    Parameters
+    ----------
+    cachedir : str
+        保存先のディレクトリ
+
+    Attributes
+    ----------
+    hits : int
+        キャッシュを使用した回数
+    misses : int
+        データを作成した回数
+    '''
+
+    # 保存形式のバージョン. 作成処理を変更した場合は上げる
+    VERSION = 3
+
+    def __init__(self, cachedir=CACHE_DIR):
+        self.cachedir = cachedir
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, name, sources, build, key=None):
+        '''キャッシュからデータを読み込む. 無効な場合は作成して保存する
+
+        読み込むたびに新しいオブジェクトを返すため，呼び出し側で変更してよい
+
+        Parameters
+        ----------
+        name : str
+            キャッシュの名前 (ファイル名)
+        sources : list of str
+            データの元ファイルのパスのリスト
+        build : callable
+            データを作成する関数 (引数なし, jsonに変換可能な値を返す. tupleはlistとして読み込まれる)
+        key : object
+            元ファイル以外でデータが依存する値 (例: 表示路線, jsonに変換可能な値). 一致しない場合は作成し直す
+
+        Returns
+        -------
+        data : object
+            作成したデータ
+        '''
+        path = os.path.join(self.cachedir, f"{name}.json")
+        entry = self.__read(path)
+        # 保存したkeyと同じ形式で比較 (tupleはlistになる)
+        key = json.loads(json.dumps(key))
+
+        if entry is not None and entry.get("version") == self.VERSION and entry.get("key") == key \
+                and "data" in entry:
+            try:
+                signatures = self.__validate(entry["sources"], sources)
+            except (KeyError, TypeError):
+                signatures = None
+            if signatures is not None:
+                self.hits += 1
+                if signatures is not entry["sources"]:
+                    # 更新時刻のみ変わった場合は記録し直す
+                    entry["sources"] = signatures
+                    self.__write(path, entry)
+                return entry["data"]
+
+        self.misses += 1
+        data = build()
+        self.__write(path, {
+            "version": self.VERSION,
+            "key": key,
+            "sources": [source_signature(p) for p in sources],
+            "data": data,
+        })
+
+        return data
+
+    def __validate(self, saved, sources):
+        '''保存時の元ファイルと現在の元ファイルを比較する
+
+        Returns
+        -------
+        signatures : list of dict
+            有効な場合は元ファイルの情報 (変化がない場合はsavedそのもの). 無効な場合はNone
+        '''
+        if [s["path"] for s in saved] != list(sources):
+            return None
+
+        signatures = saved
+        for i, s in enumerate(saved):
+            try:
+                st = os.stat(s["path"])
+            except FileNotFoundError:
+                return None
+
+            if st.st_mtime_ns == s["mtime"] and st.st_size == s["size"]:
+                continue
+
+            # 更新時刻が変わった場合は内容を比較
+            current = source_signature(s["path"])
+            if current["sha1"] != s["sha1"]:
+                return None
+            if signatures is saved:
+                signatures = list(saved)
+            signatures[i] = current
+
+        return signatures
+
+    def __read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                entry = loads(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            Log.warn(f"Ignored broken cache {path}: {e}")
+            return None
+
+        if not isinstance(entry, dict):
+            Log.warn(f"Ignored broken cache {path}: Not an object")
+            return None
+        return entry
+
+    def __write(self, path, entry):
+        try:
+            write_json(path, entry)
+        except (OSError, TypeError, ValueError) as e:
+            Log.warn(f"Could not save cache {path}: {e}")
+
+
+class TTLCache():
+    '''APIから取得したデータのキャッシュ
+
+    取得時刻とともにjsonで保存し，有効期間内は取得を省略する.
+    取得に失敗した場合は期限切れのデータを使用する
+
+    Parameters
+    ----------
+    cachedir : str
+        保存先のディレクトリ
+    ttl : float
+        有効期間[s]
+    '''
+
+    def __init__(self, cachedir=CACHE_DIR, ttl=86400):
+        self.cachedir = cachedir
+        self.ttl = ttl
+
+    def load(self, name, fetch):
+        '''有効期間内であれば保存したデータを返す. 期限切れの場合は取得して保存する
+
+        Parameters
+        ----------
+        name : str
+            キャッシュの名前 (ファイル名)
+        fetch : callable
+            データを取得する関数 (引数なし, jsonに変換可能な値を返す)
+
+        Returns
+        -------
+        data : object
+            取得したデータ
+        '''
+        path = os.path.join(self.cachedir, f"{name}.json")
+        entry = None
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+
+        if entry is not None and time.time() - entry["fetched_at"] < self.ttl:
+            return entry["data"]
+
+        try:
+            data = fetch()
+        except Exception as e:
+            if entry is None:
+                raise
+            Log.warn(f"Failed to fetch {name} ({describe_error(e)}). Use cache fetched at "
+                     f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['fetched_at']))}.")
+            return entry["data"]
+
+        try:
+            write_json(path, {"fetched_at": time.time(), "data": data})
+        except OSError as e:
+            Log.warn(f"Could not save cache {path}: {e}")
+
+        return data
@@ -0,0 +1,289 @@
+import gzip
+import json
+import threading
+import time
+
+
+class CaptureWriter():
+    '''APIのレスポンスの記録
+
+    取得したレスポンスの本文を取得時刻とともに，gzip圧縮したjson linesに追記する.
+    1レコードごとにflushするため，記録中のファイルも先頭から順に読み込める
+
+    Parameters
+    ----------
+    path : str
+        記録するファイルのパス (例: ./capture.jsonl.gz)
+
+    Attributes
+    ----------
+    count : int
+        記録したレスポンス数
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.__file = gzip.open(path, 'ab')
+        self.__lock = threading.Lock()
+
+    def write(self, service, key, body, cycle, fetched_at=None):
+        '''レスポンスを1件記録する
+
+        Parameters
+        ----------
+        service : str
+            オープンデータのサービス("odpt" or "metro")
+        key : str
+            取得対象 ("Trains": 全列車, lineCode: 路線ごと)
+        body : bytes
+            レスポンスの本文
+        cycle : int
+            ODPTの取得周期の通し番号
+        fetched_at : float
+            取得時刻 (UNIX時間). Noneの場合は現在時刻
+        '''
+        record = {
+            "t": time.time() if fetched_at is None else fetched_at,
+            "cycle": cycle,
+            "service": service,
+            "key": key,
+            "body": body.decode("utf-8"),
+        }
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+        with self.__lock:
+            self.__file.write(line)
+            self.__file.flush()
+            self.count += 1
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+def read_capture(path):
+    '''記録したレスポンスを順に読み込む
+
+    ファイル全体を読み込まないため，記録の長さによらずメモリ使用量は一定
+
+    Parameters
+    ----------
+    path : str
+        CaptureWriterで記録したファイルのパス
+
+    Yields
+    ------
+    record : dict
+        t, cycle, service, key, body
+    '''
+    with gzip.open(path, 'rb') as f:
+        try:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # 記録途中の行
+                    return
+                yield json.loads(line)
+        except EOFError:
+            # 記録中のファイル (gzipの終端なし)
+            return
+
+
+def read_cycles(path):
+    '''記録したレスポンスを取得周期ごとにまとめて読み込む
+
+    Parameters
+    ----------
+    path : str
+        CaptureWriterで記録したファイルのパス
+
+    Yields
+    ------
+    records : list of dict
+        同じ取得周期のレコードのリスト
+    '''
+    records = []
+    for record in read_capture(path):
+        if records and record["cycle"] != records[0]["cycle"]:
+            yield records
+            records = []
+        records.append(record)
+
+    if records:
+        yield records
+
+
+class ReplayResponse():
+    '''記録したレスポンス (requests.Responseの代わり)
+    '''
+
+    def __init__(self, body):
+        self.status_code = 200
+        self.headers = {}
+        self.content = body
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class ReplaySource():
+    '''記録したレスポンスの再生
+
+    ODPTのHTTP取得の代わりに，記録したレスポンスを記録時の時間間隔で再生する.
+    全列車と路線ごとのレスポンスを両方記録した場合は，路線ごとに記録時刻の新しい方を使用する
+
+    Parameters
+    ----------
+    path : str
+        CaptureWriterで記録したファイルのパス
+    speed : float
+        再生速度の倍率. 0の場合は取得ごとに次の取得周期に進む(最大速度)
+    loop : bool
+        終端に達した場合に先頭から再生する
+
+    Attributes
+    ----------
+    clock : float
+        再生中の記録上の時刻 (UNIX時間)
+    cycles : int
+        再生した取得周期の数
+    '''
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+
+        self.clock = None
+        self.cycles = 0
+
+        self.__lock = threading.Lock()
+        self.__cycles = read_cycles(path)
+        self.__pending = None
+        # (サービス, 取得対象)ごとの最新の(記録時刻, 本文)
+        self.__latest = {}
+        # (サービス, lineCode)ごとのodpt:railway (路線ごとのレスポンスから取得)
+        self.__railways = {}
+        self.__start = None
+
+    def advance(self):
+        '''再生時刻まで記録を読み進める
+
+        Returns
+        -------
+        updated : bool
+            新しいレスポンスを読み込んだ場合はTrue
+        '''
+        with self.__lock:
+            # 最大速度: 1周期ずつ進める
+            if self.speed <= 0 or self.__start is None:
+                records = self.__next_cycle()
+                if records is None:
+                    return False
+                self.__apply(records)
+                self.clock = records[0]["t"]
+                if self.__start is None:
+                    self.__start = (time.monotonic(), records[0]["t"])
+                return True
+
+            start_mono, start_t = self.__start
+            self.clock = start_t + (time.monotonic() - start_mono) * self.speed
+
+            updated = False
+            while True:
+                records = self.__next_cycle()
+                if records is None:
+                    break
+                if self.__start is None:
+                    # 先頭から再生し直す
+                    self.__apply(records)
+                    self.clock = records[0]["t"]
+                    self.__start = (time.monotonic(), records[0]["t"])
+                    updated = True
+                    break
+                if records[0]["t"] > self.clock:
+                    # 再生時刻に達していない周期は保留
+                    self.__pending = records
+                    break
+                self.__apply(records)
+                updated = True
+
+            return updated
+
+    def response(self, service, key):
+        '''再生中のレスポンスを取得する
+
+        Parameters
+        ----------
+        service : str
+            オープンデータのサービス("odpt" or "metro")
+        key : str
+            取得対象 ("Trains": 全列車, lineCode: 路線ごと)
+
+        Returns
+        -------
+        r : ReplayResponse
+            レスポンス
+        '''
+        with self.__lock:
+            if key == "Trains":
+                body = self.__merge_lines(service)
+            else:
+                latest = self.__latest.get((service, key))
+                body = latest[1] if latest is not None else None
+            if body is None:
+                body = b"[]"
+
+        return ReplayResponse(body)
+
+    def __merge_lines(self, service):
+        '''全列車のレスポンスに，それより新しい路線ごとのレスポンスを反映する
+        '''
+        bulk = self.__latest.get((service, "Trains"))
+        newer = [(k, body) for (s, k), (t, body) in self.__latest.items()
+                 if s == service and k != "Trains" and (bulk is None or t > bulk[0])]
+        if not newer:
+            return bulk[1] if bulk is not None else None
+
+        # 路線ごとに記録した場合は結合して全列車とする
+        trains = json.loads(bulk[1]) if bulk is not None else []
+        line_trains = []
+        replaced = set()
+        for k, body in newer:
+            v = json.loads(body)
+            line_trains.extend(v)
+            replaced.update(t.get("odpt:railway") for t in v)
+            railway = self.__railways.get((service, k))
+            if railway is not None:
+                replaced.add(railway)
+
+        trains = [t for t in trains if t.get("odpt:railway") not in replaced]
+        return json.dumps(trains + line_trains).encode("utf-8")
+
+    def __next_cycle(self):
+        if self.__pending is not None:
+            records, self.__pending = self.__pending, None
+            return records
+
+        records = next(self.__cycles, None)
+        if records is None and self.loop:
+            self.__cycles = read_cycles(self.path)
+            self.__start = None
+            records = next(self.__cycles, None)
+
+        return records
+
+    def __apply(self, records):
+        for record in records:
+            key = (record["service"], record["key"])
+            body = record["body"].encode("utf-8")
+            self.__latest[key] = (record["t"], body)
+            # 列車がない路線のレスポンスでも全列車から除けるよう，路線ごとのodpt:railwayを記憶する
+            if record["key"] != "Trains" and key not in self.__railways:
+                trains = json.loads(body)
+                if trains:
+                    self.__railways[key] = trains[0].get("odpt:railway")
+        self.cycles += 1
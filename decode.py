@@ -0,0 +1,78 @@
+import json
+import sys
+
+# 高速なjsonライブラリがあれば使用する
+try:
+    import orjson
+    loads = orjson.loads
+    BACKEND = "orjson"
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+        BACKEND = "ujson"
+    except ImportError:
+        loads = json.loads
+        BACKEND = "json"
+
+
+# 描画・取得計画に使用する項目 (デコード後に残す項目)
+TRAIN_FIELDS = (
+    "odpt:railway",
+    "odpt:trainNumber",
+    "odpt:fromStation",
+    "odpt:toStation",
+    "dc:date",
+    "dc:valid",
+    "odpt:frequency",
+)
+# TRAIN_FIELDSのうち，internする項目 (駅・路線)
+INTERN_FIELDS = frozenset(["odpt:railway", "odpt:fromStation", "odpt:toStation"])
+# TRAIN_FIELDSのうち，ない場合はKeyErrorとする項目
+REQUIRED_FIELDS = frozenset(["odpt:railway", "odpt:fromStation"])
+
+# 項目ごとの(項目名, internするか, 必須か)
+_PROJECTION = tuple((field, field in INTERN_FIELDS, field in REQUIRED_FIELDS) for field in TRAIN_FIELDS)
+
+
+def decode_trains(body):
+    '''列車走行位置のjsonをデコードし，必要な項目のみに射影する
+
+    jsonは全体をデコードした後に(項目を選んで解析するのではない)，TRAIN_FIELDSのみの新しいdictに写す.
+    解析の量は減らないが，レスポンスの全項目を持つdictを保持せず，以降の処理・保持するデータが小さくなる.
+    INTERN_FIELDSの文字列はinternし，同じ文字列を共有する
+
+    Parameters
+    ----------
+    body : bytes
+        odpt:Trainのレスポンスの本文
+
+    Returns
+    -------
+    data : list of dict
+        TRAIN_FIELDSのみを持つ列車走行位置情報
+
+    Raises
+    ------
+    KeyError
+        REQUIRED_FIELDSの項目がない列車がある
+    '''
+    intern = sys.intern
+    projection = _PROJECTION
+    data = []
+    append = data.append
+
+    for train in loads(body):
+        get = train.get
+        row = {}
+        for field, interned, required in projection:
+            value = get(field)
+            if value is None:
+                if required:
+                    raise KeyError(field)
+            elif interned:
+                value = intern(value)
+            row[field] = value
+        append(row)
+
+    return data
@@ -0,0 +1,214 @@
+import json
+import sys
+
+from log import Log
+
+
+class Segment():
+    '''駅間(または停車駅)ごとのLEDの点灯経路
+
+    Parameters
+    ----------
+    lednums : tuple of int
+        movingposごとの列車位置のLEDの番号 (路線内の番号, キャッシュに使用)
+    pixels : tuple of tuple of int
+        movingposごとに点灯するLEDの番号 (LEDテープ全体の番号)
+    hold_direction : int
+        列車位置を据え置く場合に, 列車位置のLEDと合わせて点灯するLEDの向き
+    '''
+
+    __slots__ = ("lednums", "pixels", "hold_direction")
+
+    def __init__(self, lednums, pixels, hold_direction):
+        self.lednums = lednums
+        self.pixels = pixels
+        self.hold_direction = hold_direction
+
+
+def load_segment_table(jsonpath="./data/segment_table.json"):
+    '''特殊区間の定義ファイルを読み込む
+
+    Parameters
+    ----------
+    jsonpath : str
+        segment_table.jsonのパス
+
+    Returns
+    -------
+    special : dict
+        路線ごとの特殊区間の定義のリスト
+    '''
+    try:
+        with open(jsonpath, 'r') as sg:
+            return json.load(sg)
+    except FileNotFoundError:
+        Log.error(f"Not Found {jsonpath}! Exit.")
+        sys.exit()
+
+
+def compile_segment(stations, distance, offset, from_sta, to_sta, rule=None):
+    '''1区間の点灯経路を作成する
+
+    Parameters
+    ----------
+    stations : dict
+        路線の駅テーブル
+    distance : int
+        駅間のLEDのドット数 + 1
+    offset : int
+        路線のLEDのoffset
+    from_sta : str
+        odpt:fromStation
+    to_sta : str
+        odpt:toStation (駅停車時はNone)
+    rule : dict
+        特殊区間の定義 (segment_table.json). 通常区間はNone
+
+    Returns
+    -------
+    segment : Segment
+        区間の点灯経路
+    '''
+    from_led = stations[from_sta] * distance
+    steps = range(distance - 1)
+
+    # 駅停車時
+    if to_sta is None:
+        return Segment(tuple(from_led for _ in steps),
+                       tuple((from_led + offset,) for _ in steps), 0)
+
+    to_led = stations[to_sta] * distance
+
+    # ナンバリング正方向: 1, 負方向: -1
+    normal_direction = 1 if from_led < to_led else -1
+
+    if rule is None:
+        rule = {"origin": "from", "shift": 0, "direction": normal_direction, "depart": False}
+
+    direction = rule["direction"]
+    base = (from_led if rule["origin"] == "from" else to_led) + rule["shift"] * distance
+
+    lednums = []
+    pixels = []
+    for movingpos in steps:
+        # 出発直後: 出発駅のLEDと経路の最初のLEDを点灯
+        if rule["depart"] and movingpos == 0:
+            lednums.append(from_led)
+            pixels.append((from_led + offset, base + direction + offset))
+        else:
+            lednum = base + movingpos * direction
+            lednums.append(lednum)
+            pixels.append((lednum + offset, lednum + direction + offset))
+
+    return Segment(tuple(lednums), tuple(pixels),
+                   rule.get("hold_direction", normal_direction))
+
+
+def compile_layout(stations, use_lines, distance, offsets, special):
+    '''路線ごとに区間から点灯経路への対応表を作成する
+
+    隣接駅間, 駅停車時, 特殊区間の点灯経路を事前に計算する
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    use_lines : list of str
+        接続したLEDテープの路線のlineCodeのリスト
+    distance : int
+        駅間のLEDのドット数 + 1
+    offsets : dict
+        路線ごとのLEDのoffset
+    special : dict
+        路線ごとの特殊区間の定義のリスト (segment_table.json)
+
+    Returns
+    -------
+    layout : dict
+        路線ごとの(fromStation, toStation)から点灯経路(Segment)への対応表
+    '''
+    layout = {}
+
+    for line in use_lines:
+        sta = stations[line]
+        offset = offsets[line]
+        table = {}
+
+        # 駅停車時と隣接駅間
+        index_sta = {v: k for k, v in sta.items()}
+        for name, index in sta.items():
+            table[(name, None)] = compile_segment(sta, distance, offset, name, None)
+            for neighbor in (index - 1, index + 1):
+                if neighbor in index_sta:
+                    table[(name, index_sta[neighbor])] = compile_segment(
+                        sta, distance, offset, name, index_sta[neighbor])
+
+        # 特殊区間
+        for rule in special.get(line, []):
+            if rule["from"] in sta and rule["to"] in sta:
+                table[(rule["from"], rule["to"])] = compile_segment(
+                    sta, distance, offset, rule["from"], rule["to"], rule)
+
+        layout[line] = table
+
+    return layout
+
+
+def intern_layout(layout):
+    '''対応表の駅名をinternする
+
+    保存した対応表を読み込んだ場合に，デコードした列車走行位置の駅名と同じ文字列を共有し，
+    検索時の文字列の比較を省略する
+
+    Parameters
+    ----------
+    layout : dict
+        compile_layout()で作成した対応表
+
+    Returns
+    -------
+    layout : dict
+        駅名をinternした対応表
+    '''
+    intern = sys.intern
+    return {line: {(intern(f), None if t is None else intern(t)): segment
+                   for (f, t), segment in table.items()}
+            for line, table in layout.items()}
+
+
+def layout_to_json(layout):
+    '''対応表をjsonで保存できる形式に変換する
+
+    Parameters
+    ----------
+    layout : dict
+        compile_layout()で作成した対応表
+
+    Returns
+    -------
+    data : dict
+        路線ごとの[fromStation, toStation, lednums, pixels, hold_direction]のリスト
+    '''
+    return {line: [[f, t, segment.lednums, segment.pixels, segment.hold_direction]
+                   for (f, t), segment in table.items()]
+            for line, table in layout.items()}
+
+
+def layout_from_json(data):
+    '''layout_to_json()で変換したデータから対応表を作成する (駅名はinternする)
+
+    Parameters
+    ----------
+    data : dict
+        layout_to_json()で変換したデータ
+
+    Returns
+    -------
+    layout : dict
+        compile_layout()と同じ形式の対応表
+    '''
+    intern = sys.intern
+    return {intern(line): {(intern(f), None if t is None else intern(t)):
+                           Segment(tuple(lednums), tuple(tuple(p) for p in pixels), hold)
+                           for f, t, lednums, pixels, hold in table}
+            for line, table in data.items()}
@@ -1,9 +1,20 @@
+import hashlib
 import json
 import time
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 from log import Log
-from rpi_ws281x import *
+from scheduler import FrameScheduler, parse_date
+from layout import compile_layout, compile_segment, load_segment_table, intern_layout, layout_to_json, \
+    layout_from_json
+from cache import ArtifactCache
+from strip import Color, ColorCorrection, create_strip
+from power import PowerLimiter
 
 
 class LEDCtrl():
@@ -21,6 +32,16 @@ class LEDCtrl():
         データの更新間隔
     jsonpath : str
         led_config.jsonのパス
+    segpath : str
+        segment_table.json(特殊区間の定義)のパス
+    backend : str
+        LEDテープの出力先 ("ws281x": rpi_ws281x, "sim": シミュレータ)
+    backend_options : dict
+        出力先のオプション (strip.create_strip()を参照)
+    metrics : Metrics
+        描画・show()・遅延の記録先 (Noneの場合は記録しない)
+    runtimes : dict
+        ODPT.get_runtimes()で得た駅間の所要時間 (Noneの場合は取得間隔で均等に移動)
 
     Attributes
     ----------
@@ -38,97 +59,605 @@ class LEDCtrl():
         駅を示すLEDの色(R, G, B)
     lines : dict
         路線ごとのLED設定
+    num_pixels : int
+        LEDテープ全体のドット数
+    changed_pixels : int
+        直近のフレームで書き換えたLEDの数
+    frame_count : int
+        描画したフレーム数
+    skipped_shows : int
+        変化がなくshow()を省略したフレーム数
+    frame_scheduler : FrameScheduler
+        描画タイミング (実フレームレート, 遅延)
+    reload_count : int
+        設定ファイル・駅テーブルの変更を反映した回数
+    layout : dict
+        路線ごとの区間から点灯経路への対応表 (layout.compile_layout())
+    strip : StripBackend
+        LEDテープの出力先
+    batch : bool
+        NumPyによる一括描画を行う (led_configのrender_mode)
+    colors : dict
+        路線ごとの列車・背景・Wipe・停滞時の色 (Color()に変換済み, ガンマ補正・ホワイトバランス適用済み)
+    power : PowerLimiter
+        消費電流の推定と明るさの制限 (led_configのpower. 上限がない場合はNone)
+    stale_threshold : float
+        データが古いとみなす，最後に取得できてからの経過時間[s] (led_configのstale)
+    stale_mode : str
+        データが古い路線の表示 ("dim": 列車を暗く表示, "blink": 列車を点滅, "none": 変更しない)
+    stale_lines : set of str
+        データが古いとみなした路線のlineCode
+    interpolation : str
+        駅間の列車位置 ("timetable": 所要時間と経過時間から推定, "even": 取得間隔で均等に移動)
+    runtimes : dict
+        列車位置の推定に使用する路線ごとの駅間の所要時間[s]
+    estimate_error : float
+        直近のスナップショットで到着を確認した列車の，推定した到着時刻の誤差の平均[s]. 未計測の場合はNone
+    estimate_bias : float
+        推定した到着時刻の誤差の符号付き平均[s] (正: 推定が遅い)
+    estimate_samples : int
+        誤差を計測した列車数
     '''
 
-    def __init__(self, stations, use_lines, channel, update_freq, jsonpath="./config/led_config.json"):
+    def __init__(self, stations, use_lines, channel, update_freq, jsonpath="./config/led_config.json",
+                 segpath="./data/segment_table.json", backend="ws281x", backend_options=None, metrics=None,
+                 runtimes=None):
+        # 点灯経路等の配置は，元ファイルが変わらない限り前回作成したものを使用
+        self.__cache = ArtifactCache()
+        self.__sources = [jsonpath, segpath]
+        self.__jsonpath = jsonpath
+        self.__segpath = segpath
+        # 設定ファイルの再読み込みで作成した，次のフレームで差し替える配置
+        self.__pending = None
         try:
             with open(jsonpath, 'r') as cf:
                 config = json.load(cf)
         except FileNotFoundError:
-            print(f"{Log.ERROR()}Not Found {jsonpath}! Exit.")
+            Log.error(f"Not Found {jsonpath}! Exit.")
             sys.exit()
 
-        self.__FREQ_HZ = 800000
-        self.__DMA = 10
-        self.__INVERT = False
+        self.__backend = backend
+        self.__backend_options = backend_options or {}
+        self.__metrics = metrics
+        self.__show_elapsed = 0.0
 
         self.stations = stations
         self.use_lines = use_lines
         self.channel = channel
         self.update_freq = update_freq
         self.__strip = None
+        self.__base_frame = []
+        self.__frame = []
+        self.__prev_frame = None
+        self.num_pixels = 0
+        self.changed_pixels = 0
+        self.frame_count = 0
+        self.skipped_shows = 0
 
         self.distance = config["led_distance"] + 1
         self.sta_color = config["stationcolor"]
         self.brightness = config["brightness"]
         self.lines = config["lines"]
+        self.frame_scheduler = FrameScheduler(config.get("frame_rate", 10))
+        self.special = load_segment_table(segpath)
+        self.reload_count = 0
+        self.layout = {}
+        self.colors = {}
+        # LEDテープの種類ごとの色の補正 (色は作成時に1回だけ補正する)
+        self.__correction = ColorCorrection.from_config(config)
+        self.__sta_color = self.__correction.color(self.sta_color)
+        # 消費電流の上限 (LEDテープのセットアップ時に作成)
+        self.__power_config = config.get("power")
+        self.power = None
+
+        # API障害時のデータが古い路線の表示
+        stale = config.get("stale", {})
+        self.stale_threshold = stale.get("threshold", 120)
+        self.stale_mode = stale.get("mode", "dim")
+        self.__stale_level = stale.get("level", 0.3)
+        self.stale_lines = set()
+        # 路線ごとの現在の列車の色 (Noneの場合は列車を表示しない)
+        self.__palette = []
+        self.__palette_array = None
+
+        # 駅間の所要時間による列車位置の推定
+        self.interpolation = config.get("interpolation", "timetable")
+        self.__runtimes = runtimes or {}
+        self.runtimes = self.__runtimes if self.interpolation == "timetable" else {}
+        self.estimate_error = None
+        self.estimate_bias = None
+        self.estimate_samples = 0
+
+        # 描画方法 ("auto": NumPyがあれば一括描画, "batch": 一括描画, "scalar": 列車ごとに描画)
+        render_mode = config.get("render_mode", "auto")
+        self.batch = render_mode == "batch" or (render_mode == "auto" and np is not None)
+        if self.batch and np is None:
+            Log.warn(f"NumPy is not installed. Set render mode \"scalar\".")
+            self.batch = False
+        self.__batch = None
+        self.__last_caches = None
 
     def setup_strip(self):
         '''各路線のLEDテープのセットアップ
         '''
-        # channel
-        if self.channel == 0: gpio = 12
-        elif self.channel == 1: gpio = 13
+        # 表示路線・駅テーブルが同じであれば，前回作成した配置を使用
+        digest = hashlib.sha1(repr(
+            [(line, sorted(self.stations[line].items())) for line in self.use_lines]).encode()).hexdigest()
+        compiled = self.__cache.load(f"layout-{digest[:16]}", self.__sources, self.__compile)
 
-        # LEDのoffset
-        offset = 0
+        for line in self.use_lines:
+            self.lines[line]["offset"] = compiled["offsets"][line]
+        self.num_pixels = compiled["num_pixels"]
+        self.colors = compiled["colors"]
+        self.layout = layout_from_json(compiled["layout"])
+        self.__set_palette([self.colors[line]["train"] for line in self.use_lines])
 
-        # LED長を計算
-        for i in range(len(self.use_lines)):
-            self.lines[self.use_lines[i]]["offset"] = offset
-            offset = (len(self.stations[self.use_lines[i]])-1) * self.distance + 1 + offset
+        self.__base_frame = compiled["base_frame"]
+        if self.batch:
+            self.__base_frame = np.array(self.__base_frame, dtype=np.uint32)
 
         # 各路線の設定項目にstripを追加
-        self.__strip = Adafruit_NeoPixel(
-            offset, gpio, self.__FREQ_HZ,
-            self.__DMA, self.__INVERT, self.brightness, self.channel)
+        self.__strip = create_strip(
+            self.__backend, self.num_pixels, self.brightness, self.channel, **self.__backend_options)
         self.__strip.begin()
+        self.power = PowerLimiter.from_config({"power": self.__power_config}, self.num_pixels, self.batch)
+
+    def __compile(self):
+        '''LEDの配置(offset, 背景色・駅の色, 点灯経路, 色)を作成する
+
+        Returns
+        -------
+        compiled : dict
+            offsets, num_pixels, base_frame, layout, colors
+        '''
+        # LEDのoffset
+        offsets, num_pixels = self.__compile_offsets(self.stations, self.distance)
+        for line in self.use_lines:
+            self.lines[line]["offset"] = offsets[line]
+        self.num_pixels = num_pixels
+
+        # 列車・背景・Wipeの色
+        colors = self.__compile_colors(self.lines, self.__stale_level, self.__correction)
+        self.colors = colors
+
+        return {
+            "offsets": offsets,
+            "num_pixels": num_pixels,
+            "colors": colors,
+            # 背景色・駅の色を事前に作成
+            "base_frame": self.__compile_base_frame(
+                self.stations, self.distance, offsets, num_pixels, colors, self.__sta_color),
+            # 区間ごとの点灯経路を事前に作成
+            "layout": layout_to_json(
+                compile_layout(self.stations, self.use_lines, self.distance, offsets, self.special)),
+        }
+
+    def __compile_offsets(self, stations, distance):
+        '''路線ごとのLEDのoffsetとLEDテープ全体のドット数を計算する
+        '''
+        offset = 0
+        offsets = {}
+        for line in self.use_lines:
+            offsets[line] = offset
+            offset = (len(stations[line])-1) * distance + 1 + offset
+
+        return offsets, offset
+
+    def __compile_colors(self, lines, stale_level, correction):
+        '''路線ごとの列車・背景・Wipe・停滞時の色を作成する
+        '''
+        colors = {}
+        for line in self.use_lines:
+            colors[line] = {
+                "train": correction.color(lines[line]["traincolor"]),
+                "ground": correction.color(lines[line]["groundcolor"]),
+                "wipe": correction.color(lines[line]["traincolor"], 0.5),
+                "stale": correction.color(lines[line]["traincolor"], stale_level),
+            }
+
+        return colors
+
+    def reload(self, stations=None):
+        '''設定ファイル・駅テーブルの変更を反映する
+
+        変更のあった部分のみ作成し直し，描画スレッドが次のフレームの区切りで差し替える.
+        点灯経路が変わらない路線は，表示中のスナップショットの列車位置(キャッシュ)を引き継ぐ
+
+        Parameters
+        ----------
+        stations : dict
+            新しい駅テーブル. Noneの場合は現在の駅テーブル
 
-    def show_strip(self, trains):
+        Returns
+        -------
+        changes : list of str
+            変更された項目. 変更がない場合は[]
+        '''
+        with open(self.__jsonpath, 'r') as cf:
+            config = json.load(cf)
+        with open(self.__segpath, 'r') as sg:
+            special = json.load(sg)
+        stations = self.stations if stations is None else stations
+
+        distance = config["led_distance"] + 1
+        lines = config["lines"]
+        offsets, num_pixels = self.__compile_offsets(stations, distance)
+        stale = config.get("stale", {})
+        stale_level = stale.get("level", 0.3)
+        correction = ColorCorrection.from_config(config)
+        sta_color = correction.color(config["stationcolor"])
+        colors = self.__compile_colors(lines, stale_level, correction)
+
+        # 列車位置(路線内のLEDの番号)が無効になる路線 (駅テーブル・駅間のドット数・特殊区間が変わった路線)
+        affected = {line for line in self.use_lines
+                    if distance != self.distance or stations[line] != self.stations[line]
+                    or special.get(line) != self.special.get(line)}
+        # 点灯経路を作り直す路線 (上記に加え，前の路線の長さが変わりoffsetがずれた路線)
+        rebuild = affected | {line for line in self.use_lines if offsets[line] != self.lines[line]["offset"]}
+        layout = {line: self.layout[line] for line in self.use_lines if line not in rebuild}
+        if rebuild:
+            layout.update(intern_layout(compile_layout(
+                stations, [line for line in self.use_lines if line in rebuild], distance, offsets, special)))
+
+        changes = []
+        if rebuild:
+            changes.append(f"layout {sorted(rebuild)}")
+        if colors != self.colors or sta_color != self.__sta_color:
+            changes.append("colors")
+        if config["brightness"] != self.brightness:
+            changes.append("brightness")
+        if config.get("power") != self.__power_config:
+            changes.append("power")
+        if any(lines[line].get("reverse") != self.lines[line].get("reverse") for line in self.use_lines):
+            changes.append("reverse")
+        if config.get("frame_rate", 10) != self.frame_scheduler.frame_rate:
+            changes.append("frame_rate")
+        if (stale.get("threshold", 120), stale.get("mode", "dim"), stale_level) != \
+                (self.stale_threshold, self.stale_mode, self.__stale_level):
+            changes.append("stale")
+        if config.get("interpolation", "timetable") != self.interpolation:
+            changes.append("interpolation")
+        if not changes:
+            return changes
+
+        self.__pending = {
+            "config": config,
+            "special": special,
+            "stations": stations,
+            "distance": distance,
+            "lines": lines,
+            "offsets": offsets,
+            "num_pixels": num_pixels,
+            "colors": colors,
+            "sta_color": sta_color,
+            "correction": correction,
+            "layout": layout,
+            "affected": affected,
+            "base_frame": self.__compile_base_frame(stations, distance, offsets, num_pixels, colors, sta_color),
+        }
+
+        return changes
+
+    def __apply_reload(self):
+        '''reload()で作成した配置に差し替える (描画スレッドのフレームの区切りで呼ぶ)
+        '''
+        pending, self.__pending = self.__pending, None
+        config = pending["config"]
+
+        # 点灯経路が変わらない路線は列車位置を引き継ぐ
+        lines = pending["lines"]
+        for line in self.use_lines:
+            lines[line]["offset"] = pending["offsets"][line]
+            lines[line]["cache"] = {} if line in pending["affected"] else self.lines[line]["cache"]
+
+        self.lines = lines
+        self.stations = pending["stations"]
+        self.special = pending["special"]
+        self.distance = pending["distance"]
+        self.sta_color = config["stationcolor"]
+        self.__sta_color = pending["sta_color"]
+        self.__correction = pending["correction"]
+        self.colors = pending["colors"]
+        self.layout = pending["layout"]
+        self.__base_frame = pending["base_frame"]
+        if self.batch:
+            self.__base_frame = np.array(self.__base_frame, dtype=np.uint32)
+
+        stale = config.get("stale", {})
+        self.stale_threshold = stale.get("threshold", 120)
+        self.stale_mode = stale.get("mode", "dim")
+        self.__stale_level = stale.get("level", 0.3)
+        self.interpolation = config.get("interpolation", "timetable")
+        self.runtimes = self.__runtimes if self.interpolation == "timetable" else {}
+
+        frame_rate = config.get("frame_rate", 10)
+        if frame_rate != self.frame_scheduler.frame_rate:
+            self.frame_scheduler = FrameScheduler(frame_rate)
+
+        # 路線ごとの列車の色 (データが古い路線は次のフレームで設定し直す)
+        self.__set_palette([self.colors[line]["train"] for line in self.use_lines])
+
+        # LEDの数が変わった場合はLEDテープを初期化し直す
+        if pending["num_pixels"] != self.num_pixels:
+            self.__strip.close()
+            self.num_pixels = pending["num_pixels"]
+            self.__strip = create_strip(
+                self.__backend, self.num_pixels, config["brightness"], self.channel, **self.__backend_options)
+            self.__strip.begin()
+        # 明るさは次のフレームのshow()の前に設定する (消費電流の上限による制限を含む)
+        self.brightness = config["brightness"]
+        self.__power_config = config.get("power")
+        self.power = PowerLimiter.from_config(config, self.num_pixels, self.batch)
+
+        # 次のフレームで配列・全LEDを作り直す
+        self.__batch = None
+        self.__last_caches = None
+        self.__prev_frame = None
+        self.reload_count += 1
+
+    @property
+    def strip(self):
+        '''LEDテープの出力先
+        '''
+        return self.__strip
+
+    def show_strip(self, trains, duration=None):
         '''LEDテープに列車位置を点灯
 
         Parameters
         ----------
         trains : list of list(ODPT.get_train())
             路線ごとの列車位置情報をまとめたリスト
+        duration : float
+            駅間アニメーションの所要時間[s]. Noneの場合はupdate_freq
         '''
-        for i in range(self.distance-1):
+        if duration is None or duration <= 0:
+            duration = self.update_freq
+
+        steps = self.distance - 1
+        start = self.frame_scheduler.start()
+        now = start
+
+        while True:
+            # 経過時間から駅間の移動位置を決定
+            movingpos = min(int((now - start) / duration * steps), steps - 1)
+            self.render_frame(trains, movingpos, time.time())
+
+            if movingpos == steps - 1 and now - start >= duration:
+                break
+            now = self.__wait_frame()
+
+        # 次回更新時用キャッシュ
+        self.commit_cache()
+
+    def run_strip(self, poller, on_update=None):
+        '''スナップショットを受け取りながらLEDテープの描画を続ける
+
+        取得と描画を分離し，新しいスナップショットはフレームの区切りで切り替える.
+        取得中も描画は止まらない
+
+        Parameters
+        ----------
+        poller : TrainPoller
+            スナップショットの取得元
+        on_update : callable
+            スナップショット切り替え時に呼ぶ関数 (引数: TrainSnapshot)
+
+        Returns
+        -------
+        result : bool
+            取得元が停止した場合はFalse
+        '''
+        steps = self.distance - 1
+
+        # 初回のみ取得を待つ
+        snapshot = poller.wait_snapshot(0)
+        trains = None
+        now = self.frame_scheduler.start()
+
+        while snapshot is not None:
+            # 最新のスナップショットに切り替え
+            if trains is None or poller.latest() is not snapshot:
+                if trains is not None:
+                    # 直前に表示した位置を次回更新時用キャッシュとする
+                    self.commit_cache()
+                    snapshot = poller.latest()
+                    if snapshot is None:
+                        break
+
+                trains = snapshot.get_lines(self.use_lines)
+                # 前回の推定と新しいスナップショットの比較
+                if self.runtimes:
+                    self.__measure_estimate(trains)
+
+                if on_update:
+                    on_update(snapshot)
+
+                start = now
+                duration = snapshot.next_fetch - time.time() if snapshot.next_fetch else 0
+                if duration <= 0:
+                    duration = self.update_freq
+
+            # 設定ファイルの変更を反映 (データが古い路線の表示色を設定する前)
+            if self.__pending is not None:
+                self.__apply_reload()
+
+            # データが古い路線の表示色
+            if self.stale_mode != "none":
+                self.__update_stale(snapshot)
+
+            # 経過時間から駅間の移動位置を決定
+            movingpos = min(int((now - start) / duration * steps), steps - 1)
+            self.render_frame(trains, movingpos, time.time())
+
+            now = self.__wait_frame()
+
+        return False
+
+    def log_update(self, snapshot):
+        '''前回のスナップショットの描画結果と，描画開始時点のデータの経過時間を出力する
+
+        run_strip()のon_updateに指定する
+
+        Parameters
+        ----------
+        snapshot : TrainSnapshot
+            切り替えるスナップショット
+        '''
+        scheduler = self.frame_scheduler
+        Log.info(f"Strip{self.channel}: Frames: {self.frame_count}, Changed pixels: {self.changed_pixels}, "
+                 f"Skipped shows: {self.skipped_shows}, FPS: {scheduler.achieved_rate:.1f}, "
+                 f"Lateness: {scheduler.lateness * 1000:.1f}ms, Jitter: {scheduler.jitter * 1000:.1f}ms, "
+                 f"Dropped: {scheduler.dropped_frames}")
+
+        # 描画時点のデータの経過時間
+        now = time.time()
+        lines = self.use_lines
+        ages = [snapshot.data_age(line, now) for line in lines]
+        if self.__metrics is not None:
+            for i in range(len(lines)):
+                if ages[i] is not None:
+                    self.__metrics.data_age.observe(ages[i], lines[i])
+        Log.debug(f"Strip{self.channel}: Data age: " + ", ".join(
+            f"{lines[i]} {ages[i]:.1f}s" if ages[i] is not None else f"{lines[i]} -" for i in range(len(lines))))
+
+        if self.power is not None:
+            Log.debug(f"Strip{self.channel}: Current: {self.power.current:.0f}mA "
+                      f"(demand {self.power.demand:.0f}mA), Limited frames: {self.power.limited_frames}")
+
+        if self.estimate_error is not None:
+            Log.debug(f"Strip{self.channel}: Estimate error: {self.estimate_error:.1f}s, "
+                      f"Bias: {self.estimate_bias:+.1f}s, Trains: {self.estimate_samples}")
+
+    def render_frame(self, trains, movingpos, now=None):
+        '''1フレームを描画
+
+        Parameters
+        ----------
+        trains : list of list(ODPT.get_train())
+            路線ごとの列車位置情報をまとめたリスト
+        movingpos : int
+            駅間移動に使用する
+            0 ~ LEDCtrl.distance-2までの値
+        now : float
+            列車位置の推定に使用する現在時刻 (time.time()).
+            Noneの場合は推定せず，全列車をmovingposで移動する
+        '''
+        # 設定ファイルの変更をフレームの区切りで反映
+        if self.__pending is not None:
+            self.__apply_reload()
+
+        start = time.perf_counter()
+
+        if self.batch:
+            self.__render_batch(trains, movingpos, now)
+        else:
+            # 背景色・駅の色から次のフレームを作成
+            self.__frame = self.__base_frame[:]
+
+            caches = []
             for j in range(len(self.use_lines)):
-                self.__set_background(self.use_lines[j])
-                self.__set_stationpos(self.use_lines[j])
-                time.sleep(0.1)
-                self.__strip.show()
-                cache = self.__set_trainpos( 
-                    self.use_lines[j], trains[j], self.lines[self.use_lines[j]]["cache"], i)
-                # 最終ループ
-                if i == self.distance - 2:
-                    self.lines[self.use_lines[j]]["cache"] = cache
-
-                self.__strip.show()
-            time.sleep(self.update_freq/(self.distance-1) - 0.1)
-    
-    def wipe_strip(self, line):
-        '''LEDテープのWipeアニメーション
+                caches.append(self.__set_trainpos(
+                    self.use_lines[j], trains[j], self.lines[self.use_lines[j]]["cache"], movingpos,
+                    self.__palette[j], now))
+            self.__last_caches = caches
+
+            # 変化したLEDのみ書き込み，1フレームにつき1回show()
+            self.__flush_frame()
+
+        if self.__metrics is not None:
+            self.__metrics.render_time.observe(
+                time.perf_counter() - start - self.__show_elapsed, self.channel)
+
+    def commit_cache(self):
+        '''直前に描画したフレームの列車位置を次回更新時用キャッシュとして確定
+        '''
+        if self.batch:
+            if self.__batch is None:
+                return
+            caches = self.__batch_caches()
+            # キャッシュが変わるため，次のフレームで配列を作り直す
+            self.__batch = None
+        else:
+            caches = self.__last_caches
+            if caches is None:
+                return
+            self.__last_caches = None
+
+        for j in range(len(self.use_lines)):
+            self.lines[self.use_lines[j]]["cache"] = caches[j]
+
+    def wipe_strip(self, line, duration=None):
+        '''LEDテープのWipeアニメーション (1路線のみ)
+
+        複数の路線を並行して行う場合はanimation.WipeAnimationを使用する
 
         Parameters
         ----------
         line : str
             アニメーションを行う路線記号
+        duration : float
+            アニメーションの所要時間[s]. Noneの場合は1ドットにつき0.01秒
+        '''
+        pixels = self.wipe_pixels(line)
+        if duration is None:
+            duration = len(pixels) * 0.01
+
+        # 1フレームにつき1回show()
+        scheduler = FrameScheduler(self.frame_scheduler.frame_rate)
+        start = scheduler.start()
+        now = start
+        done = 0
+        while done < len(pixels):
+            count = min(int((now - start) / duration * len(pixels)) + 1, len(pixels)) if duration > 0 else len(pixels)
+            self.show_pixels(pixels[done:count])
+            done = count
+            if done < len(pixels):
+                now = scheduler.wait()
+
+    def wipe_pixels(self, line):
+        '''Wipeアニメーションで点灯する順の(LEDの番号, 色)のリスト
+
+        Parameters
+        ----------
+        line : str
+            アニメーションを行う路線記号
+
+        Returns
+        -------
+        pixels : list of tuple
+            (LEDテープ全体でのLEDの番号, Color())のリスト
         '''
         if self.lines[line]["reverse"]:
             range_list = range((len(self.stations[line]) - 1) * self.distance, -1, -1)
         else:
             range_list = range((len(self.stations[line]) - 1) * self.distance + 1)
 
-        for i in range_list:
-            self.__strip.setPixelColor(
-                i+self.lines[line]["offset"],
-                Color(*list(map(lambda x: int(x * 0.5), self.lines[line]["traincolor"]))))
-            if i % self.distance == 0:
-                self.__strip.setPixelColor(
-                    i+self.lines[line]["offset"], Color(*self.sta_color))
-            self.__strip.show()
-            time.sleep(0.01)
+        offset = self.lines[line]["offset"]
+        wipe = self.colors[line]["wipe"]
+        return [(i + offset, self.__sta_color if i % self.distance == 0 else wipe) for i in range_list]
+
+    def show_pixels(self, pixels):
+        '''指定したLEDのみ書き込み，表示する (アニメーション用)
+
+        Parameters
+        ----------
+        pixels : list of tuple
+            (LEDの番号, Color())のリスト. 空の場合はshow()を省略
+        '''
+        if not pixels:
+            return
+
+        power = self.power
+        for i, color in pixels:
+            self.__strip.setPixelColor(i, color)
+            if power is not None:
+                power.set(i, color)
+        self.__update_brightness()
+        self.__strip.show()
+
+        # LEDテープの状態がフレームと異なるため，次回は全LEDを書き込む
+        self.__prev_frame = None
 
     def clear_strip(self):
         '''LEDテープを消灯
@@ -136,34 +665,280 @@ class LEDCtrl():
 
         for i in range(self.__strip.numPixels()):
             self.__strip.setPixelColor(i, Color(0, 0, 0))
+        if self.power is not None:
+            self.power.reset()
         self.__strip.show()
 
-    def __set_background(self, line):
-        '''路線の暗色をLEDに設定
+        # LEDテープの状態がフレームと異なるため，次回は全LEDを書き込む
+        self.__prev_frame = None
 
-        Parameters
-        ----------
-        line : str
-            路線のlineCode
+    def __flush_frame(self):
+        '''前回のフレームから変化したLEDのみLEDテープに書き込み，表示する
         '''
+        frame = self.__frame
+        prev = self.__prev_frame
+        power = self.power
+        self.frame_count += 1
 
-        for i in range((len(self.stations[line]) - 1) * self.distance):
-            self.__strip.setPixelColor(
-                i+self.lines[line]["offset"], Color(*self.lines[line]["groundcolor"]))
+        # 初回は全LEDを書き込む
+        if prev is None:
+            self.__strip[:] = frame
+            changed = len(frame)
+            if power is not None:
+                power.reset(frame)
+        elif self.batch:
+            indices = np.flatnonzero(frame != prev)
+            self.__strip.set_pixels(indices, frame[indices])
+            changed = len(indices)
+            if power is not None and changed:
+                power.update(indices, frame[indices])
+        else:
+            changed = 0
+            for i in range(len(frame)):
+                if frame[i] != prev[i]:
+                    self.__strip.setPixelColor(i, frame[i])
+                    if power is not None:
+                        power.set(i, frame[i])
+                    changed += 1
 
-    def __set_stationpos(self, line):
-        '''路線の駅位置をLEDに設定
+        self.changed_pixels = changed
+        self.__prev_frame = frame
 
-        Parameters
-        ----------
-        line : str
-            路線のlineCode
+        # 変化がない場合はshow()を省略
+        if changed == 0:
+            self.skipped_shows += 1
+            self.__show_elapsed = 0.0
+            return
+
+        self.__update_brightness()
+        start = time.perf_counter()
+        self.__strip.show()
+        self.__show_elapsed = time.perf_counter() - start
+        if self.__metrics is not None:
+            self.__metrics.show_time.observe(self.__show_elapsed, self.channel)
+
+    def __update_brightness(self):
+        '''show()の前に，推定した消費電流が上限を超えないよう明るさを設定する
         '''
-        for i in range(len(self.stations[line])):
-            self.__strip.setPixelColor(
-                i*self.distance+self.lines[line]["offset"], Color(*self.sta_color))
+        power = self.power
+        if power is None:
+            brightness = self.brightness
+        else:
+            limited = power.limited
+            brightness = power.limit(self.brightness)
+            # 制限の開始時のみ出力
+            if power.limited and not limited:
+                Log.warn(f"Strip{self.channel}: Estimated current {power.demand:.0f}mA exceeds "
+                         f"{power.max_current}mA. Limit brightness to {brightness}.", key=f"power-{self.channel}")
+            if self.__metrics is not None:
+                self.__metrics.led_current.set(round(power.current, 1), self.channel)
+
+        if brightness != self.__strip.brightness:
+            self.__strip.setBrightness(brightness)
 
-    def __set_trainpos(self, line, trains, cache, movingpos):
+    def __wait_frame(self):
+        '''次のフレームまで待機し，遅延を記録する
+        '''
+        now = self.frame_scheduler.wait()
+        if self.__metrics is not None:
+            self.__metrics.frame_lateness.observe(self.frame_scheduler.lateness, self.channel)
+            self.__metrics.frame_jitter.observe(self.frame_scheduler.interval_error, self.channel)
+
+        return now
+
+    def __prepare_batch(self, trains, now):
+        '''スナップショットの列車位置を配列に変換 (取得ごとに1回)
+
+        列車ごとに，キャッシュの判定を行った上でmovingposごとの点灯位置を配列にまとめる.
+        所要時間から位置を推定する列車は，区間に入った時刻と所要時間を配列にまとめる
+        '''
+        pixels = []
+        lednums = []
+        line_index = []
+        keys = []
+        steps = self.distance - 1
+        estimated = []
+        entered_at = []
+        runtimes = []
+
+        for j in range(len(self.use_lines)):
+            line = self.use_lines[j]
+            table = self.layout[line]
+            cache = self.lines[line]["cache"]
+            offset = self.lines[line]["offset"]
+            line_runtimes = self.runtimes.get(line) if now is not None else None
+            line_keys = []
+
+            for train in trains[j]:
+                from_sta = train["odpt:fromStation"]
+                to_sta = train["odpt:toStation"]
+
+                segment = table.get((from_sta, to_sta))
+                if segment is None:
+                    segment = self.__add_segment(line, from_sta, to_sta)
+
+                prev = cache.get(train["odpt:trainNumber"]) if to_sta is not None else None
+                same = prev is not None and prev["odpt:fromStation"] == from_sta and prev["odpt:toStation"] == to_sta
+                runtime = line_runtimes.get((from_sta, to_sta)) if line_runtimes and to_sta is not None else None
+                entered = None
+
+                # 所要時間から位置を推定する列車
+                if runtime is not None:
+                    entered = self.__entered_at(train, prev, same, now)
+                    estimated.append(len(line_index))
+                    entered_at.append(entered[0])
+                    runtimes.append(runtime)
+
+                # 駅間情報がキャッシュと新しい情報で一致する場合は据え置く
+                if same and entered is None:
+                    lednum = prev["nowled"]
+                    pixels.append([(lednum + offset, lednum + segment.hold_direction + offset)] * steps)
+                    lednums.append([lednum] * steps)
+                else:
+                    # 駅停車時は1点のため同じLEDを2回指定
+                    pixels.append([p if len(p) == 2 else (p[0], p[0]) for p in segment.pixels])
+                    lednums.append(segment.lednums)
+
+                line_index.append(j)
+                line_keys.append((train["odpt:trainNumber"], from_sta, to_sta, entered))
+
+            keys.append(line_keys)
+
+        self.__batch = {
+            "trains": trains,
+            "now": now is not None,
+            "pixels": np.array(pixels, dtype=np.intp).reshape(-1, steps, 2),
+            "lednums": np.array(lednums, dtype=np.intp).reshape(-1, steps),
+            "line_index": np.repeat(np.array(line_index, dtype=np.intp), 2),
+            "palette": None,
+            "keys": keys,
+            "movingpos": 0,
+            "rows": np.arange(len(line_index), dtype=np.intp),
+            "estimated": np.array(estimated, dtype=np.intp) if estimated else None,
+            "entered_at": np.array(entered_at, dtype=np.float64),
+            "runtimes": np.array(runtimes, dtype=np.float64),
+        }
+
+    def __render_batch(self, trains, movingpos, now):
+        '''配列演算による1フレームの描画
+        '''
+        if self.__batch is None or self.__batch["trains"] is not trains or self.__batch["now"] != (now is not None):
+            self.__prepare_batch(trains, now)
+        batch = self.__batch
+
+        # 所要時間から推定する列車は，区間に入ってからの経過時間で列車ごとに位置を決定
+        if batch["estimated"] is None:
+            batch["movingpos"] = movingpos
+            pixels = batch["pixels"][:, movingpos, :].ravel()
+        else:
+            steps = self.distance - 1
+            pos = np.full(len(batch["rows"]), movingpos, dtype=np.intp)
+            progress = (now - batch["entered_at"]) / batch["runtimes"] * steps
+            pos[batch["estimated"]] = np.clip(progress, 0, steps - 1).astype(np.intp)
+            batch["movingpos"] = pos
+            pixels = batch["pixels"][batch["rows"], pos, :].ravel()
+
+        # 路線ごとの色が変わった場合のみ，列車ごとの色を作り直す
+        if batch["palette"] is not self.__palette_array:
+            palette = self.__palette_array
+            batch["palette"] = palette
+            batch["colors"] = palette[batch["line_index"]]
+            # 表示しない路線(点滅の消灯中)の列車を除く
+            batch["visible"] = None if all(c is not None for c in self.__palette) else \
+                np.array([c is not None for c in self.__palette])[batch["line_index"]]
+
+        # 背景色・駅の色をコピーし，全列車の点灯位置に一括で色を設定
+        self.__frame = self.__base_frame.copy()
+        if batch["visible"] is None:
+            self.__frame[pixels] = batch["colors"]
+        else:
+            self.__frame[pixels[batch["visible"]]] = batch["colors"][batch["visible"]]
+
+        self.__flush_frame()
+
+    def __batch_caches(self):
+        '''一括描画の直前のフレームから路線ごとのキャッシュを作成
+        '''
+        batch = self.__batch
+        if isinstance(batch["movingpos"], int):
+            nowled = batch["lednums"][:, batch["movingpos"]].tolist()
+        else:
+            nowled = batch["lednums"][batch["rows"], batch["movingpos"]].tolist()
+
+        caches = []
+        i = 0
+        for line_keys in batch["keys"]:
+            cache = {}
+            for number, from_sta, to_sta, entered in line_keys:
+                cache[number] = {"odpt:fromStation": from_sta, "odpt:toStation": to_sta, "nowled": nowled[i]}
+                if entered is not None:
+                    cache[number]["entered_at"], cache[number]["entry_seen"] = entered
+                i += 1
+            caches.append(cache)
+
+        return caches
+
+    def __compile_base_frame(self, stations, distance, offsets, num_pixels, colors, sta_color):
+        '''全路線の背景色・駅の色を設定したフレームを作成
+
+        Returns
+        -------
+        frame : list of int
+            LEDごとの色 (Color())
+        '''
+        frame = [Color(0, 0, 0)] * num_pixels
+
+        for line in self.use_lines:
+            offset = offsets[line]
+            length = (len(stations[line]) - 1) * distance
+
+            # 路線の暗色
+            frame[offset:offset + length] = [colors[line]["ground"]] * length
+
+            # 駅位置
+            for i in range(len(stations[line])):
+                frame[i*distance + offset] = sta_color
+
+        return frame
+
+    def __update_stale(self, snapshot):
+        '''最後に取得できてからの経過時間から，データが古い路線の列車の色を決定
+        '''
+        now = time.time()
+        # 点滅時は1秒ごとに消灯
+        blink_off = self.stale_mode == "blink" and int(now) % 2 == 1
+
+        palette = []
+        stale_lines = set()
+        for line in self.use_lines:
+            age = snapshot.update_age(line, now)
+            if age is None or age <= self.stale_threshold:
+                palette.append(self.colors[line]["train"])
+                continue
+
+            stale_lines.add(line)
+            if line not in self.stale_lines:
+                Log.warn(f"Strip{self.channel}: Line {line}: Data is stale ({age:.0f}s since last update).")
+            if self.stale_mode == "dim":
+                palette.append(self.colors[line]["stale"])
+            else:
+                palette.append(None if blink_off else self.colors[line]["train"])
+
+        for line in self.stale_lines - stale_lines:
+            Log.info(f"Strip{self.channel}: Line {line}: Data is up to date.")
+        self.stale_lines = stale_lines
+
+        if palette != self.__palette:
+            self.__set_palette(palette)
+
+    def __set_palette(self, palette):
+        '''路線ごとの列車の色を設定
+        '''
+        self.__palette = palette
+        if self.batch:
+            self.__palette_array = np.array([0 if c is None else c for c in palette], dtype=np.uint32)
+
+    def __set_trainpos(self, line, trains, cache, movingpos, color, now=None):
         '''
         Parameters
         ----------
@@ -177,6 +952,10 @@ class LEDCtrl():
         movingpos : int
             駅間移動に使用する
             0 ~ LEDCtrl.distanceまでインクリメントした値
+        color : int
+            列車の色 (Color()). Noneの場合は列車を表示せず，キャッシュのみ作成
+        now : float
+            列車位置の推定に使用する現在時刻 (time.time()). Noneの場合は推定しない
 
         Returns
         -------
@@ -186,163 +965,136 @@ class LEDCtrl():
 
         cache_new = {}    # 次回更新時用キャッシュ
 
-        for i in range(len(trains)):
-            # 駅停車時
-            if trains[i]["odpt:toStation"] == None:
-                from_sta_index = self.stations[line][trains[i]
-                                                     ["odpt:fromStation"]]
-                lednum = from_sta_index*self.distance
-                self.__strip.setPixelColor(
-                    lednum + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
+        table = self.layout[line]
+        offset = self.lines[line]["offset"]
+        frame = self.__frame
+        runtimes = self.runtimes.get(line) if now is not None else None
+        steps = self.distance - 1
+
+        for train in trains:
+            from_sta = train["odpt:fromStation"]
+            to_sta = train["odpt:toStation"]
+
+            # 区間の点灯経路
+            segment = table.get((from_sta, to_sta))
+            if segment is None:
+                segment = self.__add_segment(line, from_sta, to_sta)
+
+            prev = cache.get(train["odpt:trainNumber"]) if to_sta is not None else None
+            same = prev is not None and prev["odpt:fromStation"] == from_sta and prev["odpt:toStation"] == to_sta
+            runtime = runtimes.get((from_sta, to_sta)) if runtimes and to_sta is not None else None
+            entered = None
+
+            # 駅間(所要時間が既知)
+            # 区間に入ってからの経過時間と所要時間から位置を推定
+            if runtime is not None:
+                entered = self.__entered_at(train, prev, same, now)
+                pos = min(max(int((now - entered[0]) / runtime * steps), 0), steps - 1)
+                lednum = segment.lednums[pos]
+                if color is not None:
+                    for n in segment.pixels[pos]:
+                        frame[n] = color
 
             # 駅間(キャッシュに列車番号存在)
-            # キャッシュから列車番号を検索
-            elif trains[i]["odpt:trainNumber"] in cache:
-                # 駅間情報がキャッシュと新しい情報で一致 (更新前と更新後で列車位置が同じ)
-                if cache[trains[i]["odpt:trainNumber"]]["odpt:fromStation"] == trains[i]["odpt:fromStation"] \
-                    and cache[trains[i]["odpt:trainNumber"]]["odpt:toStation"] == trains[i]["odpt:toStation"]:
-
-                    from_sta_index = self.stations[line][trains[i]
-                                                         ["odpt:fromStation"]]
-                    to_sta_index = self.stations[line][trains[i]
-                                                       ["odpt:toStation"]]
-
-                    # キャッシュからLED点灯位置取得
-                    lednum = cache[trains[i]["odpt:trainNumber"]]["nowled"]
-
-                    # LED点灯位置を据え置く
-                    # 大江戸線 新宿西口 -> 都庁前
-                    if line == "E" \
-                        and trains[i]["odpt:fromStation"] == "odpt.Station:Toei.Oedo.ShinjukuNishiguchi" \
-                        and trains[i]["odpt:toStation"] == "odpt.Station:Toei.Oedo.Tochomae":
-                        self.__set_strip_betw_sta(line, lednum, 1)
-                    # ナンバリング正方向
-                    elif from_sta_index < to_sta_index:
-                        self.__set_strip_betw_sta(line, lednum, 1)
-                    # ナンバリング負方向
-                    else:
-                        self.__set_strip_betw_sta(line, lednum, -1)
-
-                # 駅間列車位置更新時
-                else:
-                    lednum = self.__update_betw_sta_trainpos(line, trains, i, movingpos)
+            # 駅間情報がキャッシュと新しい情報で一致 (更新前と更新後で列車位置が同じ)
+            elif same:
+                # キャッシュからLED点灯位置取得し，据え置く
+                lednum = prev["nowled"]
+                if color is not None:
+                    frame[lednum + offset] = color
+                    frame[lednum + segment.hold_direction + offset] = color
 
-            # 駅間
+            # 駅停車時, 駅間列車位置更新時
             else:
-                lednum = self.__update_betw_sta_trainpos(line, trains, i, movingpos)
+                lednum = segment.lednums[movingpos]
+                if color is not None:
+                    for n in segment.pixels[movingpos]:
+                        frame[n] = color
 
             # キャッシュ生成
-            self.__set_traincache(cache_new, trains[i], lednum)
+            self.__set_traincache(cache_new, train, lednum, entered)
 
         return cache_new
-    
-    def __update_betw_sta_trainpos(self, line, trains, i, movingpos):
-        # 丸ノ内線支線入線時 (中野坂上 -> 中野新橋)
-        if line == "M" \
-            and trains[i]["odpt:fromStation"] == "odpt.Station:TokyoMetro.Marunouchi.NakanoSakaue" \
-            and trains[i]["odpt:toStation"] == "odpt.Station:TokyoMetro.MarunouchiBranch.NakanoShimbashi":
-                    
-            lednum = self.__set_maruouchi_betw_sta(line, trains, i, movingpos)
-
-        # 大江戸線特定区間 (新宿西口 -> 都庁前)
-        elif line == "E" \
-            and trains[i]["odpt:fromStation"] == "odpt.Station:Toei.Oedo.ShinjukuNishiguchi" \
-            and trains[i]["odpt:toStation"] == "odpt.Station:Toei.Oedo.Tochomae":
-
-            from_sta_index = self.stations[line][trains[i]["odpt:fromStation"]]
-            lednum = from_sta_index * self.distance + movingpos
-            self.__set_strip_betw_sta(line, lednum, 1)
-                
-        # 大江戸線特定区間 (都庁前 -> 新宿西口)
-        elif line == "E" \
-            and trains[i]["odpt:fromStation"] == "odpt.Station:Toei.Oedo.Tochomae" \
-            and trains[i]["odpt:toStation"] == "odpt.Station:Toei.Oedo.ShinjukuNishiguchi":
-
-            lednum = self.__set_oedo_betw_sta(line, trains, i, movingpos)
-
-        else:
-            lednum = self.__set_normal_betw_sta(line, trains, i, movingpos)
-
-        return lednum
 
-    def __set_strip_betw_sta(self, line, lednum, direction):
-        '''LEDテープに駅間の列車を描画
-        '''
+    def __entered_at(self, train, prev, same, now):
+        '''列車が現在の区間に入った時刻を決定する
 
-        self.__strip.setPixelColor(
-            lednum + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
-        self.__strip.setPixelColor(
-            lednum + direction + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
+        前回と同じ区間の場合はキャッシュの時刻，新しい区間の場合は最初に観測したdc:date
 
-    def __set_normal_betw_sta(self, line, trains, i, movingpos):
-        '''通常時の駅間の列車の位置設定
+        Returns
+        -------
+        entered : tuple of (float, bool)
+            区間に入った時刻 (time.time()), 区間に入ったことを観測したか
+            (表示開始時・初めて観測した列車はFalse)
         '''
+        if same and prev.get("entered_at") is not None:
+            return prev["entered_at"], prev["entry_seen"]
 
-        from_sta_index = self.stations[line][trains[i]["odpt:fromStation"]]
-        to_sta_index = self.stations[line][trains[i]["odpt:toStation"]]
+        entered = parse_date(train.get("dc:date"))
+        if entered is None or entered > now:
+            entered = now
 
-        # ナンバリング正方向
-        if from_sta_index < to_sta_index:
-            lednum = from_sta_index*self.distance + movingpos
-            self.__set_strip_betw_sta(line, lednum, 1)
+        return entered, prev is not None
 
-        # ナンバリング負方向
-        else:
-            lednum = from_sta_index*self.distance - movingpos
-            self.__set_strip_betw_sta(line, lednum, -1)
+    def __measure_estimate(self, trains):
+        '''前回のスナップショットで推定した到着時刻と，新しいスナップショットを比較する
 
-        return lednum
+        前回の区間の到着駅から先に進んだ列車について，推定した到着時刻(区間に入った時刻 + 所要時間)と
+        新しい状態を最初に観測したdc:dateの差を誤差とする.
+        区間に入ったことを観測していない列車(表示開始時)は除く
 
-    def __set_maruouchi_betw_sta(self, line, trains, i, movingpos):
-        '''丸ノ内線特定区間の列車の位置設定
+        Parameters
+        ----------
+        trains : list of list(ODPT.get_train())
+            新しいスナップショットの路線ごとの列車位置情報
         '''
+        errors = []
+        for j in range(len(self.use_lines)):
+            line = self.use_lines[j]
+            runtimes = self.runtimes.get(line)
+            if not runtimes:
+                continue
 
-        # 中野坂上 -> 中野新橋のみ
-        from_sta_index = self.stations[line][trains[i]["odpt:fromStation"]]
-        to_sta_index = self.stations[line][trains[i]["odpt:toStation"]]
+            cache = self.lines[line]["cache"]
+            for train in trains[j]:
+                prev = cache.get(train["odpt:trainNumber"])
+                if prev is None or not prev.get("entry_seen") or train["odpt:fromStation"] != prev["odpt:toStation"]:
+                    continue
+                arrived = parse_date(train.get("dc:date"))
+                if arrived is None:
+                    continue
 
-        # 出発直後: 中野坂上駅のledと支線の最初のLEDを点灯
-        if movingpos == 0:
-            lednum = from_sta_index*self.distance
-            self.__strip.setPixelColor(
-                lednum + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
-            self.__strip.setPixelColor(
-                to_sta_index*self.distance - self.distance + 1 + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
+                runtime = runtimes.get((prev["odpt:fromStation"], prev["odpt:toStation"]))
+                if runtime is None:
+                    continue
 
-        # それ以降
-        else:
-            lednum = to_sta_index*self.distance - self.distance + movingpos
-            self.__set_strip_betw_sta(line, lednum, 1)
+                error = prev["entered_at"] + runtime - arrived
+                errors.append(error)
+                if self.__metrics is not None:
+                    self.__metrics.estimate_error.observe(abs(error), line)
 
-        return lednum
+        self.estimate_samples = len(errors)
+        if errors:
+            self.estimate_error = sum(abs(e) for e in errors) / len(errors)
+            self.estimate_bias = sum(errors) / len(errors)
+        else:
+            self.estimate_error = self.estimate_bias = None
 
-    def __set_oedo_betw_sta(self, line, trains, i, movingpos):
-        '''大江戸線特定区間の列車の位置設定
+    def __add_segment(self, line, from_sta, to_sta):
+        '''対応表にない区間(隣接しない駅間)の点灯経路を作成し，対応表に追加
         '''
+        segment = compile_segment(
+            self.stations[line], self.distance, self.lines[line]["offset"], from_sta, to_sta)
+        self.layout[line][(from_sta, to_sta)] = segment
 
-        # 都庁前 -> 新宿西口
-        from_sta_index = self.stations[line][trains[i]["odpt:fromStation"]]
-        to_sta_index = self.stations[line][trains[i]["odpt:toStation"]]
-
-        # 出発直後: 都庁前駅のledと都庁前-新宿西口間の最初のLEDを点灯
-        if movingpos == 0:
-            lednum = from_sta_index*self.distance
-            self.__strip.setPixelColor(
-                lednum + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
-            self.__strip.setPixelColor(
-                to_sta_index*self.distance + self.distance - 1 + self.lines[line]["offset"], Color(*self.lines[line]["traincolor"]))
-
-        # それ以降
-        else:
-            lednum = to_sta_index*self.distance + self.distance - movingpos
-            self.__set_strip_betw_sta(line, lednum, -1)
-
-        return lednum
+        return segment
 
-    def __set_traincache(self, cache, train, lednum):
+    def __set_traincache(self, cache, train, lednum, entered=None):
         '''列車ごとのキャッシュを設定
         '''
 
         train_data = {
             "odpt:fromStation": train["odpt:fromStation"], "odpt:toStation": train["odpt:toStation"], "nowled": lednum}
+        if entered is not None:
+            train_data["entered_at"], train_data["entry_seen"] = entered
         cache.update([(train["odpt:trainNumber"], train_data)])
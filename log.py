@@ -1,18 +1,289 @@
+import atexit
 import datetime
+import json
+import queue
+import re
+import sys
+import threading
+import time
+
+
+# ログのレベル
+DEBUG = 10
+INFO = 20
+WARN = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARN: "warn", ERROR: "error"}
+
+# レベルごとの接頭辞 (時刻 + 色付きのレベル)
+PREFIX = {
+    DEBUG: ' \033[90m[Debug]\033[0m ',
+    INFO: ' \033[36m[Info]\033[0m ',
+    WARN: ' \033[33m[Warn]\033[0m ',
+    ERROR: ' \033[31m[Error]\033[0m ',
+}
+
+# URL・パスのクエリ文字列 (acl:consumerKeyなどのアクセストークンを含む)
+URL_QUERY = re.compile(r"((?:https?://|/)[^\s?'\"]*)\?[^\s'\"()]*")
+# クエリ文字列以外に含まれるアクセストークン
+CONSUMER_KEY = re.compile(r"(consumerKey=)[^\s&'\"()]+")
+
+
+def redact(text):
+    '''URLのクエリ文字列・アクセストークンを除く (アクセストークンをログに出力しない)
+    '''
+    return CONSUMER_KEY.sub(r"\1***", URL_QUERY.sub(r"\1", text))
+
+
+def describe_error(e):
+    '''例外をログ用の文字列に変換する
+
+    HTTPのエラーは例外名とステータスコードのみ, その他はURLのクエリ文字列を除いたメッセージ
+    '''
+    status = getattr(getattr(e, "response", None), "status_code", None)
+    if status is not None:
+        return f"{type(e).__name__}: HTTP {status}"
+    return f"{type(e).__name__}: {redact(str(e))}"
+
+
+class LogWriter():
+    '''ログの非同期書き込み
+
+    呼び出し側はキューに追加するのみで，時刻の整形・重複の抑制・出力は書き込みスレッドで行う.
+    キューが一杯の場合は破棄するため，描画スレッドが端末・journalの出力で待つことはない
+
+    Parameters
+    ----------
+    level : int
+        出力する最低のレベル (DEBUG, INFO, WARN, ERROR)
+    fmt : str
+        出力形式 ("text": 色付きの1行, "json": JSON lines)
+    stream : file object
+        出力先. Noneの場合は標準出力
+    dedup_interval : float
+        同じメッセージ(key)を再度出力するまでの間隔[s]. 間に抑制した回数を付記する
+    rate : float
+        1秒あたりの最大出力行数. 超えた分は破棄し，破棄した行数を後で出力する
+    maxsize : int
+        キューの最大長
+
+    Attributes
+    ----------
+    dropped : int
+        キューが一杯のため破棄した件数
+    suppressed : int
+        重複・出力数の制限により出力しなかった件数
+    '''
+
+    def __init__(self, level=INFO, fmt="text", stream=None, dedup_interval=60, rate=20, maxsize=1000):
+        self.level = level
+        self.fmt = fmt
+        self.stream = stream
+        self.dedup_interval = dedup_interval
+        self.rate = rate
+
+        self.dropped = 0
+        self.suppressed = 0
+
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__thread = None
+        self.__start_lock = threading.Lock()
+
+        # key -> [最後に出力した時刻, 抑制した回数]
+        self.__last = {}
+        # 出力数の制限 (トークンバケット)
+        self.__tokens = rate
+        self.__refilled = time.monotonic()
+        self.__rate_dropped = 0
+
+    def put(self, level, msg, key=None, fields=None):
+        '''ログを1件キューに追加する (待機しない)
+
+        Parameters
+        ----------
+        level : int
+            ログのレベル
+        msg : str
+            メッセージ
+        key : str
+            重複判定に使用するキー. Noneの場合は重複を抑制しない
+        fields : dict
+            JSON lines形式で出力する追加の項目
+        '''
+        if level < self.level:
+            return
+        if self.__thread is None:
+            self.__start()
+
+        try:
+            self.__queue.put_nowait((time.time(), level, msg, key, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=1.0):
+        '''キューに残ったログを出力し終えるまで待つ
+        '''
+        if self.__thread is None:
+            return
+        # 時刻の代わりにNone, fieldsの代わりに完了通知のEventを送る
+        done = threading.Event()
+        try:
+            self.__queue.put((None, None, None, None, done), timeout=timeout)
+        except queue.Full:
+            return
+        done.wait(timeout)
+
+    def __start(self):
+        with self.__start_lock:
+            if self.__thread is not None:
+                return
+            th = threading.Thread(target=self.__write_thread)
+            th.setDaemon(True)
+            th.start()
+            self.__thread = th
+            atexit.register(self.flush)
+
+    def __write_thread(self):
+        while True:
+            t, level, msg, key, fields = self.__queue.get()
+
+            # flush()の区切り
+            if t is None:
+                self.__stream().flush()
+                fields.set()
+                continue
+
+            if key is not None and self.__duplicated(t, key):
+                self.suppressed += 1
+                continue
+
+            if level < ERROR and not self.__take_token():
+                self.suppressed += 1
+                self.__rate_dropped += 1
+                continue
+
+            if self.__rate_dropped and self.__tokens >= 1:
+                dropped, self.__rate_dropped = self.__rate_dropped, 0
+                self.__write(t, WARN, f"Log: Suppressed {dropped} messages (over {self.rate}/s).", None)
+
+            repeated = self.__last[key][1] if key is not None else 0
+            if repeated:
+                msg = f"{msg} (repeated {repeated} times)"
+                self.__last[key][1] = 0
+
+            self.__write(t, level, msg, fields)
+
+    def __duplicated(self, t, key):
+        '''dedup_interval以内に同じkeyを出力した場合はTrue
+        '''
+        last = self.__last.get(key)
+        if last is not None and t - last[0] < self.dedup_interval:
+            last[1] += 1
+            return True
+        if last is None:
+            self.__last[key] = [t, 0]
+        else:
+            last[0] = t
+        return False
+
+    def __take_token(self):
+        now = time.monotonic()
+        self.__tokens = min(self.__tokens + (now - self.__refilled) * self.rate, self.rate)
+        self.__refilled = now
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+    def __write(self, t, level, msg, fields):
+        if self.fmt == "json":
+            record = {"time": datetime.datetime.fromtimestamp(t).isoformat(),
+                      "level": LEVEL_NAMES[level], "msg": msg}
+            if fields:
+                record.update(fields)
+            line = json.dumps(record, ensure_ascii=False, default=str)
+        else:
+            line = datetime.datetime.fromtimestamp(t).isoformat() + PREFIX[level] + msg
+            if fields and "traceback" in fields:
+                line += "\n" + fields["traceback"].rstrip("\n")
+
+        # 例外のメッセージ・tracebackに含まれるアクセストークンを除く
+        line = redact(line)
+
+        stream = self.__stream()
+        try:
+            stream.write(line + "\n")
+            if self.__queue.empty():
+                stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def __stream(self):
+        return self.stream if self.stream is not None else sys.stdout
+
 
 class Log():
+    '''ログ出力
+
+    Log.info()等はLogWriterのキューに追加するのみで，出力は書き込みスレッドで行う.
+    keyを指定したメッセージは，dedup_intervalの間は重複を抑制する
+    '''
+
+    writer = LogWriter()
+
+    @staticmethod
+    def configure(level="info", fmt="text", **options):
+        '''ログの出力方法を設定する
+
+        Parameters
+        ----------
+        level : str
+            出力する最低のレベル ("debug", "info", "warn", "error")
+        fmt : str
+            出力形式 ("text", "json")
+        options : dict
+            LogWriterのオプション (dedup_interval, rate, stream)
+        '''
+        levels = {v: k for k, v in LEVEL_NAMES.items()}
+        Log.writer.flush()
+        Log.writer = LogWriter(levels[level], fmt, **options)
+
+    @staticmethod
+    def debug(msg, key=None, **fields):
+        Log.writer.put(DEBUG, msg, key, fields)
+
+    @staticmethod
+    def info(msg, key=None, **fields):
+        Log.writer.put(INFO, msg, key, fields)
+
+    @staticmethod
+    def warn(msg, key=None, **fields):
+        Log.writer.put(WARN, msg, key, fields)
+
+    @staticmethod
+    def error(msg, key=None, **fields):
+        Log.writer.put(ERROR, msg, key, fields)
+
+    @staticmethod
+    def flush():
+        '''キューに残ったログを出力する (終了前に呼ぶ)
+        '''
+        Log.writer.flush()
+
+    # 同期出力用の接頭辞 (bench.py等のコマンドラインツール)
     @staticmethod
     def get_date():
         return datetime.datetime.now().isoformat()
 
     @staticmethod
     def INFO():
-        return Log.get_date() + ' \033[36m[Info]\033[0m '
+        return Log.get_date() + PREFIX[INFO]
 
     @staticmethod
     def WARN():
-        return Log.get_date() + ' \033[33m[Warn]\033[0m '
+        return Log.get_date() + PREFIX[WARN]
 
     @staticmethod
     def ERROR():
-        return Log.get_date() + ' \033[31m[Error]\033[0m '
+        return Log.get_date() + PREFIX[ERROR]
@@ -2,13 +2,21 @@ import argparse
 import threading
 import time
 import datetime
-import traceback
 
 from odpt import ODPT
-from ledctrl import LEDCtrl
+from poller import TrainPoller
+from renderproc import RenderProcess, create_leds
+from pubsub import SnapshotPublisher, SnapshotSubscriber
+from watcher import ConfigReloader
+from animation import WipeAnimation
+from capture import CaptureWriter, ReplaySource
+from metrics import Metrics, MetricsServer, StatsWriter
 from log import Log
 
 class Main():
+    # 最大速度(--replay-speed 0)で再生する場合の取得間隔[s] (描画の駅間の所要時間に使用するため0にはしない)
+    REPLAY_MAX_INTERVAL = 0.01
+
     def __init__(self):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument("-ch0", "--ch0-lines", action="store",
@@ -29,40 +37,149 @@ class Main():
                                 help="起動時にLEDアニメーションを行う. 13線全ての路線表示を行う場合，history，routenumを選択可能． \
                                 normal: 接続順に点灯, history: 開業順に点灯, routenum: 路線番号順に点灯",
                                 default="", choices=["normal", "history", "routenum"])
+        self.parser.add_argument("--animation-duration", action="store",
+                                help="起動時のアニメーション全体の所要時間(秒). アニメーション中に初回の取得を行う. Default: 5",
+                                default=5, type=float)
+
+        self.parser.add_argument("-b", "--backend", action="store",
+                                help="LEDテープの出力先. ws281x: rpi_ws281x, sim: シミュレータ(ハードウェア不要). Default: ws281x",
+                                default="ws281x", choices=["ws281x", "sim"])
+        self.parser.add_argument("--sim-dump", action="store",
+                                help="シミュレータのフレームを書き出すファイルのパス. Channelごとに末尾に番号を付加",
+                                default=None, type=str)
+
+        self.parser.add_argument("--capture", action="store",
+                                help="取得したAPIのレスポンスを記録するファイルのパス (例: ./capture.jsonl.gz)",
+                                default=None, type=str)
+        self.parser.add_argument("--replay", action="store",
+                                help="APIの代わりに再生する記録ファイルのパス. アクセストークン, ネットワーク接続は不要",
+                                default=None, type=str)
+        self.parser.add_argument("--replay-speed", action="store",
+                                help="記録の再生速度の倍率. 0: 最大速度. Default: 1",
+                                default=1.0, type=float)
+
+        self.parser.add_argument("--metrics-port", action="store",
+                                help="計測値(Prometheus形式)を公開するポート. 指定した場合のみ http://127.0.0.1:<port>/metrics で公開",
+                                default=None, type=int)
+        self.parser.add_argument("--stats-file", action="store",
+                                help="計測値を定期的に書き出すファイルのパス (例: ./metroled.prom)",
+                                default=None, type=str)
+        self.parser.add_argument("--stats-interval", action="store",
+                                help="計測値を書き出す間隔(秒). Default: 60",
+                                default=60, type=float)
+
+        self.parser.add_argument("--log-level", action="store",
+                                help="出力するログの最低のレベル. Default: info",
+                                default="info", choices=["debug", "info", "warn", "error"])
+        self.parser.add_argument("--log-format", action="store",
+                                help="ログの出力形式. text: 色付きの1行, json: JSON lines. Default: text",
+                                default="text", choices=["text", "json"])
+
+        self.parser.add_argument("--render-process", action="store_true",
+                                help="LEDテープの描画を別プロセスで行う. 取得・デコードによる描画の遅れを防ぐ")
+
+        self.parser.add_argument("--reload-interval", action="store",
+                                help="LEDの設定ファイル・駅番号の定義ファイルの変更を確認する間隔(秒). 0: 確認しない. Default: 2",
+                                default=2, type=float)
+
+        self.parser.add_argument("--publish", action="store",
+                                help="取得したスナップショットを他のノードに配信するアドレス (host:port, unix:/path). \
+                                他のノードから購読する場合は 0.0.0.0:5800 など",
+                                default=None, type=str)
+        self.parser.add_argument("--publish-lines", action="store",
+                                help="配信のために取得する路線の路線記号 (表示路線に追加). Default: 全路線",
+                                default=["G", "M", "H", "T", "C", "Y", "Z", "N", "F", "A", "I", "S", "E"],
+                                type=str, choices=["G", "M", "H", "T", "C", "Y", "Z", "N", "F", "A", "I", "S", "E"],
+                                nargs='*')
+        self.parser.add_argument("--subscribe", action="store",
+                                help="APIから取得せず，配信元(--publish)からスナップショットを購読するアドレス (host:port, unix:/path)",
+                                default=None, type=str)
+        self.parser.add_argument("--subscriber-name", action="store",
+                                help="配信元のログ・計測値に表示する購読者名. Default: ホスト名",
+                                default=None, type=str)
 
         self.args = self.parser.parse_args()
+        Log.configure(self.args.log_level, self.args.log_format)
         self.anim_param = self.args.animation
         self.cf_path = self.args.led_config
         self.st_path = self.args.station_table
         self.lines = [self.args.ch0_lines, self.args.ch1_lines]
 
-        self.odpt = ODPT()
+        # APIのレスポンスの記録・再生
+        self.capture = CaptureWriter(self.args.capture) if self.args.capture else None
+        replay = ReplaySource(self.args.replay, self.args.replay_speed) if self.args.replay else None
+
+        # 各段階の所要時間の計測
+        self.metrics = Metrics()
+        self.metrics_server = MetricsServer(self.metrics, self.args.metrics_port) \
+            if self.args.metrics_port is not None else None
+        self.stats = StatsWriter(self.metrics, self.args.stats_file, self.args.stats_interval) \
+            if self.args.stats_file else None
+
+        self.odpt = ODPT(capture=self.capture, replay=replay, metrics=self.metrics)
+        if replay:
+            # 再生速度に合わせて取得間隔を短縮 (最大速度の場合は待たずに次の記録を再生)
+            speed = self.args.replay_speed
+            self.odpt.update_freq = max(self.odpt.update_freq / speed, 1) if speed > 0 else self.REPLAY_MAX_INTERVAL
+            Log.info(f"Replay {self.args.replay}. Speed: {speed if speed > 0 else 'max'}")
+        # 取得元 (配信元から購読する場合はAPIから取得しない)
+        if self.args.subscribe:
+            self.poller = SnapshotSubscriber(self.args.subscribe, self.args.ch0_lines + self.args.ch1_lines,
+                                             self.args.subscriber_name, metrics=self.metrics)
+        else:
+            poll_lines = self.args.ch0_lines + self.args.ch1_lines
+            if self.args.publish:
+                poll_lines += [line for line in self.args.publish_lines if line not in poll_lines]
+            self.poller = TrainPoller(self.odpt, poll_lines, metrics=self.metrics)
+        self.publisher = SnapshotPublisher(self.poller, self.args.publish, self.metrics) \
+            if self.args.publish else None
         stations = self.odpt.get_stationtable(self.st_path)
-        print(f"{Log.INFO()}Loaded Station table!")
+        Log.info(f"Loaded Station table!")
+        # 駅間の所要時間 (取得間の列車位置の推定). 購読する場合はAPIにアクセスせず，取得間隔で均等に移動
+        if self.args.subscribe:
+            runtimes = {}
+            Log.info(f"Run times are not used with --subscribe. Trains move evenly between snapshots.")
+        else:
+            runtimes = self.odpt.get_runtimes(self.args.ch0_lines + self.args.ch1_lines)
+            Log.info(f"Loaded run times of {len(runtimes)} lines!")
 
-        self.leds = []
-        for i in range(len(self.lines)):
-            if self.lines[i] == []:
-                self.leds.append([])
-                continue
-            led = LEDCtrl(stations, self.lines[i], i, self.odpt.update_freq, self.cf_path)
-            led.setup_strip()
-            self.leds.append(led)
+        # 起動時のアニメーションは初回の取得と並行して行う (showline())
+        self.animation = self.anim_order(self.anim_param) if self.anim_param else []
+
+        # 描画を別プロセスで行う場合，LEDテープの初期化・アニメーションは描画プロセスで行う
+        self.render = None
+        self.reloader = None
+        if self.args.render_process:
+            stats_file = f"{self.args.stats_file}.render" if self.args.stats_file else None
+            metrics_port = self.args.metrics_port + 1 if self.args.metrics_port is not None else None
+            self.render = RenderProcess(stations, self.lines, self.odpt.update_freq, {
+                "led_config": self.cf_path, "backend": self.args.backend, "sim_dump": self.args.sim_dump,
+                "animation": self.animation, "animation_duration": self.args.animation_duration,
+                "log_level": self.args.log_level, "log_format": self.args.log_format,
+                "metrics_port": metrics_port, "stats_file": stats_file, "stats_interval": self.args.stats_interval,
+                "runtimes": runtimes, "station_table": self.st_path, "reload_interval": self.args.reload_interval,
+            })
+            self.leds = [[] for _ in self.lines]
+            return
 
-        print(f"{Log.INFO()}Setuped LED strips!")
+        self.leds = create_leds(stations, self.lines, self.odpt.update_freq, self.cf_path,
+                                self.args.backend, self.args.sim_dump, self.metrics, runtimes)
+        Log.info(f"Setuped LED strips!")
 
-        # アニメーション
-        if self.anim_param:
-            self.anim_test(self.anim_param)
+        # 設定ファイルの変更を再起動せずに反映
+        if self.args.reload_interval > 0:
+            self.reloader = ConfigReloader(self.leds, self.cf_path, self.st_path, interval=self.args.reload_interval)
 
-    def anim_test(self, param=""):
+    def anim_order(self, param=""):
+        '''起動時のアニメーションで点灯する順の(Channel, 路線)のリスト
+        '''
         # normal用の表示順リストを作成
         line_list = self.args.ch0_lines + self.args.ch1_lines
 
         # 全路線が選択された場合のみ. historyもしくはroutenumを適用
         if len(line_list) < 13 and param != "normal":
             param = "normal"
-            print(f"{Log.WARN()}Must select all lines (13 lines) to set animation mode \"history\" and \"routenum\". Set animation mode \"normal\".")
+            Log.warn(f"Must select all lines (13 lines) to set animation mode \"history\" and \"routenum\". Set animation mode \"normal\".")
 
         elif param == "history":
             line_list = ["G", "M", "A", "H", "T", "I", "C", "Y", "Z", "S", "N", "E", "F"]
@@ -70,70 +187,87 @@ class Main():
         elif param == "routenum":
             line_list = ["A", "H", "G", "M", "T", "I", "N", "Y", "C", "S", "Z", "E", "F"]
 
-        print(f"{Log.INFO()}Show animation! Mode: {param}")
+        Log.info(f"Show animation! Mode: {param}")
 
-        # 表示
-        for i in range(len(line_list)):
-            if line_list[i] in self.args.ch0_lines: ch = 0
-            else: ch = 1
-            self.leds[ch].wipe_strip(line_list[i])
+        return [(0 if line in self.args.ch0_lines else 1, line) for line in line_list]
 
     def showline(self):
+        # 計測値の公開・書き出し
+        if self.metrics_server:
+            self.metrics_server.start()
+        if self.stats:
+            self.stats.start()
+
+        # 全チャンネル共通の取得スレッドを開始 (描画プロセスの場合は共有メモリへの書き込みのみ)
+        if self.render:
+            self.poller.subscribe()
+        else:
+            for i in range(len(self.lines)):
+                if self.lines[i] != []:
+                    self.poller.subscribe()
+        self.poller.start()
+
+        # 他のノードへの配信
+        if self.publisher:
+            self.publisher.start()
+
+        # 描画プロセスに共有メモリでスナップショットを渡す (アニメーションは描画プロセスで行う)
+        if self.render:
+            self.render.start(self.poller)
+            return
+
+        # 起動時のアニメーション (取得スレッドは初回の取得を並行して行う)
+        if self.animation:
+            WipeAnimation(self.leds, self.animation, self.args.animation_duration).run()
+
+        if self.reloader:
+            self.reloader.start()
+
         for i in range(len(self.lines)):
             if self.lines[i] == []:
                 continue
-            
+
             th = threading.Thread(
                 target=self.__showline_thread, args=(self.lines[i], i, ))
             th.setDaemon(True)
             th.start()
-
-            time.sleep(1)
     
     def __showline_thread(self, lines, led_idx):
-        print(f"{Log.INFO()}Strip{led_idx}: Started thread!")
-
-        # 例外カウント
-        except_count = 0
+        Log.info(f"Strip{led_idx}: Started thread!")
 
-        print(f"{Log.INFO()}Strip{led_idx}: Started real-time display!")
+        Log.info(f"Strip{led_idx}: Started real-time display!")
 
-        while True:
-            try:
-                # 表示路線の列車位置を取得
-                trains = self.odpt.get_lines_train(lines)
-            except:
-                # 取得失敗時
-                except_count += 1
-                print(traceback.format_exc())
-                print(f"{Log.WARN()}Strip{led_idx}: Could not get or decode json. Retry after 2 second...")
-                time.sleep(2)
+        led = self.leds[led_idx]
 
-                # 5回以上失敗した場合，処理を終了
-                if except_count >= 5:
-                    print(f"{Log.ERROR()}Strip{led_idx}: Processing failed 5 times. Press Ctrl + C to terminate the main thread.")
-                    return False
+        # 取得とは独立して描画を続ける (全チャンネル共通のスナップショット)
+        led.run_strip(self.poller, led.log_update)
 
-                continue
-            
-            # ログ出力
-            for i in range(len(lines)):
-                # 列車が存在しない場合
-                if trains[i] == []:
-                    print(f"{Log.WARN()}Line {lines[i]}: There are no trains currently running!")
-                else:
-                    print(f"{Log.INFO()}Line {lines[i]}: Updated Train data. Date: {trains[i][0]['dc:date']}")
-            
-            self.leds[led_idx].show_strip(trains)
-            # 例外カウント初期化
-            except_count = 0
+        # 取得スレッドが停止した場合，処理を終了
+        Log.error(f"Strip{led_idx}: Poller stopped. Press Ctrl + C to terminate the main thread.")
+        return False
 
     def stop(self):
+        if self.reloader:
+            self.reloader.stop()
         for i in range(len(self.leds)):
             if self.leds[i]:
                 self.leds[i].clear_strip()
-                print(f"{Log.INFO()}Strip{i}: Stopped LEDs.")
-        print(f"{Log.INFO()}Stopped all LEDs. Exit")
+                self.leds[i].strip.close()
+                Log.info(f"Strip{i}: Stopped LEDs.")
+        if self.render:
+            self.render.stop()
+            Log.info(f"Stopped render process.")
+        if self.publisher:
+            self.publisher.stop()
+            Log.info(f"Stopped publisher. Sent {self.publisher.sent_bytes / 1024:.1f}KB.")
+        if self.capture:
+            self.capture.close()
+            Log.info(f"Saved {self.capture.count} responses to {self.capture.path}.")
+        if self.stats:
+            self.stats.stop()
+            Log.info(f"Saved stats to {self.stats.path}.")
+        Log.info(f"Stopped all LEDs. Exit")
+        Log.flush()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,328 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log import Log
+
+
+# 処理時間用のバケット[s]
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+# 通信時間用のバケット[s]
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# データの経過時間用のバケット[s]
+AGE_BUCKETS = (5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+# 配信の遅れ用のバケット[s]
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# 列車位置の推定誤差用のバケット[s]
+ERROR_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+
+class Histogram():
+    '''ラベルごとの累積ヒストグラム (Prometheusのhistogram)
+
+    Parameters
+    ----------
+    name : str
+        メトリクス名
+    description : str
+        説明
+    buckets : tuple of float
+        バケットの上限値 (昇順)
+    labels : tuple of str
+        ラベル名
+    '''
+
+    def __init__(self, name, description, buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+
+        # ラベル値 -> [バケットごとの件数(+Inf含む), 合計, 件数]
+        self.__series = {}
+        self.__lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        '''値を1件記録する
+
+        Parameters
+        ----------
+        value : float
+            記録する値
+        label_values : str
+            labelsと同じ順のラベル値
+        '''
+        i = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            series = self.__series.get(label_values)
+            if series is None:
+                series = self.__series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        '''Prometheusのテキスト形式に変換する
+
+        Returns
+        -------
+        lines : list of str
+            テキスト形式の行
+        '''
+        with self.__lock:
+            series = [(k, list(v[0]), v[1], v[2]) for k, v in self.__series.items()]
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        bounds = [format_value(b) for b in self.buckets] + ["+Inf"]
+
+        for label_values, counts, total, count in sorted(series):
+            labels = [f'{k}="{v}"' for k, v in zip(self.labels, label_values)]
+            cumulative = 0
+            for le, c in zip(bounds, counts):
+                cumulative += c
+                bucket = ",".join(labels + [f'le="{le}"'])
+                lines.append(f"{self.name}_bucket{{{bucket}}} {cumulative}")
+            suffix = f"{{{','.join(labels)}}}" if labels else ""
+            lines.append(f"{self.name}_sum{suffix} {format_value(total)}")
+            lines.append(f"{self.name}_count{suffix} {count}")
+
+        return lines
+
+
+class Gauge():
+    '''ラベルごとの現在値 (Prometheusのgauge)
+
+    Parameters
+    ----------
+    name : str
+        メトリクス名
+    description : str
+        説明
+    labels : tuple of str
+        ラベル名
+    '''
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.__values = {}
+
+    def set(self, value, *label_values):
+        self.__values[label_values] = value
+
+    def remove(self, *label_values):
+        self.__values.pop(label_values, None)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge"]
+        for label_values, value in sorted(list(self.__values.items())):
+            labels = ",".join(f'{k}="{v}"' for k, v in zip(self.labels, label_values))
+            lines.append(f"{self.name}{{{labels}}} {format_value(value)}" if labels
+                         else f"{self.name} {format_value(value)}")
+
+        return lines
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics():
+    '''取得・描画の各段階の計測値
+
+    各段階で値を記録し，Prometheusのテキスト形式で出力する.
+    記録は二分探索とロック1回のみのため，常時有効にしてよい
+
+    Attributes
+    ----------
+    fetch_latency : Histogram
+        サービスごとのHTTPリクエストの所要時間[s]
+    decode_time : Histogram
+        レスポンスごとのjsonのデコード時間[s]
+    partition_time : Histogram
+        取得ごとの路線別の分類時間[s]
+    render_time : Histogram
+        Channelごと，1フレームの描画時間[s] (show()を含まない)
+    show_time : Histogram
+        Channelごとのshow()の所要時間[s]
+    frame_lateness : Histogram
+        Channelごとのフレームの予定時刻からの遅れ[s]
+    frame_jitter : Histogram
+        Channelごとのフレーム間隔の目標からのずれ[s]
+    poll_jitter : Histogram
+        取得スレッドの起床の予定時刻からの遅れ[s]
+    data_age : Histogram
+        路線ごとの描画開始時点のデータの経過時間[s]
+    estimate_error : Histogram
+        路線ごとの所要時間から推定した到着時刻の誤差(絶対値)[s]
+    subscriber_lag : Histogram
+        配信側: 購読者ごとのスナップショットの取得から購読者の受信確認までの時間[s]
+    subscriber_version_lag : Gauge
+        配信側: 購読者ごとの最新のスナップショットから遅れている版数
+    subscribers : Gauge
+        配信側: 接続中の購読者数
+    snapshot_lag : Histogram
+        購読側: 配信元での取得から受信までの時間[s] (ノード間の時刻のずれを含む)
+    led_current : Gauge
+        Channelごとの直近のフレームの推定消費電流[mA] (led_configのpowerを設定した場合のみ)
+    '''
+
+    PREFIX = "metroled_"
+
+    def __init__(self):
+        p = self.PREFIX
+        self.fetch_latency = Histogram(f"{p}fetch_latency_seconds", "HTTP request latency per service.",
+                                       LATENCY_BUCKETS, ("service",))
+        self.decode_time = Histogram(f"{p}decode_seconds", "JSON decode time per response.", TIME_BUCKETS)
+        self.partition_time = Histogram(f"{p}partition_seconds", "Time to partition trains by line.",
+                                        TIME_BUCKETS)
+        self.render_time = Histogram(f"{p}render_seconds", "Frame render time excluding show().",
+                                     TIME_BUCKETS, ("channel",))
+        self.show_time = Histogram(f"{p}show_seconds", "Time spent in show() per frame.",
+                                   TIME_BUCKETS, ("channel",))
+        self.frame_lateness = Histogram(f"{p}frame_lateness_seconds", "Frame lateness behind schedule.",
+                                        TIME_BUCKETS, ("channel",))
+        self.frame_jitter = Histogram(f"{p}frame_jitter_seconds", "Deviation of frame interval from target.",
+                                      TIME_BUCKETS, ("channel",))
+        self.poll_jitter = Histogram(f"{p}poll_jitter_seconds", "Poller wake-up delay behind schedule.",
+                                     TIME_BUCKETS)
+        self.data_age = Histogram(f"{p}data_age_seconds", "Age of train data when a snapshot is shown.",
+                                  AGE_BUCKETS, ("line",))
+        self.estimate_error = Histogram(f"{p}estimate_error_seconds",
+                                        "Error of estimated arrival time against the next snapshot.",
+                                        ERROR_BUCKETS, ("line",))
+        self.subscriber_lag = Histogram(f"{p}subscriber_lag_seconds",
+                                        "Time from fetch to acknowledgement per subscriber.",
+                                        LAG_BUCKETS, ("subscriber",))
+        self.subscriber_version_lag = Gauge(f"{p}subscriber_version_lag",
+                                            "Snapshots not yet acknowledged per subscriber.", ("subscriber",))
+        self.subscribers = Gauge(f"{p}subscribers", "Connected subscribers.")
+        self.snapshot_lag = Histogram(f"{p}snapshot_lag_seconds", "Time from fetch on the publisher to receipt.",
+                                      LAG_BUCKETS)
+        self.led_current = Gauge(f"{p}led_current_milliamps", "Estimated LED strip current of the last frame.",
+                                 ("channel",))
+        self.uptime = Gauge(f"{p}uptime_seconds", "Seconds since the process started.")
+
+        self.__started = time.monotonic()
+
+    def render(self):
+        '''全ての計測値をPrometheusのテキスト形式に変換する
+
+        Returns
+        -------
+        text : str
+            テキスト形式の計測値
+        '''
+        self.uptime.set(time.monotonic() - self.__started)
+
+        lines = []
+        for metric in (self.fetch_latency, self.decode_time, self.partition_time, self.render_time,
+                       self.show_time, self.frame_lateness, self.frame_jitter, self.poll_jitter,
+                       self.data_age, self.estimate_error, self.subscriber_lag, self.subscriber_version_lag,
+                       self.subscribers, self.snapshot_lag, self.led_current, self.uptime):
+            lines += metric.render()
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer():
+    '''計測値を公開するHTTPサーバ
+
+    GET /metrics でPrometheusのテキスト形式の計測値を返す
+
+    Parameters
+    ----------
+    metrics : Metrics
+        公開する計測値
+    port : int
+        待ち受けるポート
+    host : str
+        待ち受けるアドレス. 既定では同一ホストからのみ接続可能
+    '''
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        self.metrics = metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split("?")[0] != "/metrics":
+                    handler.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                handler.send_response(200)
+                handler.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                handler.send_header("Content-Length", str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                # アクセスごとのログは出力しない
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+        self.address = self.__server.server_address
+
+    def start(self):
+        '''サーバのスレッドを開始する
+        '''
+        th = threading.Thread(target=self.__server.serve_forever)
+        th.setDaemon(True)
+        th.start()
+        Log.info(f"Serving metrics on http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class StatsWriter():
+    '''計測値を定期的にファイルへ書き出す
+
+    node_exporterのtextfile collectorで読み込めるよう，Prometheusのテキスト形式で
+    一時ファイルから置き換える
+
+    Parameters
+    ----------
+    metrics : Metrics
+        書き出す計測値
+    path : str
+        書き出すファイルのパス (例: ./metroled.prom)
+    interval : float
+        書き出す間隔[s]
+    '''
+
+    def __init__(self, metrics, path, interval=60):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.__stop = threading.Event()
+
+    def start(self):
+        '''書き出しスレッドを開始する
+        '''
+        th = threading.Thread(target=self.__write_thread)
+        th.setDaemon(True)
+        th.start()
+
+    def stop(self):
+        '''書き出しを停止し，最後の計測値を書き出す
+        '''
+        self.__stop.set()
+        self.write()
+
+    def write(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.metrics.render())
+            os.replace(tmp, self.path)
+        except OSError as e:
+            Log.warn(f"Could not write stats {self.path}: {e}")
+
+    def __write_thread(self):
+        while not self.__stop.wait(self.interval):
+            self.write()
@@ -1,8 +1,16 @@
 import requests
 import json
 import sys
+import time
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
-from log import Log
+from log import Log, describe_error
+from decode import decode_trains
+from cache import TTLCache, intern_keys
+from backoff import CircuitBreaker, ServiceUnavailable
 
 
 class ODPT():
@@ -12,6 +20,12 @@ class ODPT():
     ----------
     jsonpath : str
         api_config.jsonのパス
+    capture : CaptureWriter
+        取得したレスポンスの記録先 (Noneの場合は記録しない)
+    replay : ReplaySource
+        HTTP取得の代わりに使用する記録の再生 (Noneの場合はAPIから取得)
+    metrics : Metrics
+        通信・デコード・分類の所要時間の記録先 (Noneの場合は記録しない)
 
     Attributes
     ----------
@@ -19,17 +33,102 @@ class ODPT():
         路線記号のテーブル
     update_freq : int
         APIデータの更新間隔
+    poll_margin : float
+        データの公開予定時刻から取得までの余裕[s]
+    request_count : int
+        送信したHTTPリクエスト数
+    latency : dict
+        サービスごとの直近のリクエストの所要時間[s]
+    cycle_latency : float
+        直近の全列車取得の所要時間[s] (サービス間の最大値)
+    fetch_strategy : dict
+        サービスごとの直近の取得方法 ("bulk": 全列車, "line": 路線ごと, None: 取得なし)
+    payload_size : dict
+        サービスごとの全列車データの直近のサイズ[byte]
+    line_payload_size : dict
+        路線ごとの列車データの直近のサイズ[byte]
+    not_modified_count : int
+        304 Not Modifiedにより本文の取得を省略できた回数
+    decode_time : float
+        直近の取得周期のjsonのデコード時間[s]
+    cycle_bytes : int
+        直近の取得周期で受信した本文のサイズ[byte]
+    breakers : dict
+        サービスごとの再試行制御 (CircuitBreaker)
+    last_success : dict
+        サービスごとの最後に取得に成功した時刻 (time.time()). 未取得の場合はNone
     '''
 
-    def __init__(self, jsonpath="./config/api_config.json"):
+    # 1リクエストあたりのヘッダ等のオーバーヘッド[byte]
+    REQUEST_OVERHEAD = 1500
+
+    def __init__(self, jsonpath="./config/api_config.json", capture=None, replay=None, metrics=None):
 
         with open(jsonpath, 'r') as cf:
             config = json.load(cf)
 
-        with open("./data/line_table.json", 'r') as li:
-            self.line_table = json.load(li)
+        # APIから作成した駅テーブルは有効期間内は再取得しない
+        self.__station_cache = TTLCache(ttl=config.get("station_cache_ttl", 86400))
+        # 駅間の所要時間は1日ごとに再取得
+        self.__runtime_cache = TTLCache(ttl=config.get("runtime_cache_ttl", 86400))
+
+        with open("./data/line_table.json", 'r') as lf:
+            self.line_table = json.load(lf)
+
+        # odpt:railway -> lineCode
+        self.__railway_line = {v: k for k, v in self.line_table.items()}
 
         self.update_freq = config["update_freq"]
+        self.poll_margin = config.get("poll_margin", 2)
+        self.request_count = 0
+        self.latency = {"odpt": 0.0, "metro": 0.0}
+        self.cycle_latency = 0.0
+        self.__count_lock = threading.Lock()
+        self.__metrics = metrics
+
+        # 記録・再生
+        self.__capture = capture
+        self.__replay = replay
+        self.__cycle = 0
+
+        # 取得方法 ("auto", "bulk", "line"). 再生時は全列車
+        self.__strategy = config.get("fetch_strategy", "auto") if replay is None else "bulk"
+        self.fetch_strategy = {"odpt": None, "metro": None}
+        self.payload_size = {"odpt": None, "metro": None}
+        self.line_payload_size = {}
+
+        # 条件付きリクエスト用のキャッシュ (url -> ETag, Last-Modified, データ)
+        self.__conditional = {}
+        self.not_modified_count = 0
+
+        self.decode_time = 0.0
+        self.cycle_bytes = 0
+
+        # サービスごとの再試行制御. 一方のサービスの障害中も他方の路線は更新を続ける
+        backoff = config.get("backoff", {})
+        self.breakers = {service: CircuitBreaker(
+            backoff.get("base", 2), backoff.get("max_delay", 120),
+            backoff.get("threshold", 5), backoff.get("cooldown", 60),
+            backoff.get("jitter", 5)) for service in ["odpt", "metro"]}
+        self.last_success = {"odpt": None, "metro": None}
+        # 障害中に使用する，サービスごとの最後に取得できたデータ
+        self.__last_good = {}
+
+        # タイムアウト(接続, 読み込み)
+        timeout = config.get("timeout", {})
+        self.__timeout = (timeout.get("connect", 5), timeout.get("read", 10))
+
+        # サービスごとにKeep-Aliveの接続プールを保持
+        self.__sessions = {}
+        for service in ["odpt", "metro"]:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self.__sessions[service] = session
+
+        # 2サービスの並列取得用
+        self.__executor = ThreadPoolExecutor(max_workers=2)
+        # 路線ごとの並列取得用
+        self.__line_executor = ThreadPoolExecutor(max_workers=4)
 
         self.__odpt_key = config["odpt"]["token"]
         self.__metro_key = config["metro"]["token"]
@@ -43,12 +142,24 @@ class ODPT():
         self.__trains = {}
         self.__trains.update(**config["odpt"]["Train"], **config["metro"]["Train"])
 
+        # 路線ごとの提供サービス
+        self.__line_service = {}
+        self.__line_service.update(**{k: "odpt" for k in config["odpt"]["Train"].keys()},
+                                   **{k: "metro" for k in config["metro"]["Train"].keys()})
+
         self.__odpt_tra = config["odpt"]["Trains"] + self.__odpt_key
         self.__metro_tra = config["metro"]["Trains"] + self.__metro_key
 
         self.__odpt_rwy = config["odpt"]["Railway"] + self.__odpt_key
         self.__metro_rwy = config["metro"]["Railway"] + self.__metro_key
 
+        # 路線ごとの列車時刻表 (路線情報に駅間の所要時間がない場合に使用)
+        self.__timetables = {}
+        for service in ["odpt", "metro"]:
+            url = config[service].get("TrainTimetable")
+            if url:
+                self.__timetables[service] = url + config[service]["token"]
+
     def get_railway(self, service):
         '''"service"で提供される路線情報を取得する
 
@@ -63,9 +174,9 @@ class ODPT():
             路線ごとの駅情報
         '''
         if service == "odpt":
-            r = requests.get(self.__odpt_rwy)
+            r = self.__fetch(service, self.__odpt_rwy)
         elif service == "metro":
-            r = requests.get(self.__metro_rwy)
+            r = self.__fetch(service, self.__metro_rwy)
         else:
             return None
 
@@ -87,11 +198,37 @@ class ODPT():
             指定した路線の列車走行位置情報
         '''
 
-        r = requests.get(self.__trains[line])
-        train_data = r.json()
-        
+        train_data = self.__fetch_json(self.__line_service[line], self.__trains[line], line)
+        self.line_payload_size[line] = self.__last_size(self.__trains[line])
+
         return train_data
 
+    def get_service(self, line):
+        '''路線を提供するサービスを取得する
+
+        Parameters
+        ----------
+        line : str
+            路線のlineCode
+
+        Returns
+        -------
+        service : str
+            "odpt" or "metro". 不明な路線の場合はNone
+        '''
+        return self.__line_service.get(line)
+
+    def retry_delay(self):
+        '''全サービスが取得できない場合に，次に試行できるまでの時間
+
+        Returns
+        -------
+        delay : float
+            最も早く再試行できるサービスまでの時間[s]
+        '''
+        now = time.monotonic()
+        return max(min(b.next_attempt for b in self.breakers.values()) - now, 0.0)
+
     def get_lines_train(self, lines):
         '''指定した複数路線の列車走行位置を取得する
 
@@ -103,22 +240,50 @@ class ODPT():
         Returns
         -------
         data : [[dict],[dict],...]
-            複数路線の列車走行位置情報
+            複数路線の列車走行位置情報. 取得できなかったサービスの路線は最後に取得できたデータ
+
+        Raises
+        ------
+        ServiceUnavailable
+            表示路線を提供する全てのサービスから取得できなかった場合
         '''
 
-        trains_data = []
-        all_trains = self.__get_all_trains()
+        all_trains = self.__get_all_trains(lines)
+
+        start = time.perf_counter()
+        index = self.partition_trains(all_trains)
+        if self.__metrics is not None:
+            self.__metrics.partition_time.observe(time.perf_counter() - start)
+
+        return [index.get(line, []) for line in lines]
+
+    def partition_trains(self, all_trains):
+        '''列車走行位置を路線ごとに分類する
+
+        Parameters
+        ----------
+        all_trains : list of dict
+            複数路線の列車走行位置情報
 
-        for i in range(len(lines)):
-            line_trains = []
+        Returns
+        -------
+        index : dict
+            lineCodeごとの列車走行位置情報のリスト
+        '''
+        index = {}
+        railway_line = self.__railway_line
 
-            for j in range(len(all_trains)):
-                if all_trains[j]["odpt:railway"] == self.line_table[lines[i]]:
-                    line_trains.append(all_trains[j])
-                    
-            trains_data.append(line_trains)
+        # 1回の走査で分類
+        for train in all_trains:
+            line = railway_line.get(train["odpt:railway"])
+            if line is None:
+                continue
+            line_trains = index.get(line)
+            if line_trains is None:
+                index[line] = line_trains = []
+            line_trains.append(train)
 
-        return trains_data
+        return index
 
     def get_stationtable(self, jsonpath="./data/station_table.json"):
         '''静的ファイルから駅テーブルを取得する
@@ -129,17 +294,19 @@ class ODPT():
             路線ごとの駅テーブル
         '''
         try:
-            with open(jsonpath, 'r') as sta:
-                sta_table = json.load(sta)
+            with open(jsonpath, 'r') as sf:
+                sta_table = json.load(sf)
         except FileNotFoundError:
-            print(f"{Log.ERROR()}Not Found {jsonpath}! Exit.")
+            Log.error(f"Not Found {jsonpath}! Exit.")
             sys.exit()
 
-        return sta_table
+        return intern_keys(sta_table)
 
     def get_stationtable_api(self, service):
         '''APIから"service"の駅テーブルを取得する
 
+        取得した駅テーブルはstation_cache_ttl[s]の間保存し，再取得しない
+
         Parameters
         ----------
         service : str
@@ -150,6 +317,158 @@ class ODPT():
         sta_table : dict
             "service"の路線ごとの駅テーブル
         '''
+        sta_table = self.__station_cache.load(
+            f"stationtable-{service}", lambda: self.__build_stationtable_api(service))
+
+        return intern_keys(sta_table)
+
+    def get_runtimes(self, lines):
+        '''駅間の所要時間を取得する
+
+        路線情報の所要時間(odpt:travelTime), ない場合は列車時刻表から求めた所要時間を
+        runtime_cache_ttl[s]の間保存し，再取得しない
+
+        Parameters
+        ----------
+        lines : list of str
+            路線のlineCodeのリスト
+
+        Returns
+        -------
+        runtimes : dict
+            lineCodeごと，(odpt:fromStation, odpt:toStation)ごとの所要時間[s].
+            取得できなかった路線は含まない
+        '''
+        runtimes = {}
+
+        # 記録の再生時は使用しない (dc:dateが記録時刻のため，現在時刻からの経過時間で推定できない)
+        if self.__replay is not None:
+            Log.info(f"ODPT: Run times are not used in replay. Trains move evenly between polls.")
+            return runtimes
+
+        for service in ["odpt", "metro"]:
+            service_lines = [line for line in lines if self.__line_service.get(line) == service]
+            if service_lines == []:
+                continue
+
+            try:
+                table = self.__runtime_cache.load(
+                    f"runtime-{service}", lambda: self.__build_runtime_table(service))
+            except Exception as e:
+                Log.warn(f"ODPT: Could not get {service} run times ({describe_error(e)}). "
+                         f"Trains move evenly between polls.")
+                continue
+
+            for line in service_lines:
+                if not table.get(line):
+                    Log.warn(f"Line {line}: No run times between stations. Trains move evenly between polls.")
+                    continue
+                runtimes[sys.intern(line)] = self.__runtime_keys(table[line])
+
+        return runtimes
+
+    @staticmethod
+    def __runtime_keys(table):
+        '''保存形式("駅 駅": 所要時間)から(駅, 駅)をキーとする対応表に変換する
+        '''
+        intern = sys.intern
+        runtimes = {}
+        for key, runtime in table.items():
+            from_sta, to_sta = key.split(" ")
+            runtimes[(intern(from_sta), intern(to_sta))] = runtime
+
+        return runtimes
+
+    def __build_runtime_table(self, service):
+        '''"service"の路線ごとの駅間の所要時間を作成する
+
+        Returns
+        -------
+        table : dict
+            lineCodeごと，"fromStation toStation"ごとの所要時間[s] (jsonで保存するため文字列のキー)
+        '''
+        railway_line = self.__railway_line
+        table = {}
+
+        # 路線情報の所要時間 (種別ごとに異なる場合は最短)
+        for railway in self.get_railway(service):
+            line = railway_line.get(railway.get("owl:sameAs"), railway.get("odpt:lineCode"))
+            runtimes = {}
+            for t in railway.get("odpt:travelTime") or []:
+                runtime = t.get("odpt:necessaryTime")
+                if runtime:
+                    self.__add_runtime(runtimes, t["odpt:fromStation"], t["odpt:toStation"], runtime * 60)
+            if line and runtimes:
+                table[line] = self.__fill_reverse(runtimes)
+
+        # 所要時間がない路線は列車時刻表の駅間の発車時刻の差から求める
+        url = self.__timetables.get(service)
+        if url:
+            for line, service_of_line in self.__line_service.items():
+                if service_of_line != service or line in table:
+                    continue
+                r = self.__fetch(service, url.replace("{railway}", self.line_table[line]))
+                runtimes = self.__runtimes_from_timetables(r.json())
+                if runtimes:
+                    table[line] = self.__fill_reverse(runtimes)
+
+        return table
+
+    def __runtimes_from_timetables(self, timetables):
+        '''列車時刻表から駅間の所要時間(中央値)を求める
+        '''
+        samples = {}
+        for timetable in timetables:
+            prev_sta = prev_time = None
+            for stop in timetable.get("odpt:trainTimetableObject") or []:
+                sta = stop.get("odpt:departureStation") or stop.get("odpt:arrivalStation")
+                minutes = self.__parse_minutes(stop.get("odpt:departureTime") or stop.get("odpt:arrivalTime"))
+                if sta is None or minutes is None:
+                    prev_sta = None
+                    continue
+
+                if prev_sta is not None:
+                    # 日付をまたぐ場合
+                    runtime = (minutes - prev_time) % (24 * 60)
+                    if runtime > 0:
+                        samples.setdefault((prev_sta, sta), []).append(runtime)
+                prev_sta, prev_time = sta, minutes
+
+        runtimes = {}
+        for (from_sta, to_sta), v in samples.items():
+            v.sort()
+            self.__add_runtime(runtimes, from_sta, to_sta, v[len(v) // 2] * 60)
+
+        return runtimes
+
+    @staticmethod
+    def __add_runtime(runtimes, from_sta, to_sta, runtime):
+        '''駅間の所要時間を追加する (既にある場合は短い方)
+        '''
+        key = f"{from_sta} {to_sta}"
+        runtimes[key] = min(runtimes.get(key, runtime), runtime)
+
+    @staticmethod
+    def __fill_reverse(runtimes):
+        '''逆方向の所要時間がない駅間は，同じ所要時間とする
+        '''
+        for key, runtime in list(runtimes.items()):
+            from_sta, to_sta = key.split(" ")
+            runtimes.setdefault(f"{to_sta} {from_sta}", runtime)
+
+        return runtimes
+
+    @staticmethod
+    def __parse_minutes(hhmm):
+        try:
+            hour, minute = hhmm.split(":")
+            return int(hour) * 60 + int(minute)
+        except (AttributeError, ValueError):
+            return None
+
+    def __build_stationtable_api(self, service):
+        '''APIの路線情報から駅テーブルを作成する
+        '''
         railway = self.get_railway(service)
         sta_table = {}
 
@@ -165,11 +484,210 @@ class ODPT():
 
         return sta_table
 
-    def __get_all_trains(self):
-        odpt_r = requests.get(self.__odpt_tra)
-        metro_r = requests.get(self.__metro_tra)
-        
-        odpt_data = odpt_r.json()
-        metro_data = metro_r.json()
-        
+    def __fetch(self, service, url, headers=None):
+        '''"service"の接続プールを用いてurlを取得する
+
+        Parameters
+        ----------
+        service : str
+            オープンデータのサービス("odpt" or "metro")
+        url : str
+            取得するURL
+        headers : dict
+            追加するリクエストヘッダ
+
+        Returns
+        -------
+        r : requests.Response
+            レスポンス
+        '''
+        start = time.monotonic()
+        r = self.__sessions[service].get(url, headers=headers, timeout=self.__timeout)
+        self.latency[service] = time.monotonic() - start
+        if self.__metrics is not None:
+            self.__metrics.fetch_latency.observe(self.latency[service], service)
+        with self.__count_lock:
+            self.request_count += 1
+        r.raise_for_status()
+
+        return r
+
+    def __fetch_json(self, service, url, key):
+        '''条件付きリクエストでurlを取得し，jsonをデコードする
+
+        前回取得時のETag, Last-Modifiedを送信し，304の場合は前回のデータを返す.
+        keyは記録・再生時の取得対象 ("Trains": 全列車, lineCode: 路線ごと)
+        '''
+        # 記録の再生
+        if self.__replay is not None:
+            r = self.__replay.response(service, key)
+            data = self.__decode(r.content)
+            self.__conditional[url] = {"size": len(r.content)}
+            return data
+
+        headers = {}
+        cached = self.__conditional.get(url)
+        if cached is not None:
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        r = self.__fetch(service, url, headers)
+
+        # 更新なし
+        if r.status_code == 304 and cached is not None:
+            with self.__count_lock:
+                self.not_modified_count += 1
+            return cached["data"]
+
+        data = self.__decode(r.content)
+        if self.__capture is not None:
+            self.__capture.write(service, key, r.content, self.__cycle)
+        self.__conditional[url] = {
+            "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"),
+            "data": data, "size": len(r.content)}
+
+        return data
+
+    def __decode(self, body):
+        '''必要な項目のみデコードし，デコード時間と受信サイズを集計する
+        '''
+        start = time.perf_counter()
+        data = decode_trains(body)
+        elapsed = time.perf_counter() - start
+        if self.__metrics is not None:
+            self.__metrics.decode_time.observe(elapsed)
+
+        with self.__count_lock:
+            self.decode_time += elapsed
+            self.cycle_bytes += len(body)
+
+        return data
+
+    def __last_size(self, url):
+        return self.__conditional[url]["size"]
+
+    def __select_strategy(self, service, lines):
+        '''"service"の取得方法を選択する
+
+        計測した全列車データと路線ごとのデータのサイズから，転送量の少ない方を選ぶ
+
+        Parameters
+        ----------
+        service : str
+            オープンデータのサービス("odpt" or "metro")
+        lines : list of str
+            "service"で提供される表示路線のlineCodeのリスト
+
+        Returns
+        -------
+        strategy : str
+            "bulk": 全列車, "line": 路線ごと
+        '''
+        if self.__strategy != "auto":
+            return self.__strategy
+
+        service_lines = [k for k, v in self.__line_service.items() if v == service]
+        bulk_size = self.payload_size[service]
+
+        # 未計測の場合は，既知の路線ごとのサイズから推定
+        if bulk_size is None:
+            known = [self.line_payload_size[k] for k in service_lines if k in self.line_payload_size]
+            if not known:
+                # 半数以上の路線を表示する場合は全列車
+                return "bulk" if len(lines) * 2 >= len(service_lines) else "line"
+            bulk_size = sum(known) / len(known) * len(service_lines)
+
+        line_cost = 0
+        for line in lines:
+            line_cost += self.line_payload_size.get(line, bulk_size / len(service_lines))
+            line_cost += self.REQUEST_OVERHEAD
+
+        return "line" if line_cost < bulk_size + self.REQUEST_OVERHEAD else "bulk"
+
+    def __get_service_trains(self, service, lines):
+        '''"service"で提供される表示路線の列車走行位置を取得する
+        '''
+        lines = [line for line in lines if self.__line_service.get(line) == service]
+
+        # 表示路線がない場合は取得しない
+        if lines == []:
+            self.fetch_strategy[service] = None
+            return []
+
+        strategy = self.__select_strategy(service, lines)
+        self.fetch_strategy[service] = strategy
+
+        if strategy == "bulk":
+            url = self.__odpt_tra if service == "odpt" else self.__metro_tra
+            data = self.__fetch_json(service, url, "Trains")
+            self.payload_size[service] = self.__last_size(url)
+            return data
+
+        # 路線ごとに並列取得
+        futures = [self.__line_executor.submit(self.get_train, line) for line in lines]
+        data = []
+        for f in futures:
+            data += f.result()
+
+        return data
+
+    def __get_all_trains(self, lines):
+        start = time.monotonic()
+        self.__cycle += 1
+        self.decode_time = 0.0
+        self.cycle_bytes = 0
+
+        # 再生時刻まで記録を読み進める
+        if self.__replay is not None:
+            self.__replay.advance()
+
+        # 2サービスを並列に取得
+        odpt_f = self.__executor.submit(self.__guard_service_trains, "odpt", lines)
+        metro_f = self.__executor.submit(self.__guard_service_trains, "metro", lines)
+        odpt_data, odpt_ok = odpt_f.result()
+        metro_data, metro_ok = metro_f.result()
+
+        self.cycle_latency = time.monotonic() - start
+
+        # 1サービスでも取得できれば，他方は最後に取得できたデータを使用
+        if True not in (odpt_ok, metro_ok) and False in (odpt_ok, metro_ok):
+            raise ServiceUnavailable("Could not get trains from any service")
+
         return odpt_data + metro_data
+
+    def __guard_service_trains(self, service, lines):
+        '''再試行制御を行いながら"service"の列車走行位置を取得する
+
+        Returns
+        -------
+        data : list of dict
+            取得したデータ. 失敗・待機中の場合は最後に取得できたデータ
+        ok : bool
+            取得できた場合はTrue, 失敗・待機中の場合はFalse, 表示路線がない場合はNone
+        '''
+        if not any(self.__line_service.get(line) == service for line in lines):
+            self.fetch_strategy[service] = None
+            return [], None
+
+        breaker = self.breakers[service]
+        if not breaker.allow():
+            return self.__last_good.get(service, []), False
+
+        try:
+            data = self.__get_service_trains(service, lines)
+        except Exception as e:
+            delay = breaker.failure()
+            Log.warn(f"ODPT: Could not get {service} trains ({describe_error(e)}). "
+                     f"Retry after {delay:.1f}s. Failures: {breaker.failures}, State: {breaker.state}",
+                     key=f"fetch-{service}", traceback=traceback.format_exc())
+            return self.__last_good.get(service, []), False
+
+        if breaker.failures:
+            Log.info(f"ODPT: Recovered {service} after {breaker.failures} failures.")
+        breaker.success()
+        self.__last_good[service] = data
+        self.last_success[service] = time.time()
+
+        return data, True
@@ -0,0 +1,356 @@
+import sys
+import threading
+import time
+import traceback
+from types import MappingProxyType
+
+from log import Log
+from scheduler import PollScheduler, parse_date
+from backoff import ServiceUnavailable
+
+
+class TrainSnapshot():
+    '''ある時点の列車走行位置 (読み取り専用)
+
+    Parameters
+    ----------
+    version : int
+        スナップショットの通し番号
+    trains : dict
+        lineCodeごとの列車走行位置情報
+    next_fetch : float
+        次回の取得予定時刻 (time.time())
+    updated_at : dict
+        lineCodeごとの最後に取得に成功した時刻 (time.time()). Noneの場合は全路線がfetched_at
+    fetched_at : float
+        取得完了時刻 (time.time()). Noneの場合は現在時刻
+
+    Attributes
+    ----------
+    version : int
+        スナップショットの通し番号
+    fetched_at : float
+        取得完了時刻 (time.time())
+    next_fetch : float
+        次回の取得予定時刻 (time.time())
+    trains : mappingproxy
+        lineCodeごとの列車走行位置情報 (tuple of dict. 列車ごとのdictは変更しないこと)
+    data_date : mappingproxy
+        lineCodeごとの最新のdc:date (UNIX時間). 列車がない場合はNone
+    updated_at : mappingproxy
+        lineCodeごとの最後に取得に成功した時刻 (time.time())
+    by_number : mappingproxy
+        lineCodeごとの列車番号から列車走行位置情報への対応 (初回の参照時に作成)
+    '''
+
+    def __init__(self, version, trains, next_fetch=None, updated_at=None, fetched_at=None):
+        self.version = version
+        self.fetched_at = time.time() if fetched_at is None else fetched_at
+        self.next_fetch = next_fetch
+        self.updated_at = MappingProxyType(
+            dict(updated_at) if updated_at is not None else {k: self.fetched_at for k in trains})
+
+        # 外側の容器(路線ごとのtuple, mappingproxy)のみ読み取り専用にし，列車ごとの複製は作らない
+        line_trains = {}
+        data_date = {}
+        for k, v in trains.items():
+            latest = None
+            for t in v:
+                d = parse_date(t.get("dc:date"))
+                if d is not None and (latest is None or d > latest):
+                    latest = d
+            line_trains[k] = tuple(v)
+            data_date[k] = latest
+
+        self.trains = MappingProxyType(line_trains)
+        self.data_date = MappingProxyType(data_date)
+        self.__by_number = None
+
+    @property
+    def by_number(self):
+        # 参照しない場合は作成しない. 複数スレッドから同時に作成しても結果は同じ
+        by_number = self.__by_number
+        if by_number is None:
+            by_number = self.__by_number = MappingProxyType({
+                line: MappingProxyType({t["odpt:trainNumber"]: t for t in v}) for line, v in self.trains.items()})
+        return by_number
+
+    def data_age(self, line, now=None):
+        '''路線のデータの経過時間を取得する
+
+        Parameters
+        ----------
+        line : str
+            路線のlineCode
+        now : float
+            基準時刻 (UNIX時間). Noneの場合は現在時刻
+
+        Returns
+        -------
+        age : float
+            最新のdc:dateからの経過時間[s]. 列車がない場合はNone
+        '''
+        date = self.data_date.get(line)
+        if date is None:
+            return None
+        return (time.time() if now is None else now) - date
+
+    def update_age(self, line, now=None):
+        '''路線のデータを最後に取得できてからの経過時間を取得する
+
+        APIの障害中は，最後に取得できたデータを使い続けるため増加する
+
+        Parameters
+        ----------
+        line : str
+            路線のlineCode
+        now : float
+            基準時刻 (time.time()). Noneの場合は現在時刻
+
+        Returns
+        -------
+        age : float
+            最後に取得できてからの経過時間[s]. 一度も取得できていない場合はNone
+        '''
+        updated = self.updated_at.get(line)
+        if updated is None:
+            return None
+        return (time.time() if now is None else now) - updated
+
+    def to_compact(self, lines=None):
+        '''描画に必要な項目のみの形式に変換する (プロセス間・ノード間の受け渡し用)
+
+        Parameters
+        ----------
+        lines : list of str
+            変換する路線のlineCodeのリスト. Noneの場合は全路線
+
+        Returns
+        -------
+        data : dict
+            version, fetched_at, next_fetch, updated_at, trains
+            (trainsはlineCodeごとの[列車番号, fromStation, toStation, dc:date]のリスト)
+        '''
+        if lines is None:
+            lines = list(self.trains)
+
+        return {
+            "version": self.version,
+            "fetched_at": self.fetched_at,
+            "next_fetch": self.next_fetch,
+            "updated_at": {line: self.updated_at.get(line) for line in lines if line in self.trains},
+            "trains": {line: [(t["odpt:trainNumber"], t["odpt:fromStation"], t["odpt:toStation"], t.get("dc:date"))
+                              for t in self.trains[line]] for line in lines if line in self.trains},
+        }
+
+    @staticmethod
+    def from_compact(data, version=None):
+        '''to_compact()で変換したデータからスナップショットを作成する
+
+        駅名はinternし，駅テーブル・点灯経路の対応表と同じ文字列を共有する
+
+        Parameters
+        ----------
+        data : dict
+            to_compact()で変換したデータ
+        version : int
+            スナップショットの通し番号. Noneの場合はdataの通し番号
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            作成したスナップショット
+        '''
+        intern = sys.intern
+        trains = {}
+        for line, v in data["trains"].items():
+            trains[intern(line)] = [{"odpt:trainNumber": number,
+                                     "odpt:fromStation": intern(from_sta),
+                                     "odpt:toStation": None if to_sta is None else intern(to_sta),
+                                     "dc:date": date} for number, from_sta, to_sta, date in v]
+
+        return TrainSnapshot(data["version"] if version is None else version, trains,
+                             data["next_fetch"], data["updated_at"], data["fetched_at"])
+
+    def get_lines(self, lines):
+        '''指定した複数路線の列車走行位置を取得する
+
+        Parameters
+        ----------
+        lines : list of str
+            路線のlineCodeのリスト
+
+        Returns
+        -------
+        data : [(dict, dict, ...), ...]
+            ODPT.get_lines_train()と同じ並びの列車走行位置情報
+        '''
+        return [self.trains.get(line, ()) for line in lines]
+
+
+class TrainPoller():
+    '''全チャンネル共通の列車位置取得
+
+    1回の取得結果をTrainSnapshotとして全チャンネルに配布する
+
+    Parameters
+    ----------
+    odpt : ODPT
+        APIデータ処理
+    lines : list of str
+        全チャンネルで表示する路線のlineCodeのリスト
+    metrics : Metrics
+        取得スレッドの起床の遅れの記録先 (Noneの場合は記録しない)
+
+    Attributes
+    ----------
+    lines : list of str
+        取得対象の路線のlineCodeのリスト
+    subscribers : int
+        スナップショットを参照するチャンネル数
+    fetch_count : int
+        取得回数
+    saved_requests : int
+        チャンネルごとに取得した場合と比べて削減できたHTTPリクエスト数
+    scheduler : PollScheduler
+        取得タイミングの計画
+    '''
+
+    def __init__(self, odpt, lines, metrics=None):
+        self.odpt = odpt
+        self.lines = list(lines)
+        self.subscribers = 0
+        self.fetch_count = 0
+        self.saved_requests = 0
+        self.scheduler = PollScheduler(odpt.update_freq, odpt.poll_margin)
+
+        self.__metrics = metrics
+        self.__snapshot = None
+        self.__stopped = False
+        self.__cond = threading.Condition()
+
+    def subscribe(self):
+        '''スナップショットを参照するチャンネルを登録する
+        '''
+        with self.__cond:
+            self.subscribers += 1
+
+    def start(self):
+        '''取得スレッドを開始する
+        '''
+        th = threading.Thread(target=self.__poll_thread)
+        th.setDaemon(True)
+        th.start()
+
+    def wait_snapshot(self, version=0):
+        '''"version"より新しいスナップショットを待つ
+
+        Parameters
+        ----------
+        version : int
+            前回受け取ったスナップショットの通し番号
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            最新のスナップショット. 取得スレッドが停止した場合はNone
+        '''
+        with self.__cond:
+            while not self.__stopped and \
+                    (self.__snapshot is None or self.__snapshot.version <= version):
+                self.__cond.wait()
+
+            if self.__stopped:
+                return None
+            return self.__snapshot
+
+    def latest(self):
+        '''最新のスナップショットを待たずに取得する
+
+        スナップショットは読み取り専用のため，取得スレッドは新しいスナップショットを
+        作成してから参照を差し替える (ダブルバッファ)
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            最新のスナップショット. 取得スレッドが停止した場合はNone
+        '''
+        if self.__stopped:
+            return None
+        return self.__snapshot
+
+    def stop(self):
+        '''取得スレッドを停止し，待機中の描画スレッドに通知する
+        '''
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+
+    def __publish(self, trains, next_fetch, updated_at):
+        # 裏で作成してから差し替え
+        version = self.__snapshot.version + 1 if self.__snapshot else 1
+        snapshot = TrainSnapshot(version, trains, next_fetch, updated_at)
+
+        with self.__cond:
+            self.__snapshot = snapshot
+            self.__cond.notify_all()
+
+    def __poll_thread(self):
+        # 例外カウント
+        except_count = 0
+
+        while not self.__stopped:
+            requests_before = self.odpt.request_count
+
+            try:
+                # 全チャンネルの表示路線の列車位置を一括取得
+                trains = self.odpt.get_lines_train(self.lines)
+            except ServiceUnavailable:
+                # 全サービスの障害時は，再試行できるまで待機 (描画は最後のスナップショットで続ける)
+                except_count += 1
+                delay = max(self.odpt.retry_delay(), 1)
+                Log.warn(f"Poller: All services are unavailable. Retry after {delay:.1f}s. "
+                         f"Failures: {except_count}", key="poller-unavailable")
+                time.sleep(delay)
+                continue
+            except:
+                # 取得後の処理の失敗時
+                except_count += 1
+                Log.warn(f"Poller: Could not process train data. Retry after 2 second... Failures: {except_count}",
+                         key="poller-error", traceback=traceback.format_exc())
+                time.sleep(2)
+                continue
+
+            # 削減できたリクエスト数 (チャンネルごとに取得した場合との差)
+            self.fetch_count += 1
+            self.saved_requests += \
+                (self.odpt.request_count - requests_before) * max(self.subscribers - 1, 0)
+
+            # ログ出力
+            for i in range(len(self.lines)):
+                # 列車が存在しない場合 (夜間は毎回同じ警告となるため重複を抑制)
+                if trains[i] == []:
+                    Log.warn(f"Line {self.lines[i]}: There are no trains currently running!",
+                             key=f"no-trains-{self.lines[i]}")
+                else:
+                    Log.debug(f"Line {self.lines[i]}: Updated Train data. Date: {trains[i][0]['dc:date']}")
+
+            # 次回の取得時刻を計画
+            next_fetch = self.scheduler.plan(trains, time.time())
+
+            # 路線ごとの最後に取得できた時刻 (障害中のサービスの路線は過去の時刻)
+            updated_at = {line: self.odpt.last_success.get(self.odpt.get_service(line)) for line in self.lines}
+
+            self.__publish(dict(zip(self.lines, trains)), next_fetch, updated_at)
+            Log.info(f"Poller: Fetched {self.fetch_count} times. Saved {self.saved_requests} requests. "
+                     f"Latency: odpt {self.odpt.latency['odpt']:.3f}s, metro {self.odpt.latency['metro']:.3f}s. "
+                     f"Strategy: {self.odpt.fetch_strategy}. Not modified: {self.odpt.not_modified_count}. "
+                     f"Next fetch in {self.scheduler.interval:.1f}s. Jitter: {self.scheduler.jitter * 1000:.1f}ms. "
+                     f"Decode: {self.odpt.decode_time * 1000:.1f}ms, {self.odpt.cycle_bytes / 1024:.1f}KB")
+
+            # 例外カウント初期化
+            except_count = 0
+
+            self.scheduler.wait()
+            if self.__metrics is not None:
+                self.__metrics.poll_jitter.observe(self.scheduler.jitter)
@@ -0,0 +1,149 @@
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class PowerLimiter():
+    '''LEDテープの消費電流の推定と明るさの制限
+
+    LEDごとのR, G, Bの合計を書き込んだLEDの分だけ差分で更新し，フレームごとの消費電流を推定する.
+    推定値が上限を超える場合は，上限に収まるよう明るさを下げる
+
+    Parameters
+    ----------
+    num : int
+        LEDのドット数
+    max_current : float
+        LEDテープの消費電流の上限[mA]
+    led_current : float
+        LEDの1色を最大(255)で点灯した場合の電流[mA]
+    idle_current : float
+        消灯時のLED1個あたりの電流[mA]
+    batch : bool
+        LEDごとの値をNumPyの配列で記録する (一括描画用)
+
+    Attributes
+    ----------
+    demand : float
+        直近のフレームを設定の明るさで表示した場合の推定電流[mA]
+    current : float
+        直近のフレームを制限後の明るさで表示した場合の推定電流[mA]
+    limited : bool
+        直近のフレームで明るさを制限した
+    limited_frames : int
+        明るさを制限したフレーム数
+    '''
+
+    def __init__(self, num, max_current, led_current=20, idle_current=1, batch=False):
+        self.max_current = max_current
+        self.led_current = led_current
+        self.idle_current = idle_current
+        self.demand = 0.0
+        self.current = 0.0
+        self.limited = False
+        self.limited_frames = 0
+
+        self.__batch = batch
+        self.__num = num
+        # 明るさ1, R, G, Bの合計1あたりの電流[mA]
+        self.__unit_current = led_current / 255 / 255
+        self.__idle = idle_current * num
+        self.__units = None
+        self.__total = 0
+        # 色ごとのR, G, Bの合計 (列車・背景などの色の種類は少ない)
+        self.__color_units = {}
+        self.reset()
+
+    @classmethod
+    def from_config(cls, config, num, batch=False):
+        '''led_configのpowerから作成する (max_currentがない場合はNone)
+        '''
+        power = config.get("power") or {}
+        if not power.get("max_current"):
+            return None
+
+        return cls(num, power["max_current"], power.get("led_current", 20), power.get("idle_current", 1), batch)
+
+    def reset(self, frame=None):
+        '''LEDテープ全体の色を設定する
+
+        Parameters
+        ----------
+        frame : list of int or numpy.ndarray
+            LEDごとの色 (Color()). Noneの場合は全て消灯
+        '''
+        if frame is None:
+            self.__units = np.zeros(self.__num, dtype=np.int64) if self.__batch else [0] * self.__num
+            self.__total = 0
+        elif self.__batch:
+            self.__units = self.__array_units(np.asarray(frame))
+            self.__total = int(self.__units.sum())
+        else:
+            self.__units = [self.__pixel_units(color) for color in frame]
+            self.__total = sum(self.__units)
+
+    def update(self, indices, colors):
+        '''変化したLEDの色を設定する (一括描画用)
+
+        Parameters
+        ----------
+        indices : numpy.ndarray
+            LEDの番号
+        colors : numpy.ndarray
+            LEDの色 (Color())
+        '''
+        units = self.__array_units(colors)
+        self.__total += int(units.sum() - self.__units[indices].sum())
+        self.__units[indices] = units
+
+    def set(self, n, color):
+        '''1つのLEDの色を設定する
+
+        Parameters
+        ----------
+        n : int
+            LEDの番号
+        color : int
+            LEDの色 (Color())
+        '''
+        units = self.__pixel_units(color)
+        self.__total += units - self.__units[n]
+        self.__units[n] = units
+
+    def limit(self, brightness):
+        '''推定電流が上限を超えない明るさを求める
+
+        Parameters
+        ----------
+        brightness : int
+            設定の明るさ(0~255)
+
+        Returns
+        -------
+        brightness : int
+            制限後の明るさ(0~255)
+        '''
+        per_brightness = self.__total * self.__unit_current
+        self.demand = self.__idle + per_brightness * brightness
+
+        self.limited = self.demand > self.max_current and per_brightness > 0
+        if self.limited:
+            brightness = min(max(int((self.max_current - self.__idle) / per_brightness), 0), brightness)
+            self.limited_frames += 1
+        self.current = self.__idle + per_brightness * brightness
+
+        return brightness
+
+    def __pixel_units(self, color):
+        units = self.__color_units.get(color)
+        if units is None:
+            color = int(color)
+            units = ((color >> 16) & 0xff) + ((color >> 8) & 0xff) + (color & 0xff)
+            self.__color_units[color] = units
+        return units
+
+    @staticmethod
+    def __array_units(colors):
+        colors = colors.astype(np.int64)
+        return ((colors >> 16) & 0xff) + ((colors >> 8) & 0xff) + (colors & 0xff)
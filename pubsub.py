@@ -0,0 +1,690 @@
+import argparse
+import datetime
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import traceback
+
+from log import Log
+from decode import loads
+from poller import TrainSnapshot
+from backoff import CircuitBreaker
+
+
+# メッセージの長さ (ビッグエンディアン4byte) + json
+HEADER = struct.Struct(">I")
+# 1メッセージの最大サイズ[byte]
+MAX_MESSAGE = 8 << 20
+# 既定の配信ポート
+DEFAULT_PORT = 5800
+# 配信元が送信するハートビートの間隔[s]
+HEARTBEAT_INTERVAL = 5
+# 購読者の受信のタイムアウト[s]. 超えた場合は配信元が停止したとみなし，再接続する
+RECEIVE_TIMEOUT = HEARTBEAT_INTERVAL * 3
+
+
+def parse_address(address):
+    '''配信・購読先のアドレスを変換する
+
+    Parameters
+    ----------
+    address : str
+        "host:port", ":port"(127.0.0.1), "unix:/path/to/socket"
+
+    Returns
+    -------
+    family : int
+        socket.AF_INET or socket.AF_UNIX
+    address : tuple or str
+        socketに指定するアドレス
+    '''
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port) if port else DEFAULT_PORT)
+
+
+def send_message(sock, message):
+    '''メッセージを1件送信する
+    '''
+    body = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    sock.sendall(HEADER.pack(len(body)) + body)
+
+    return len(body) + HEADER.size
+
+
+def recv_message(sock, closed=None):
+    '''メッセージを1件受信する
+
+    Parameters
+    ----------
+    sock : socket.socket
+        接続
+    closed : threading.Event
+        指定した場合，タイムアウトしても受信途中のデータを保持して待ち続け，
+        closedが設定された場合のみsocket.timeoutを送出する (送信用のタイムアウトを設定した接続の受信)
+
+    Returns
+    -------
+    message : dict
+        受信したメッセージ. 接続が閉じられた場合はNone
+    '''
+    header = recv_exact(sock, HEADER.size, closed)
+    if header is None:
+        return None
+
+    length, = HEADER.unpack(header)
+    if length > MAX_MESSAGE:
+        raise ValueError(f"Message too large ({length} bytes)")
+
+    body = recv_exact(sock, length, closed)
+    if body is None:
+        return None
+
+    return loads(body)
+
+
+def recv_exact(sock, size, closed=None):
+    buf = bytearray()
+    while len(buf) < size:
+        try:
+            chunk = sock.recv(size - len(buf))
+        except socket.timeout:
+            # メッセージの途中で中断するとフレームがずれるため，接続を閉じるまで待ち続ける
+            if closed is None or closed.is_set():
+                raise
+            continue
+        if not chunk:
+            return None
+        buf += chunk
+
+    return bytes(buf)
+
+
+class SnapshotPublisher():
+    '''スナップショットの配信
+
+    取得したスナップショットを購読者(他のノードのmain.py)に送信する.
+    購読者ごとに表示路線のみを送り，2回目以降は前回から変化した路線のみ送る(差分)
+
+    プロトコル: 長さ(4byte) + jsonのメッセージ
+        購読者 -> 配信: {"type": "hello", "name", "lines"}, {"type": "ack", "version"}
+        配信 -> 購読者: {"type": "snapshot", "version", "base", "fetched_at", "next_fetch", "updated_at", "trains"},
+                        {"type": "heartbeat"} (HEARTBEAT_INTERVAL秒ごと)
+        (base: 差分の基準の版. 0の場合は全路線)
+
+    Parameters
+    ----------
+    source : TrainPoller
+        スナップショットの取得元
+    address : str
+        待ち受けるアドレス (parse_address()を参照). 他のノードから購読する場合は"0.0.0.0:port"
+    metrics : Metrics
+        購読者ごとの遅れの記録先 (Noneの場合は記録しない)
+
+    Attributes
+    ----------
+    address : tuple or str
+        待ち受けているアドレス
+    subscribers : dict
+        購読者名ごとの状態 (lines, version: 送信済みの版, acked: 受信確認済みの版)
+    sent_bytes : int
+        送信したメッセージの合計サイズ[byte]
+    '''
+
+    # 購読者の送信のタイムアウト[s]. 超えた購読者は切断する
+    SEND_TIMEOUT = 10
+
+    def __init__(self, source, address, metrics=None):
+        self.source = source
+        self.subscribers = {}
+        self.sent_bytes = 0
+
+        self.__metrics = metrics
+        self.__lock = threading.Lock()
+        self.__stopped = False
+        self.__connections = set()
+        # 版ごとの取得時刻 (受信確認までの遅れの計算用)
+        self.__fetched_at = {}
+        self.__compact = None
+
+        family, addr = parse_address(address)
+        if family == socket.AF_UNIX and os.path.exists(addr):
+            os.unlink(addr)
+        self.__server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.__server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.__server.bind(addr)
+        self.__server.listen(16)
+        self.__family = family
+        self.address = self.__server.getsockname()
+
+    def start(self):
+        '''接続の受け付けを開始する
+        '''
+        th = threading.Thread(target=self.__accept_thread)
+        th.setDaemon(True)
+        th.start()
+        Log.info(f"Publisher: Publishing snapshots on {self.address}")
+
+    def stop(self):
+        '''配信を停止し，全ての購読者を切断する
+        '''
+        self.__stopped = True
+        self.__server.close()
+        with self.__lock:
+            for conn in list(self.__connections):
+                self.__close(conn)
+        if self.__family == socket.AF_UNIX:
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+    def __accept_thread(self):
+        while not self.__stopped:
+            try:
+                conn, peer = self.__server.accept()
+            except OSError:
+                return
+
+            with self.__lock:
+                self.__connections.add(conn)
+            th = threading.Thread(target=self.__serve, args=(conn, peer or "unix"))
+            th.setDaemon(True)
+            th.start()
+
+    def __serve(self, conn, peer):
+        '''購読者1件への配信
+        '''
+        name = None
+        # 接続を閉じたことを配信・受信確認・ハートビートのスレッドで共有
+        closed = threading.Event()
+        # 配信とハートビートの送信が混ざらないよう，送信は1件ずつ
+        send_lock = threading.Lock()
+        try:
+            conn.settimeout(self.SEND_TIMEOUT)
+            hello = recv_message(conn)
+            if hello is None or hello.get("type") != "hello":
+                return
+
+            name = self.__register(hello, peer)
+            for target in (self.__ack_thread, self.__heartbeat_thread):
+                th = threading.Thread(target=target, args=(conn, name, closed, send_lock))
+                th.setDaemon(True)
+                th.start()
+
+            self.__publish_loop(conn, name, closed, send_lock)
+        except (OSError, ValueError) as e:
+            # 受信確認のスレッドが切断した場合(購読の解除)は出力しない
+            if not self.__stopped and not closed.is_set():
+                Log.warn(f"Publisher: Subscriber {name or peer} disconnected ({type(e).__name__}: {e}).",
+                         key=f"publisher-{name or peer}")
+        finally:
+            self.__disconnect(conn, name, closed)
+
+    def __register(self, hello, peer):
+        name = str(hello.get("name") or (f"{peer[0]}:{peer[1]}" if isinstance(peer, tuple) else peer))
+        lines = hello.get("lines") or None
+
+        with self.__lock:
+            # 同名の購読者は別の購読者として扱う
+            base, i = name, 1
+            while name in self.subscribers:
+                i += 1
+                name = f"{base}#{i}"
+            self.subscribers[name] = {"lines": lines, "version": 0, "acked": 0}
+        if self.__metrics is not None:
+            self.__metrics.subscribers.set(len(self.subscribers))
+
+        Log.info(f"Publisher: Subscribed {name}. Lines: {lines or 'all'}")
+
+        return name
+
+    def __publish_loop(self, conn, name, closed, send_lock):
+        '''新しいスナップショットごとに，前回から変化した路線を送信する
+        '''
+        state = self.subscribers[name]
+        sent = None
+        version = 0
+        missing = None
+
+        while not self.__stopped:
+            snapshot = self.source.wait_snapshot(version)
+            if snapshot is None or closed.is_set():
+                return
+
+            compact = self.__get_compact(snapshot)
+            lines = state["lines"] or list(compact["trains"])
+            trains = {line: compact["trains"][line] for line in lines if line in compact["trains"]}
+
+            if missing is None:
+                missing = [line for line in lines if line not in compact["trains"]]
+                if missing:
+                    Log.warn(f"Publisher: Lines {missing} requested by {name} are not fetched.")
+
+            # 初回は全路線, 2回目以降は変化した路線のみ
+            changed = trains if sent is None else {line: v for line, v in trains.items() if sent.get(line) != v}
+            with send_lock:
+                size = send_message(conn, {
+                    "type": "snapshot",
+                    "version": snapshot.version,
+                    "base": 0 if sent is None else version,
+                    "fetched_at": compact["fetched_at"],
+                    "next_fetch": compact["next_fetch"],
+                    "updated_at": {line: compact["updated_at"].get(line) for line in trains},
+                    "trains": changed,
+                })
+
+            sent = trains
+            version = snapshot.version
+            with self.__lock:
+                self.sent_bytes += size
+                state["version"] = version
+            if self.__metrics is not None:
+                self.__metrics.subscriber_version_lag.set(version - state["acked"], name)
+
+    def __ack_thread(self, conn, name, closed, send_lock):
+        '''購読者の受信確認から，取得から受信確認までの遅れを記録する
+        '''
+        conn_state = self.subscribers[name]
+        while True:
+            try:
+                # 送信用のタイムアウトではメッセージの途中で中断しない
+                message = recv_message(conn, closed)
+            except (OSError, ValueError):
+                message = None
+            # 購読者が切断した場合は，次のスナップショットを待たずに登録を解除
+            if message is None:
+                if not self.__stopped and not closed.is_set():
+                    Log.info(f"Publisher: Unsubscribed {name}.")
+                self.__disconnect(conn, name, closed)
+                return
+            if message.get("type") != "ack":
+                continue
+
+            version = message.get("version", 0)
+            conn_state["acked"] = version
+            fetched_at = self.__fetched_at.get(version)
+            if self.__metrics is not None:
+                if fetched_at is not None:
+                    self.__metrics.subscriber_lag.observe(time.time() - fetched_at, name)
+                self.__metrics.subscriber_version_lag.set(conn_state["version"] - version, name)
+
+    def __heartbeat_thread(self, conn, name, closed, send_lock):
+        '''スナップショットがない間も，配信元が動作中であることを購読者に通知する
+        '''
+        while not closed.wait(HEARTBEAT_INTERVAL):
+            try:
+                with send_lock:
+                    send_message(conn, {"type": "heartbeat"})
+            except (OSError, ValueError):
+                self.__disconnect(conn, name, closed)
+                return
+
+    def __get_compact(self, snapshot):
+        '''スナップショットの変換は版ごとに1回
+        '''
+        with self.__lock:
+            compact = self.__compact
+            if compact is None or compact["version"] != snapshot.version:
+                compact = self.__compact = snapshot.to_compact()
+                self.__fetched_at[snapshot.version] = snapshot.fetched_at
+                # 古い版の取得時刻は破棄
+                for v in [v for v in self.__fetched_at if v < snapshot.version - 16]:
+                    del self.__fetched_at[v]
+
+        return compact
+
+    def __disconnect(self, conn, name, closed):
+        '''購読者を切断し，登録を解除する (配信・受信確認・ハートビートのスレッドから呼ぶ)
+        '''
+        closed.set()
+        with self.__lock:
+            self.__close(conn)
+            if name is None or self.subscribers.pop(name, None) is None:
+                return
+        if self.__metrics is not None:
+            self.__metrics.subscriber_version_lag.remove(name)
+            self.__metrics.subscribers.set(len(self.subscribers))
+
+    def __close(self, conn):
+        self.__connections.discard(conn)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+
+
+class SnapshotSubscriber():
+    '''配信元(SnapshotPublisher)からのスナップショットの購読
+
+    TrainPollerと同じsubscribe(), start(), wait_snapshot(), latest(), stop()を持ち，
+    APIからの取得の代わりに使用する. 切断時は最後のスナップショットで描画を続け，再接続する
+
+    Parameters
+    ----------
+    address : str
+        配信元のアドレス (parse_address()を参照)
+    lines : list of str
+        購読する路線のlineCodeのリスト
+    name : str
+        配信元のログ・計測値に使用する購読者名. Noneの場合はホスト名
+    metrics : Metrics
+        受信の遅れの記録先 (Noneの場合は記録しない)
+
+    Attributes
+    ----------
+    lines : list of str
+        購読する路線のlineCodeのリスト
+    subscribers : int
+        スナップショットを参照するチャンネル数
+    fetch_count : int
+        受信したスナップショット数
+    connected : bool
+        配信元に接続中の場合はTrue
+    publisher_version : int
+        直近に受信した配信元の版
+    breaker : CircuitBreaker
+        再接続の間隔の制御
+    '''
+
+    def __init__(self, address, lines, name=None, metrics=None):
+        self.address = address
+        self.lines = list(lines)
+        self.name = name or socket.gethostname()
+        self.subscribers = 0
+        self.fetch_count = 0
+        self.connected = False
+        self.publisher_version = 0
+        self.breaker = CircuitBreaker(base=1, max_delay=30, threshold=10, cooldown=30)
+
+        self.__metrics = metrics
+        self.__snapshot = None
+        # 配信元の版とは別に通し番号を振る (配信元の再起動で版が戻るため)
+        self.__version = 0
+        self.__state = None
+        self.__stopped = False
+        self.__sock = None
+        self.__cond = threading.Condition()
+
+    def subscribe(self):
+        '''スナップショットを参照するチャンネルを登録する
+        '''
+        with self.__cond:
+            self.subscribers += 1
+
+    def start(self):
+        '''購読スレッドを開始する
+        '''
+        th = threading.Thread(target=self.__subscribe_thread)
+        th.setDaemon(True)
+        th.start()
+
+    def wait_snapshot(self, version=0):
+        '''"version"より新しいスナップショットを待つ
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            最新のスナップショット. 購読を停止した場合はNone
+        '''
+        with self.__cond:
+            while not self.__stopped and \
+                    (self.__snapshot is None or self.__snapshot.version <= version):
+                self.__cond.wait()
+
+            if self.__stopped:
+                return None
+            return self.__snapshot
+
+    def latest(self):
+        '''最新のスナップショットを待たずに取得する
+        '''
+        if self.__stopped:
+            return None
+        return self.__snapshot
+
+    def stop(self):
+        '''購読を停止し，待機中の描画スレッドに通知する
+        '''
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        sock = self.__sock
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __subscribe_thread(self):
+        while not self.__stopped:
+            try:
+                self.__receive()
+                if self.__stopped:
+                    return
+                raise ConnectionError("Closed by publisher")
+            except (OSError, ValueError) as e:
+                self.connected = False
+                if self.__stopped:
+                    return
+                delay = self.breaker.failure()
+                Log.warn(f"Subscriber: Disconnected from {self.address} ({type(e).__name__}: {e}). "
+                         f"Reconnect after {delay:.1f}s. Failures: {self.breaker.failures}",
+                         key="subscriber-disconnected")
+                time.sleep(delay)
+            except (KeyError, TypeError, AttributeError) as e:
+                # フレームは正しいが形式の誤ったメッセージ. 接続は__receive()で閉じているため再接続する
+                self.connected = False
+                if self.__stopped:
+                    return
+                delay = self.breaker.failure()
+                Log.warn(f"Subscriber: Malformed message from {self.address} ({type(e).__name__}: {e}). "
+                         f"Reconnect after {delay:.1f}s. Failures: {self.breaker.failures}",
+                         key="subscriber-malformed", traceback=traceback.format_exc())
+                time.sleep(delay)
+
+    def __receive(self):
+        '''配信元に接続し，切断されるまで受信する
+        '''
+        family, addr = parse_address(self.address)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(10)
+            sock.connect(addr)
+            # 配信元のハートビートが途絶えた場合(電源断・ネットワークの分断)はタイムアウトし，再接続する
+            sock.settimeout(RECEIVE_TIMEOUT)
+            self.__sock = sock
+            send_message(sock, {"type": "hello", "name": self.name, "lines": self.lines})
+
+            self.connected = True
+            self.breaker.success()
+            Log.info(f"Subscriber: Connected to {self.address}. Lines: {self.lines}")
+
+            while not self.__stopped:
+                try:
+                    message = recv_message(sock)
+                except socket.timeout:
+                    raise ConnectionError(f"No message from publisher for {RECEIVE_TIMEOUT}s")
+                if message is None:
+                    return
+                if message.get("type") != "snapshot":
+                    continue
+
+                self.__apply(message)
+                send_message(sock, {"type": "ack", "version": message["version"]})
+        finally:
+            self.__sock = None
+            sock.close()
+
+    def __apply(self, message):
+        '''全路線または差分を反映し，新しいスナップショットを作成する
+        '''
+        now = time.time()
+
+        if message["base"] == 0:
+            trains = message["trains"]
+        else:
+            if self.__state is None or message["base"] != self.publisher_version:
+                raise ValueError(f"Missing base version {message['base']}")
+            trains = dict(self.__state)
+            trains.update(message["trains"])
+
+        self.__state = trains
+        self.publisher_version = message["version"]
+        self.fetch_count += 1
+
+        snapshot = TrainSnapshot.from_compact({
+            "trains": {line: trains.get(line, []) for line in self.lines},
+            "fetched_at": message["fetched_at"],
+            "next_fetch": message["next_fetch"],
+            "updated_at": message["updated_at"],
+            "version": None,
+        }, self.__version + 1)
+
+        with self.__cond:
+            self.__version += 1
+            self.__snapshot = snapshot
+            self.__cond.notify_all()
+
+        if self.__metrics is not None:
+            self.__metrics.snapshot_lag.observe(max(now - message["fetched_at"], 0.0))
+        Log.debug(f"Subscriber: Received version {message['version']} "
+                  f"({'full' if message['base'] == 0 else 'delta'}, {len(message['trains'])} lines).")
+
+
+class StandInPoller():
+    '''試験用の配信元 (APIに接続しない)
+
+    駅テーブルから列車を作成し，一定間隔で停車・駅間を交互に進める.
+    TrainPollerと同じwait_snapshot(), latest()を持つ
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    lines : list of str
+        配信する路線のlineCodeのリスト
+    interval : float
+        列車を進める間隔[s]
+    trains_per_line : int
+        路線ごとの列車数
+    '''
+
+    def __init__(self, stations, lines, interval=10, trains_per_line=6):
+        self.lines = list(lines)
+        self.interval = interval
+        self.subscribers = 0
+
+        self.__snapshot = None
+        self.__stopped = False
+        self.__cond = threading.Condition()
+
+        # 路線ごとの駅順 (駅番号の昇順)
+        self.__orders = {}
+        for line in self.lines:
+            order = sorted((v, k) for k, v in stations[line].items() if v >= 0)
+            self.__orders[line] = [k for v, k in order]
+        self.__trains_per_line = trains_per_line
+
+    def subscribe(self):
+        self.subscribers += 1
+
+    def start(self):
+        th = threading.Thread(target=self.__poll_thread)
+        th.setDaemon(True)
+        th.start()
+
+    def wait_snapshot(self, version=0):
+        with self.__cond:
+            while not self.__stopped and \
+                    (self.__snapshot is None or self.__snapshot.version <= version):
+                self.__cond.wait()
+
+            if self.__stopped:
+                return None
+            return self.__snapshot
+
+    def latest(self):
+        if self.__stopped:
+            return None
+        return self.__snapshot
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+
+    def __poll_thread(self):
+        step = 0
+        while not self.__stopped:
+            now = time.time()
+            date = datetime.datetime.fromtimestamp(now).astimezone().replace(microsecond=0).isoformat()
+
+            trains = {}
+            for line in self.lines:
+                order = self.__orders[line]
+                # 停車(偶数)と駅間(奇数)を交互に, 上下線で列車を配置
+                states = (len(order) - 1) * 2
+                trains[line] = []
+                for i in range(self.__trains_per_line):
+                    pos = (step + i * states // self.__trains_per_line) % states
+                    k, running = divmod(pos, 2)
+                    if i % 2:
+                        from_sta, to_sta = order[-1 - k], order[-2 - k]
+                    else:
+                        from_sta, to_sta = order[k], order[k + 1]
+                    trains[line].append({
+                        "odpt:trainNumber": f"{line}{i:03d}",
+                        "odpt:fromStation": from_sta,
+                        "odpt:toStation": to_sta if running else None,
+                        "dc:date": date,
+                    })
+
+            version = self.__snapshot.version + 1 if self.__snapshot else 1
+            snapshot = TrainSnapshot(version, trains, now + self.interval)
+            with self.__cond:
+                self.__snapshot = snapshot
+                self.__cond.notify_all()
+            Log.info(f"StandIn: Published version {version}.")
+
+            step += 1
+            time.sleep(self.interval)
+
+
+if __name__ == "__main__":
+    # 試験用の配信元: python3 pubsub.py --address 127.0.0.1:5800
+    parser = argparse.ArgumentParser(description="試験用のスナップショットの配信元 (APIのアクセストークン不要)")
+    parser.add_argument("--address", action="store", default=f"127.0.0.1:{DEFAULT_PORT}", type=str,
+                        help=f"待ち受けるアドレス (host:port, unix:/path). Default: 127.0.0.1:{DEFAULT_PORT}")
+    parser.add_argument("--lines", action="store", nargs='*', type=str,
+                        default=["G", "M", "H", "T", "C", "Y", "Z", "N", "F", "A", "I", "S", "E"],
+                        help="配信する路線の路線記号. Default: 全路線")
+    parser.add_argument("-s", "--station-table", action="store", default="./data/station_table.json", type=str,
+                        help="駅番号の定義ファイル. Default: ./data/station_table.json")
+    parser.add_argument("--interval", action="store", default=10, type=float,
+                        help="列車を進める間隔(秒). Default: 10")
+    args = parser.parse_args()
+
+    with open(args.station_table, 'r') as f:
+        stations = json.load(f)
+
+    source = StandInPoller(stations, args.lines, args.interval)
+    publisher = SnapshotPublisher(source, args.address)
+    source.start()
+    publisher.start()
+
+    while 1:
+        try:
+            time.sleep(1)
+        except KeyboardInterrupt:
+            publisher.stop()
+            source.stop()
+            Log.flush()
+            break
@@ -0,0 +1,438 @@
+import multiprocessing
+import pickle
+import signal
+import struct
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+from log import Log
+from ledctrl import LEDCtrl
+from poller import TrainSnapshot
+from cache import intern_keys
+from metrics import Metrics, MetricsServer, StatsWriter
+from watcher import ConfigReloader
+from animation import WipeAnimation
+
+
+def encode_snapshot(snapshot):
+    '''描画に必要な項目のみの列車走行位置に変換する
+
+    Parameters
+    ----------
+    snapshot : TrainSnapshot
+        変換するスナップショット
+
+    Returns
+    -------
+    data : bytes
+        変換したスナップショット
+    '''
+    return pickle.dumps(snapshot.to_compact(), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def decode_snapshot(data):
+    '''encode_snapshot()で変換したスナップショットを復元する
+
+    Parameters
+    ----------
+    data : bytes
+        変換したスナップショット
+
+    Returns
+    -------
+    snapshot : TrainSnapshot
+        復元したスナップショット
+    '''
+    return TrainSnapshot.from_compact(pickle.loads(data))
+
+
+class SharedSnapshotWriter():
+    '''共有メモリへのスナップショットの書き込み (取得プロセス側)
+
+    共有メモリの形式: ヘッダ(シーケンス番号, 通し番号, 長さ, 停止フラグ) + スナップショット.
+    書き込み中はシーケンス番号を奇数とし，読み込み側は前後で番号が一致した場合のみ使用する
+
+    Parameters
+    ----------
+    size : int
+        スナップショットの最大サイズ[byte]
+
+    Attributes
+    ----------
+    name : str
+        共有メモリの名前 (SharedSnapshotReaderに渡す)
+    last_size : int
+        直近に書き込んだスナップショットのサイズ[byte]
+    '''
+
+    # シーケンス番号, 通し番号, 長さ, 停止フラグ
+    HEADER = struct.Struct("<QQIB")
+    OFFSET = 32
+
+    def __init__(self, size=1 << 20):
+        self.__shm = shared_memory.SharedMemory(create=True, size=self.OFFSET + size)
+        self.__shm.buf[:self.OFFSET] = bytes(self.OFFSET)
+        self.__capacity = size
+        self.__seq = 0
+        self.__lock = threading.Lock()
+
+        self.name = self.__shm.name
+        self.last_size = 0
+
+    def publish(self, snapshot):
+        '''スナップショットを書き込む
+
+        Parameters
+        ----------
+        snapshot : TrainSnapshot
+            書き込むスナップショット
+
+        Returns
+        -------
+        result : bool
+            サイズ超過で書き込めなかった場合はFalse
+        '''
+        data = encode_snapshot(snapshot)
+        if len(data) > self.__capacity:
+            Log.error(f"Render: Snapshot ({len(data)} bytes) exceeds shared memory ({self.__capacity} bytes).",
+                      key="render-overflow")
+            return False
+
+        with self.__lock:
+            self.__write(snapshot.version, data, False)
+        self.last_size = len(data)
+
+        return True
+
+    def stop(self):
+        '''描画プロセスに停止を通知する
+        '''
+        with self.__lock:
+            self.__write(0, b"", True)
+
+    def close(self):
+        '''共有メモリを解放する
+        '''
+        self.__shm.close()
+        self.__shm.unlink()
+
+    def __write(self, version, data, stopped):
+        buf = self.__shm.buf
+        self.__seq += 1
+        struct.pack_into("<Q", buf, 0, self.__seq)
+        buf[self.OFFSET:self.OFFSET + len(data)] = data
+        struct.pack_into("<QIB", buf, 8, version, len(data), stopped)
+        self.__seq += 1
+        struct.pack_into("<Q", buf, 0, self.__seq)
+
+
+class SharedSnapshotReader():
+    '''共有メモリからのスナップショットの読み込み (描画プロセス側)
+
+    TrainPollerと同じwait_snapshot(), latest()を持ち，LEDCtrl.run_strip()の取得元に指定できる.
+    latest()は通し番号が変わった場合のみ復元するため，毎フレーム呼び出してよい
+
+    Parameters
+    ----------
+    name : str
+        SharedSnapshotWriterの共有メモリの名前
+
+    Attributes
+    ----------
+    decode_time : float
+        直近のスナップショットの復元時間[s]
+    '''
+
+    # 新しいスナップショットを待つ間隔[s]
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, name):
+        # 共有メモリは取得プロセスが解放する (spawnした描画プロセスはresource_trackerを共有)
+        self.__shm = shared_memory.SharedMemory(name=name)
+
+        self.__version = None
+        self.__snapshot = None
+        self.__stopped = False
+        self.__lock = threading.Lock()
+
+        self.decode_time = 0.0
+
+    def wait_snapshot(self, version=0):
+        '''"version"より新しいスナップショットを待つ
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            最新のスナップショット. 停止した場合はNone
+        '''
+        while True:
+            snapshot = self.latest()
+            if self.__stopped:
+                return None
+            if snapshot is not None and snapshot.version > version:
+                return snapshot
+            time.sleep(self.POLL_INTERVAL)
+
+    def latest(self):
+        '''最新のスナップショットを待たずに取得する
+
+        Returns
+        -------
+        snapshot : TrainSnapshot
+            最新のスナップショット. 停止した場合はNone
+        '''
+        if self.__stopped:
+            return None
+
+        with self.__lock:
+            self.__read()
+            return None if self.__stopped else self.__snapshot
+
+    def stop(self):
+        '''読み込みを停止する (描画プロセス内からの停止)
+        '''
+        self.__stopped = True
+
+    def close(self):
+        self.__shm.close()
+
+    def __read(self):
+        buf = self.__shm.buf
+        header = SharedSnapshotWriter.HEADER
+        offset = SharedSnapshotWriter.OFFSET
+
+        while True:
+            seq, version, length, stopped = header.unpack_from(buf, 0)
+            # 書き込み中
+            if seq & 1:
+                time.sleep(0.0005)
+                continue
+
+            if stopped:
+                self.__stopped = True
+                return
+            if seq == 0 or version == self.__version:
+                return
+
+            data = bytes(buf[offset:offset + length])
+            if struct.unpack_from("<Q", buf, 0)[0] != seq:
+                # 読み込み中に書き換えられた場合は読み直す
+                continue
+
+            start = time.perf_counter()
+            self.__snapshot = decode_snapshot(data)
+            self.decode_time = time.perf_counter() - start
+            self.__version = version
+            return
+
+
+def intern_runtimes(runtimes):
+    '''駅間の所要時間の駅名をinternする (プロセス間で受け渡した場合)
+    '''
+    intern = sys.intern
+    return {intern(line): {(intern(f), intern(t)): v for (f, t), v in table.items()}
+            for line, table in runtimes.items()}
+
+
+def create_leds(stations, lines, update_freq, jsonpath, backend="ws281x", sim_dump=None, metrics=None,
+                runtimes=None):
+    '''Channelごとに表示路線のLEDテープをセットアップする
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    lines : list of list of str
+        Channelごとの表示路線のlineCodeのリスト
+    update_freq : int
+        データの更新間隔
+    jsonpath : str
+        led_config.jsonのパス
+    backend : str
+        LEDテープの出力先 ("ws281x", "sim")
+    sim_dump : str
+        シミュレータのフレームを書き出すファイルのパス (Channelごとに末尾に番号を付加)
+    metrics : Metrics
+        描画の計測値の記録先
+    runtimes : dict
+        ODPT.get_runtimes()で得た駅間の所要時間
+
+    Returns
+    -------
+    leds : list of LEDCtrl
+        ChannelごとのLED制御. 表示路線がないChannelは[]
+    '''
+    leds = []
+    for i in range(len(lines)):
+        if lines[i] == []:
+            leds.append([])
+            continue
+        backend_options = {}
+        if backend == "sim":
+            # 常駐時にメモリを消費しないよう，フレームはファイルにのみ書き出す
+            backend_options = {"record": False,
+                               "dumppath": f"{sim_dump}.{i}" if sim_dump else None}
+        led = LEDCtrl(stations, lines[i], i, update_freq, jsonpath,
+                      backend=backend, backend_options=backend_options, metrics=metrics, runtimes=runtimes)
+        led.setup_strip()
+        leds.append(led)
+
+    return leds
+
+
+def render_main(name, stations, lines, update_freq, options):
+    '''描画プロセスのエントリポイント
+
+    Parameters
+    ----------
+    name : str
+        SharedSnapshotWriterの共有メモリの名前
+    stations : dict
+        路線ごとの駅テーブル
+    lines : list of list of str
+        Channelごとの表示路線のlineCodeのリスト
+    update_freq : int
+        データの更新間隔
+    options : dict
+        led_config, backend, sim_dump, animation, animation_duration, log_level, log_format, metrics_port, stats_file,
+        stats_interval, runtimes, station_table, reload_interval
+    '''
+    Log.configure(options["log_level"], options["log_format"])
+
+    # SIGTERM(systemdの停止)でもLEDを消灯して終了する
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+
+    metrics = Metrics()
+    server = MetricsServer(metrics, options["metrics_port"]) if options["metrics_port"] is not None else None
+    stats = StatsWriter(metrics, options["stats_file"], options["stats_interval"]) if options["stats_file"] else None
+    if server:
+        server.start()
+    if stats:
+        stats.start()
+
+    reader = SharedSnapshotReader(name)
+    leds = create_leds(intern_keys(stations), lines, update_freq, options["led_config"],
+                       options["backend"], options["sim_dump"], metrics, intern_runtimes(options["runtimes"]))
+    Log.info(f"Render: Setuped LED strips in render process!")
+
+    # 設定ファイルの変更は描画プロセスで反映
+    reloader = None
+    if options["reload_interval"] > 0:
+        reloader = ConfigReloader(leds, options["led_config"], options["station_table"],
+                                  interval=options["reload_interval"])
+        reloader.start()
+
+    threads = []
+    try:
+        # 起動時のアニメーション (取得プロセスは初回の取得を並行して行う)
+        if options["animation"]:
+            WipeAnimation(leds, options["animation"], options["animation_duration"]).run()
+
+        for led in leds:
+            if not led:
+                continue
+            th = threading.Thread(target=led.run_strip, args=(reader, led.log_update))
+            th.setDaemon(True)
+            th.start()
+            threads.append(th)
+            Log.info(f"Strip{led.channel}: Started real-time display in render process!")
+
+        while any(th.is_alive() for th in threads):
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 描画を止めてから消灯
+        if reloader:
+            reloader.stop()
+        reader.stop()
+        for th in threads:
+            th.join(1)
+        for led in leds:
+            if led:
+                led.clear_strip()
+                led.strip.close()
+                Log.info(f"Strip{led.channel}: Stopped LEDs.")
+        if stats:
+            stats.stop()
+        reader.close()
+        Log.flush()
+
+
+class RenderProcess():
+    '''描画専用のプロセス
+
+    取得・デコードを行うプロセスとGILを共有しないよう，LEDテープの描画を別プロセスで行う.
+    スナップショットは共有メモリ(SharedSnapshotWriter)で受け渡す
+
+    Parameters
+    ----------
+    stations : dict
+        路線ごとの駅テーブル
+    lines : list of list of str
+        Channelごとの表示路線のlineCodeのリスト
+    update_freq : int
+        データの更新間隔
+    options : dict
+        render_main()のオプション
+    size : int
+        共有メモリのスナップショットの最大サイズ[byte]
+
+    Attributes
+    ----------
+    writer : SharedSnapshotWriter
+        スナップショットの書き込み先
+    '''
+
+    def __init__(self, stations, lines, update_freq, options, size=1 << 20):
+        self.writer = SharedSnapshotWriter(size)
+
+        # 取得スレッド等を複製しないよう，spawnで新しいインタプリタを起動
+        ctx = multiprocessing.get_context("spawn")
+        self.__process = ctx.Process(
+            target=render_main, name="metroled-render",
+            args=(self.writer.name, stations, lines, update_freq, options))
+
+    def start(self, poller):
+        '''描画プロセスと，スナップショットを共有メモリに書き込むスレッドを開始する
+
+        Parameters
+        ----------
+        poller : TrainPoller
+            スナップショットの取得元
+        '''
+        self.__process.start()
+        Log.info(f"Render: Started render process (pid {self.__process.pid}).")
+
+        th = threading.Thread(target=self.__relay_thread, args=(poller, ))
+        th.setDaemon(True)
+        th.start()
+
+    def stop(self, timeout=5):
+        '''描画プロセスを停止し，共有メモリを解放する
+        '''
+        self.writer.stop()
+        self.__process.join(timeout)
+        if self.__process.is_alive():
+            Log.warn(f"Render: Render process did not stop. Terminate.")
+            self.__process.terminate()
+            self.__process.join(timeout)
+        self.writer.close()
+
+    def is_alive(self):
+        return self.__process.is_alive()
+
+    def __relay_thread(self, poller):
+        version = 0
+        while True:
+            snapshot = poller.wait_snapshot(version)
+            if snapshot is None:
+                Log.error(f"Render: Poller stopped. Press Ctrl + C to terminate the main thread.")
+                return False
+            self.writer.publish(snapshot)
+            version = snapshot.version
+            Log.debug(f"Render: Published snapshot {version} ({self.writer.last_size / 1024:.1f}KB).")
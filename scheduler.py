@@ -0,0 +1,211 @@
+import datetime
+import time
+from functools import lru_cache
+
+
+@lru_cache(maxsize=4096)
+def parse_date(date):
+    '''ISO8601形式の日時をUNIX時間に変換する
+
+    Parameters
+    ----------
+    date : str
+        dc:date, dc:validなどの日時 (例: "2020-01-01T12:00:00+09:00")
+
+    Returns
+    -------
+    timestamp : float
+        UNIX時間. 変換できない場合はNone
+    '''
+    try:
+        return datetime.datetime.fromisoformat(date).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler():
+    '''dc:valid, odpt:frequencyに基づく取得タイミングの計画
+
+    データの次回公開予定時刻の直後に取得するよう，次回の取得時刻を決める
+
+    Parameters
+    ----------
+    update_freq : int
+        既定の取得間隔. 最短の取得間隔としても用いる
+    margin : float
+        公開予定時刻から取得までの余裕[s]
+
+    Attributes
+    ----------
+    next_fetch : float
+        次回の取得時刻 (UNIX時間)
+    interval : float
+        前回の取得から次回の取得までの間隔[s]
+    publish_freq : float
+        データの更新間隔(odpt:frequency)[s]. 不明な場合はNone
+    jitter : float
+        直近の待機の予定時刻からの遅れ[s] (取得スレッドの起床のずれ)
+    '''
+
+    def __init__(self, update_freq, margin=2):
+        self.update_freq = update_freq
+        self.margin = margin
+        self.max_interval = update_freq * 3
+
+        self.next_fetch = time.time()
+        self.interval = update_freq
+        self.publish_freq = None
+        self.jitter = 0.0
+
+    def plan(self, trains, fetched_at):
+        '''取得したデータから次回の取得時刻を決める
+
+        Parameters
+        ----------
+        trains : list of list of dict
+            ODPT.get_lines_train()で得た列車走行位置情報
+        fetched_at : float
+            取得時刻 (UNIX時間)
+
+        Returns
+        -------
+        next_fetch : float
+            次回の取得時刻 (UNIX時間)
+        '''
+        publish = None
+        freq = None
+
+        for line_trains in trains:
+            for train in line_trains:
+                f = train.get("odpt:frequency")
+                if f:
+                    freq = f if freq is None else min(freq, f)
+
+                # 公開予定時刻: dc:valid, なければdc:date + odpt:frequency
+                valid = parse_date(train.get("dc:valid"))
+                if valid is None and f:
+                    date = parse_date(train.get("dc:date"))
+                    valid = date + f if date is not None else None
+
+                if valid is not None and valid > fetched_at:
+                    publish = valid if publish is None else min(publish, valid)
+
+        self.publish_freq = freq
+
+        # 公開予定が不明な場合は既定の間隔
+        if publish is None:
+            next_fetch = fetched_at + self.update_freq
+        else:
+            next_fetch = publish + self.margin
+            # 最短間隔より短い場合は，その次の公開予定まで待つ
+            while next_fetch - fetched_at < self.update_freq:
+                next_fetch += freq if freq else self.update_freq
+
+            if next_fetch - fetched_at > self.max_interval:
+                next_fetch = fetched_at + self.update_freq
+
+        self.interval = next_fetch - fetched_at
+        self.next_fetch = next_fetch
+
+        return next_fetch
+
+    def wait(self):
+        '''次回の取得時刻まで待機する
+        '''
+        time.sleep(max(self.next_fetch - time.time(), 0))
+        self.jitter = max(time.time() - self.next_fetch, 0.0)
+
+
+class FrameScheduler():
+    '''単調時計による固定フレームレートの描画タイミング
+
+    描画に要した時間を差し引いて待機し，遅延した場合は間に合わなかったフレームを破棄する
+
+    Parameters
+    ----------
+    frame_rate : float
+        目標フレームレート[fps]
+
+    Attributes
+    ----------
+    frame_rate : float
+        目標フレームレート[fps]
+    achieved_rate : float
+        実際のフレームレート[fps] (指数移動平均)
+    lateness : float
+        直近のフレームの予定時刻からの遅れ[s]
+    dropped_frames : int
+        遅延により破棄したフレーム数
+    jitter : float
+        フレーム間隔の目標からのずれ[s] (指数移動平均)
+    interval_error : float
+        直近のフレーム間隔の目標からのずれ[s]
+    '''
+
+    # 実フレームレートの平滑化係数
+    SMOOTHING = 0.1
+
+    def __init__(self, frame_rate):
+        self.frame_rate = frame_rate
+        self.__interval = 1 / frame_rate
+
+        self.achieved_rate = 0.0
+        self.lateness = 0.0
+        self.dropped_frames = 0
+        self.jitter = 0.0
+        self.interval_error = 0.0
+
+        self.__next = None
+        self.__last = None
+
+    def start(self):
+        '''フレームの基準時刻を現在時刻に設定する
+
+        Returns
+        -------
+        now : float
+            基準時刻 (time.monotonic())
+        '''
+        now = time.monotonic()
+        self.__next = now
+        self.__last = None
+        return now
+
+    def wait(self):
+        '''次のフレームの予定時刻まで待機する
+
+        Returns
+        -------
+        now : float
+            待機後の時刻 (time.monotonic())
+        '''
+        if self.__next is None:
+            self.start()
+
+        self.__next += self.__interval
+        now = time.monotonic()
+        if now < self.__next:
+            time.sleep(self.__next - now)
+            now = time.monotonic()
+
+        self.lateness = max(now - self.__next, 0.0)
+
+        # 1フレーム以上遅れた場合は，間に合わなかったフレームを破棄
+        missed = int(self.lateness // self.__interval)
+        if missed > 0:
+            self.dropped_frames += missed
+            self.__next += missed * self.__interval
+
+        # 実フレームレート, フレーム間隔のずれ
+        if self.__last is not None and now > self.__last:
+            rate = 1 / (now - self.__last)
+            self.interval_error = abs((now - self.__last) - self.__interval * (missed + 1))
+            if self.achieved_rate == 0.0:
+                self.achieved_rate = rate
+                self.jitter = self.interval_error
+            else:
+                self.achieved_rate += (rate - self.achieved_rate) * self.SMOOTHING
+                self.jitter += (self.interval_error - self.jitter) * self.SMOOTHING
+        self.__last = now
+
+        return now
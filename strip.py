@@ -0,0 +1,300 @@
+import struct
+import time
+from abc import ABC, abstractmethod
+
+
+def Color(red, green, blue, white=0):
+    '''(R, G, B)をLEDテープの24bitの色に変換する (rpi_ws281x.Colorと同じ形式)
+    '''
+    return (white << 24) | (red << 16) | (green << 8) | blue
+
+
+class ColorCorrection():
+    '''LEDテープの種類ごとのガンマ補正・ホワイトバランス
+
+    R, G, Bごとに0~255の変換表を作成し，色を作成するときに1回だけ変換する
+
+    Parameters
+    ----------
+    gamma : float
+        ガンマ値 (1.0: 補正しない)
+    white_balance : list of float
+        R, G, Bごとの倍率(0~1)
+    '''
+
+    def __init__(self, gamma=1.0, white_balance=(1.0, 1.0, 1.0)):
+        self.gamma = gamma
+        self.white_balance = list(white_balance)
+        self.luts = [[min(round(255 * (v / 255) ** gamma * scale), 255) for v in range(256)]
+                     for scale in self.white_balance]
+
+    @classmethod
+    def from_config(cls, config):
+        '''led_configのcolor_correctionから作成する (ない場合は補正しない)
+        '''
+        correction = config.get("color_correction", {})
+        return cls(correction.get("gamma", 1.0), correction.get("white_balance", (1.0, 1.0, 1.0)))
+
+    def color(self, rgb, level=1.0):
+        '''(R, G, B)を補正してLEDテープの24bitの色に変換する
+
+        Parameters
+        ----------
+        rgb : list of int
+            設定ファイルの色(R, G, B)
+        level : float
+            補正前に掛ける明るさの倍率 (Wipe・データが古い路線の色)
+        '''
+        return Color(*[lut[int(x * level)] for lut, x in zip(self.luts, rgb)])
+
+
+class StripBackend(ABC):
+    '''LEDテープの出力先
+
+    rpi_ws281x.Adafruit_NeoPixelと同じメソッドを持つ.
+    show(), setPixelColor(), getPixelColor()を実装しないサブクラスは作成時にTypeErrorとなる
+
+    Parameters
+    ----------
+    num : int
+        LEDのドット数
+    brightness : int
+        LEDの明るさ(0~255)
+    '''
+
+    def __init__(self, num, brightness):
+        self.num = num
+        self.brightness = brightness
+
+    def begin(self):
+        pass
+
+    @abstractmethod
+    def show(self):
+        pass
+
+    def numPixels(self):
+        return self.num
+
+    @abstractmethod
+    def setPixelColor(self, n, color):
+        pass
+
+    @abstractmethod
+    def getPixelColor(self, n):
+        pass
+
+    def setBrightness(self, brightness):
+        self.brightness = brightness
+
+    def close(self):
+        pass
+
+    def set_pixels(self, indices, colors):
+        '''複数のLEDの色を設定する
+
+        Parameters
+        ----------
+        indices : sequence of int
+            LEDの番号
+        colors : sequence of int
+            LEDの色 (Color())
+        '''
+        for n, color in zip(indices, colors):
+            self.setPixelColor(int(n), int(color))
+
+    def __setitem__(self, pos, value):
+        if isinstance(pos, slice):
+            for i, n in enumerate(range(*pos.indices(self.num))):
+                self.setPixelColor(n, value[i])
+        else:
+            self.setPixelColor(pos, value)
+
+
+class WS281xStrip(StripBackend):
+    '''rpi_ws281xによるLEDテープ (Raspberry PiのPWM)
+
+    Parameters
+    ----------
+    num : int
+        LEDのドット数
+    brightness : int
+        LEDの明るさ(0~255)
+    channel : int
+        PWMのChannel (0 or 1)
+    '''
+
+    # PWM Channelごとの出力GPIO
+    GPIO = {0: 12, 1: 13}
+
+    FREQ_HZ = 800000
+    DMA = 10
+    INVERT = False
+
+    def __init__(self, num, brightness, channel):
+        super().__init__(num, brightness)
+
+        from rpi_ws281x import Adafruit_NeoPixel
+
+        self.__strip = Adafruit_NeoPixel(
+            num, self.GPIO[channel], self.FREQ_HZ,
+            self.DMA, self.INVERT, brightness, channel)
+
+    def begin(self):
+        self.__strip.begin()
+
+    def show(self):
+        self.__strip.show()
+
+    def setPixelColor(self, n, color):
+        self.__strip.setPixelColor(n, color)
+
+    def getPixelColor(self, n):
+        return self.__strip.getPixelColor(n)
+
+    def setBrightness(self, brightness):
+        super().setBrightness(brightness)
+        self.__strip.setBrightness(brightness)
+
+    def __setitem__(self, pos, value):
+        # rpi_ws281xはPythonのintのみ受け付けるため，NumPyの配列(一括描画のフレーム)は変換する
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        # rpi_ws281xのスライス代入で一括設定
+        self.__strip[pos] = value
+
+
+class SimStrip(StripBackend):
+    '''NumPyのフレームバッファによるLEDテープのシミュレータ
+
+    show()ごとのフレームを時刻とともに記録する. ハードウェアなしで描画の検証・計測に使用する
+
+    Parameters
+    ----------
+    num : int
+        LEDのドット数
+    brightness : int
+        LEDの明るさ(0~255)
+    record : bool
+        フレームをメモリに記録する
+    dumppath : str
+        フレームを書き出すバイナリファイルのパス (Noneの場合は書き出さない)
+
+    Attributes
+    ----------
+    pixels : numpy.ndarray
+        LEDごとの色 (uint32)
+    frames : list of (float, numpy.ndarray)
+        show()ごとの時刻(time.time())とフレーム
+    show_count : int
+        show()の呼び出し回数
+    '''
+
+    # ダンプファイルの形式: ヘッダ(識別子, バージョン, ドット数) + フレーム(時刻, 色 x ドット数)
+    MAGIC = b"MLED"
+    VERSION = 1
+    HEADER = struct.Struct("<4sBI")
+    TIMESTAMP = struct.Struct("<d")
+
+    def __init__(self, num, brightness=255, record=True, dumppath=None):
+        super().__init__(num, brightness)
+
+        import numpy as np
+
+        self.pixels = np.zeros(num, dtype=np.uint32)
+        self.record = record
+        self.frames = []
+        self.show_count = 0
+
+        self.__dump = None
+        if dumppath:
+            self.__dump = open(dumppath, 'wb')
+            self.__dump.write(self.HEADER.pack(self.MAGIC, self.VERSION, num))
+
+    def show(self):
+        self.show_count += 1
+        now = time.time()
+
+        if self.record:
+            self.frames.append((now, self.pixels.copy()))
+
+        if self.__dump:
+            self.__dump.write(self.TIMESTAMP.pack(now))
+            self.__dump.write(self.pixels.astype("<u4").tobytes())
+
+    def setPixelColor(self, n, color):
+        self.pixels[n] = color
+
+    def getPixelColor(self, n):
+        return int(self.pixels[n])
+
+    def __setitem__(self, pos, value):
+        self.pixels[pos] = value
+
+    def set_pixels(self, indices, colors):
+        self.pixels[indices] = colors
+
+    def close(self):
+        '''ダンプファイルを閉じる
+        '''
+        if self.__dump:
+            self.__dump.close()
+            self.__dump = None
+
+    @classmethod
+    def read_dump(cls, dumppath):
+        '''ダンプファイルからフレームを順に読み込む
+
+        Parameters
+        ----------
+        dumppath : str
+            SimStripで書き出したバイナリファイルのパス
+
+        Yields
+        ------
+        frame : (float, numpy.ndarray)
+            時刻(time.time())とフレーム
+        '''
+        import numpy as np
+
+        with open(dumppath, 'rb') as f:
+            magic, version, num = cls.HEADER.unpack(f.read(cls.HEADER.size))
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError(f"{dumppath} is not a strip dump file")
+
+            size = num * 4
+            while True:
+                ts = f.read(cls.TIMESTAMP.size)
+                data = f.read(size)
+                if len(ts) < cls.TIMESTAMP.size or len(data) < size:
+                    return
+                yield cls.TIMESTAMP.unpack(ts)[0], np.frombuffer(data, dtype="<u4")
+
+
+def create_strip(backend, num, brightness, channel, **options):
+    '''LEDテープの出力先を作成する
+
+    Parameters
+    ----------
+    backend : str
+        "ws281x": rpi_ws281x, "sim": シミュレータ
+    num : int
+        LEDのドット数
+    brightness : int
+        LEDの明るさ(0~255)
+    channel : int
+        PWMのChannel (0 or 1)
+    options : dict
+        SimStripのオプション (record, dumppath)
+
+    Returns
+    -------
+    strip : StripBackend
+        LEDテープの出力先
+    '''
+    if backend == "ws281x":
+        return WS281xStrip(num, brightness, channel)
+    elif backend == "sim":
+        return SimStrip(num, brightness, **options)
+    else:
+        raise ValueError(f"Unknown strip backend: {backend}")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# モジュールはリポジトリ直下に置かれているため，テストから読み込めるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
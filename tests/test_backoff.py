@@ -0,0 +1,67 @@
+import random
+
+from backoff import CircuitBreaker
+
+
+def breaker(**kwargs):
+    options = {"base": 2, "max_delay": 16, "threshold": 4, "cooldown": 60, "jitter": 5, "rnd": random.Random(0)}
+    options.update(kwargs)
+    return CircuitBreaker(**options)
+
+
+def test_backoff_doubles_with_jitter():
+    b = breaker()
+
+    for failures, delay in zip(range(1, 4), (2, 4, 8)):
+        d = b.failure(now=0)
+        assert delay / 2 <= d <= delay
+        assert b.failures == failures
+        assert b.state == "closed"
+
+
+def test_backoff_is_capped():
+    b = breaker(threshold=100)
+
+    delays = [b.failure(now=0) for _ in range(10)]
+    assert max(delays) <= 16
+
+
+def test_opens_after_threshold_for_at_least_cooldown():
+    b = breaker()
+    for _ in range(3):
+        b.failure(now=0)
+
+    delay = b.failure(now=100)
+    assert b.state == "open"
+    assert 60 <= delay <= 65
+    assert not b.allow(now=100 + 59.9)
+
+
+def test_half_open_after_cooldown():
+    b = breaker(threshold=1)
+    delay = b.failure(now=0)
+
+    assert b.allow(now=delay)
+    assert b.state == "half_open"
+
+
+def test_half_open_failure_reopens():
+    b = breaker(threshold=1)
+    delay = b.failure(now=0)
+    b.allow(now=delay)
+
+    again = b.failure(now=delay)
+    assert b.state == "open"
+    assert again >= 60
+    assert not b.allow(now=delay + 1)
+
+
+def test_success_closes():
+    b = breaker(threshold=1)
+    delay = b.failure(now=0)
+    b.allow(now=delay)
+    b.success()
+
+    assert b.state == "closed"
+    assert b.failures == 0
+    assert b.allow(now=0)
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+
+import pytest
+
+from cache import ArtifactCache, TTLCache, write_json
+
+
+class Builder():
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        with open(self.path, 'r') as f:
+            return {"value": json.load(f), "calls": self.calls}
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = str(tmp_path / "source.json")
+    write_json(path, [1, 2, 3])
+    return path
+
+
+def test_reuses_until_source_changes(tmp_path, source):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    build = Builder(source)
+
+    assert cache.load("a", [source], build) == {"value": [1, 2, 3], "calls": 1}
+    assert cache.load("a", [source], build)["calls"] == 1
+    # 別のインスタンス(次回起動時)も保存したデータを使用する
+    assert ArtifactCache(str(tmp_path / "cache")).load("a", [source], build)["calls"] == 1
+
+    write_json(source, [4, 5])
+    assert cache.load("a", [source], build) == {"value": [4, 5], "calls": 2}
+    assert cache.hits == 1
+    assert cache.misses == 2
+
+
+def test_reuses_if_only_mtime_changes(tmp_path, source):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    build = Builder(source)
+    cache.load("a", [source], build)
+
+    st = os.stat(source)
+    os.utime(source, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert cache.load("a", [source], build)["calls"] == 1
+
+
+def test_rebuilds_if_key_changes(tmp_path, source):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    build = Builder(source)
+    cache.load("a", [source], build, key=("G", "M"))
+
+    assert cache.load("a", [source], build, key=("G", "M"))["calls"] == 1
+    assert cache.load("a", [source], build, key=("G",))["calls"] == 2
+
+
+def test_rebuilds_broken_entry(tmp_path, source):
+    cache = ArtifactCache(str(tmp_path / "cache"))
+    build = Builder(source)
+    cache.load("a", [source], build)
+
+    with open(tmp_path / "cache" / "a.json", 'w') as f:
+        f.write("{broken")
+    assert cache.load("a", [source], build)["calls"] == 2
+
+
+def test_ttl_uses_saved_data_within_ttl(tmp_path):
+    cache = TTLCache(str(tmp_path), ttl=60)
+    fetched = []
+
+    def fetch():
+        fetched.append(1)
+        return {"n": len(fetched)}
+
+    assert cache.load("a", fetch) == {"n": 1}
+    assert cache.load("a", fetch) == {"n": 1}
+
+    write_json(str(tmp_path / "a.json"), {"fetched_at": time.time() - 120, "data": {"n": 1}})
+    assert cache.load("a", fetch) == {"n": 2}
+
+
+def test_ttl_falls_back_to_expired_data(tmp_path):
+    cache = TTLCache(str(tmp_path), ttl=60)
+    write_json(str(tmp_path / "a.json"), {"fetched_at": time.time() - 120, "data": {"n": 1}})
+
+    def fail():
+        raise ConnectionError("unreachable")
+
+    assert cache.load("a", fail) == {"n": 1}
+
+
+def test_ttl_raises_without_saved_data(tmp_path):
+    cache = TTLCache(str(tmp_path), ttl=60)
+
+    def fail():
+        raise ConnectionError("unreachable")
+
+    with pytest.raises(ConnectionError):
+        cache.load("a", fail)
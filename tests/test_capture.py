@@ -0,0 +1,96 @@
+import gzip
+import json
+
+from capture import CaptureWriter, ReplaySource, read_capture, read_cycles
+
+
+def write(path, records):
+    writer = CaptureWriter(path)
+    for service, key, body, cycle, t in records:
+        writer.write(service, key, body, cycle, t)
+    writer.close()
+
+
+def test_groups_records_by_cycle(tmp_path):
+    path = str(tmp_path / "capture.jsonl.gz")
+    write(path, [
+        ("odpt", "A", b"[]", 1, 10.0),
+        ("metro", "G", b"[]", 1, 10.5),
+        ("odpt", "A", b"[1]", 2, 40.0),
+        ("odpt", "A", b"[2]", 3, 70.0),
+        ("metro", "Trains", b"[3]", 3, 70.2),
+    ])
+
+    cycles = list(read_cycles(path))
+    assert [[r["cycle"] for r in records] for records in cycles] == [[1, 1], [2], [3, 3]]
+    assert [r["key"] for r in cycles[2]] == ["A", "Trains"]
+    assert cycles[1][0]["body"] == "[1]"
+
+
+def test_stops_at_unfinished_record(tmp_path):
+    path = str(tmp_path / "capture.jsonl.gz")
+    write(path, [("odpt", "A", b"[]", 1, 10.0)])
+    # 記録途中の行 (改行なし)
+    with gzip.open(path, 'ab') as f:
+        f.write(b'{"t": 11.0, "cycle": 2')
+
+    assert [r["cycle"] for r in read_capture(path)] == [1]
+
+
+def test_reads_file_being_written(tmp_path):
+    path = str(tmp_path / "capture.jsonl.gz")
+    writer = CaptureWriter(path)
+    writer.write("odpt", "A", b"[]", 1, 10.0)
+    writer.write("odpt", "A", b"[]", 2, 40.0)
+
+    try:
+        assert [len(records) for records in read_cycles(path)] == [1, 1]
+    finally:
+        writer.close()
+
+
+def body(*trains):
+    return json.dumps([{"odpt:railway": railway, "odpt:trainNumber": number} for railway, number in trains]).encode()
+
+
+def numbers(replay, service, key="Trains"):
+    return sorted(t["odpt:trainNumber"] for t in replay.response(service, key).json())
+
+
+def test_replay_prefers_newer_line_records(tmp_path):
+    path = str(tmp_path / "capture.jsonl.gz")
+    write(path, [
+        ("metro", "G", body(("Ginza", "G0")), 1, 5.0),
+        ("metro", "M", body(("Marunouchi", "M0")), 1, 5.5),
+        ("metro", "Trains", body(("Ginza", "G1"), ("Marunouchi", "M1")), 2, 10.0),
+        ("metro", "G", body(("Ginza", "G2")), 2, 11.0),
+        ("metro", "M", b"[]", 3, 20.0),
+    ])
+    replay = ReplaySource(path, speed=0)
+
+    replay.advance()
+    assert numbers(replay, "metro") == ["G0", "M0"]
+
+    # 全列車より新しい路線のレスポンスのみ置き換える
+    replay.advance()
+    assert numbers(replay, "metro") == ["G2", "M1"]
+    assert numbers(replay, "metro", "G") == ["G2"]
+
+    # 列車がなくなった路線は，以前のレスポンスのodpt:railwayで全列車から除く
+    replay.advance()
+    assert numbers(replay, "metro") == ["G2"]
+
+
+def test_replay_ignores_older_line_records(tmp_path):
+    path = str(tmp_path / "capture.jsonl.gz")
+    write(path, [
+        ("odpt", "A", body(("Asakusa", "A0")), 1, 5.0),
+        ("odpt", "A", b"[]", 2, 9.0),
+        ("odpt", "Trains", body(("Asakusa", "A1")), 2, 10.0),
+    ])
+    replay = ReplaySource(path, speed=0)
+    replay.advance()
+    replay.advance()
+
+    assert numbers(replay, "odpt") == ["A1"]
+    assert numbers(replay, "metro") == []
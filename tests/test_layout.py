@@ -0,0 +1,96 @@
+import json
+import os
+
+from conftest import ROOT
+from layout import compile_layout, compile_segment, layout_from_json, layout_to_json
+
+DISTANCE = 4
+
+NAKANO_SAKAUE = "odpt.Station:TokyoMetro.Marunouchi.NakanoSakaue"
+NAKANO_SHIMBASHI = "odpt.Station:TokyoMetro.MarunouchiBranch.NakanoShimbashi"
+SHINJUKU_NISHIGUCHI = "odpt.Station:Toei.Oedo.ShinjukuNishiguchi"
+TOCHOMAE = "odpt.Station:Toei.Oedo.Tochomae"
+
+
+def load(name):
+    with open(os.path.join(ROOT, "data", name), 'r') as f:
+        return json.load(f)
+
+
+def build(lines, offsets=None):
+    stations = load("station_table.json")
+    special = load("segment_table.json")
+    offsets = offsets or {line: 0 for line in lines}
+    return stations, compile_layout(stations, lines, DISTANCE, offsets, special)
+
+
+def test_stop_lights_station_led():
+    stations = {"A": 0, "B": 1}
+    segment = compile_segment(stations, DISTANCE, 10, "B", None)
+
+    assert segment.lednums == (DISTANCE,) * (DISTANCE - 1)
+    assert segment.pixels == ((DISTANCE + 10,),) * (DISTANCE - 1)
+
+
+def test_normal_segment_follows_numbering():
+    stations = {"A": 0, "B": 1}
+    forward = compile_segment(stations, DISTANCE, 0, "A", "B")
+    backward = compile_segment(stations, DISTANCE, 0, "B", "A")
+
+    assert forward.lednums == (0, 1, 2)
+    assert forward.pixels == ((0, 1), (1, 2), (2, 3))
+    assert forward.hold_direction == 1
+    assert backward.lednums == (4, 3, 2)
+    assert backward.pixels == ((4, 3), (3, 2), (2, 1))
+    assert backward.hold_direction == -1
+
+
+def test_marunouchi_branch():
+    # 中野坂上 -> 中野新橋: 出発直後は中野坂上と支線の最初のLED, 以降は支線のLEDを正方向に進む
+    stations, layout = build(["M"], {"M": 100})
+    from_led = stations["M"][NAKANO_SAKAUE] * DISTANCE
+    to_led = stations["M"][NAKANO_SHIMBASHI] * DISTANCE
+    segment = layout["M"][(NAKANO_SAKAUE, NAKANO_SHIMBASHI)]
+
+    assert segment.pixels[0] == (from_led + 100, to_led - DISTANCE + 1 + 100)
+    for movingpos in range(1, DISTANCE - 1):
+        lednum = to_led - DISTANCE + movingpos
+        assert segment.lednums[movingpos] == lednum
+        assert segment.pixels[movingpos] == (lednum + 100, lednum + 1 + 100)
+
+
+def test_oedo_loop():
+    stations, layout = build(["E"])
+    nishiguchi = stations["E"][SHINJUKU_NISHIGUCHI] * DISTANCE
+    tochomae = stations["E"][TOCHOMAE] * DISTANCE
+
+    # 新宿西口 -> 都庁前: 新宿西口から正方向に進み，据え置き時も正方向
+    inbound = layout["E"][(SHINJUKU_NISHIGUCHI, TOCHOMAE)]
+    assert inbound.lednums == tuple(nishiguchi + m for m in range(DISTANCE - 1))
+    assert inbound.hold_direction == 1
+
+    # 都庁前 -> 新宿西口: 出発直後は都庁前と区間の最初のLED, 以降は新宿西口の先から負方向に進む
+    outbound = layout["E"][(TOCHOMAE, SHINJUKU_NISHIGUCHI)]
+    assert outbound.pixels[0] == (tochomae, nishiguchi + DISTANCE - 1)
+    for movingpos in range(1, DISTANCE - 1):
+        lednum = nishiguchi + DISTANCE - movingpos
+        assert outbound.lednums[movingpos] == lednum
+        assert outbound.pixels[movingpos] == (lednum, lednum - 1)
+
+
+def test_special_rules_only_for_their_line():
+    _, layout = build(["G"])
+
+    assert (NAKANO_SAKAUE, NAKANO_SHIMBASHI) not in layout["G"]
+
+
+def test_json_round_trip():
+    _, layout = build(["M", "E"])
+    restored = layout_from_json(json.loads(json.dumps(layout_to_json(layout))))
+
+    for line, table in layout.items():
+        assert set(restored[line]) == set(table)
+        for key, segment in table.items():
+            assert restored[line][key].lednums == segment.lednums
+            assert restored[line][key].pixels == segment.pixels
+            assert restored[line][key].hold_direction == segment.hold_direction
@@ -0,0 +1,108 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from poller import TrainSnapshot
+from pubsub import SnapshotPublisher, SnapshotSubscriber, parse_address, recv_message, send_message
+
+
+class Source():
+    '''テスト用の配信元 (publish()したスナップショットを配る)
+    '''
+
+    def __init__(self):
+        self.version = 0
+        self.__snapshot = None
+        self.__stopped = False
+        self.__cond = threading.Condition()
+
+    def publish(self, trains):
+        with self.__cond:
+            self.version += 1
+            self.__snapshot = TrainSnapshot(self.version, trains, next_fetch=0.0, fetched_at=1.0)
+            self.__cond.notify_all()
+
+    def wait_snapshot(self, version=0):
+        with self.__cond:
+            while not self.__stopped and (self.__snapshot is None or self.__snapshot.version <= version):
+                self.__cond.wait()
+            return None if self.__stopped else self.__snapshot
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+
+
+def train(number, from_sta, to_sta=None):
+    return {"odpt:trainNumber": number, "odpt:fromStation": from_sta, "odpt:toStation": to_sta,
+            "dc:date": "2020-01-01T12:00:00+09:00"}
+
+
+@pytest.fixture
+def publisher():
+    source = Source()
+    pub = SnapshotPublisher(source, "127.0.0.1:0")
+    pub.start()
+    yield source, f"127.0.0.1:{pub.address[1]}"
+    pub.stop()
+    source.stop()
+
+
+def connect(address, lines):
+    sock = socket.create_connection(parse_address(address)[1], timeout=5)
+    send_message(sock, {"type": "hello", "name": "test", "lines": lines})
+    return sock
+
+
+def test_parse_address():
+    assert parse_address("unix:/tmp/a.sock") == (socket.AF_UNIX, "/tmp/a.sock")
+    assert parse_address(":5801") == (socket.AF_INET, ("127.0.0.1", 5801))
+    assert parse_address("0.0.0.0:5802") == (socket.AF_INET, ("0.0.0.0", 5802))
+
+
+def test_sends_full_then_changed_lines(publisher):
+    source, address = publisher
+    source.publish({"G": [train("A1", "g1")], "M": [train("B1", "m1")], "T": [train("C1", "t1")]})
+    sock = connect(address, ["G", "M"])
+    try:
+        first = recv_message(sock)
+        assert first["base"] == 0
+        assert set(first["trains"]) == {"G", "M"}
+
+        source.publish({"G": [train("A1", "g1", "g2")], "M": [train("B1", "m1")], "T": []})
+        second = recv_message(sock)
+        while second["type"] != "snapshot":
+            second = recv_message(sock)
+        assert second["base"] == first["version"]
+        assert list(second["trains"]) == ["G"]
+        assert set(second["updated_at"]) == {"G", "M"}
+    finally:
+        sock.close()
+
+
+def test_subscriber_reconstructs_deltas(publisher):
+    source, address = publisher
+    sub = SnapshotSubscriber(address, ["G", "M"], name="test")
+    sub.start()
+    try:
+        states = [
+            {"G": [train("A1", "g1")], "M": [train("B1", "m1"), train("B2", "m3", "m2")]},
+            {"G": [train("A1", "g1", "g2")], "M": [train("B1", "m1"), train("B2", "m3", "m2")]},
+            {"G": [train("A1", "g1", "g2")], "M": [train("B2", "m2")]},
+            {"G": [], "M": [train("B2", "m2")]},
+        ]
+        for trains in states:
+            source.publish(trains)
+            deadline = time.monotonic() + 5
+            while sub.publisher_version != source.version and time.monotonic() < deadline:
+                time.sleep(0.01)
+            # 受信した版ごとにスナップショットを作成するため，通し番号は受信数と一致する
+            snapshot = sub.wait_snapshot(sub.fetch_count - 1)
+
+            expected = TrainSnapshot(0, trains).to_compact(["G", "M"])["trains"]
+            assert snapshot.to_compact(["G", "M"])["trains"] == expected
+    finally:
+        sub.stop()
@@ -0,0 +1,52 @@
+from scheduler import PollScheduler, parse_date
+
+FETCHED_AT = parse_date("2020-01-01T12:00:00+09:00")
+
+
+def train(valid=None, date=None, frequency=None):
+    return {"dc:valid": valid, "dc:date": date, "odpt:frequency": frequency}
+
+
+def test_parse_date():
+    assert parse_date("2020-01-01T03:00:00+00:00") == FETCHED_AT
+    assert parse_date(None) is None
+    assert parse_date("not a date") is None
+
+
+def test_fetch_after_earliest_valid():
+    scheduler = PollScheduler(update_freq=30, margin=2)
+    trains = [[train(valid="2020-01-01T12:00:50+09:00", frequency=90)],
+              [train(valid="2020-01-01T12:00:40+09:00", frequency=60)]]
+
+    assert scheduler.plan(trains, FETCHED_AT) == FETCHED_AT + 42
+    assert scheduler.interval == 42
+    assert scheduler.publish_freq == 60
+
+
+def test_valid_from_date_and_frequency():
+    scheduler = PollScheduler(update_freq=30, margin=2)
+    trains = [[train(date="2020-01-01T11:59:50+09:00", frequency=90)]]
+
+    assert scheduler.plan(trains, FETCHED_AT) == FETCHED_AT + 82
+
+
+def test_skips_to_next_publish_if_too_soon():
+    scheduler = PollScheduler(update_freq=30, margin=2)
+    trains = [[train(valid="2020-01-01T12:00:10+09:00", frequency=60)]]
+
+    assert scheduler.plan(trains, FETCHED_AT) == FETCHED_AT + 72
+
+
+def test_default_interval_without_schedule():
+    scheduler = PollScheduler(update_freq=30, margin=2)
+
+    assert scheduler.plan([[train()]], FETCHED_AT) == FETCHED_AT + 30
+    # 古いdc:validは無視する
+    assert scheduler.plan([[train(valid="2020-01-01T11:00:00+09:00")]], FETCHED_AT) == FETCHED_AT + 30
+
+
+def test_caps_interval():
+    scheduler = PollScheduler(update_freq=30, margin=2)
+    trains = [[train(valid="2020-01-01T12:05:00+09:00")]]
+
+    assert scheduler.plan(trains, FETCHED_AT) == FETCHED_AT + 30
@@ -0,0 +1,58 @@
+import os
+
+from watcher import FileWatcher
+
+
+def write(path, text, mtime_ns):
+    with open(path, 'w') as f:
+        f.write(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_notifies_after_content_settles(tmp_path):
+    path = str(tmp_path / "led_config.json")
+    write(path, '{"a": 1}', 10 ** 18)
+    watcher = FileWatcher([path], callback=None)
+
+    assert watcher.check() == set()
+
+    write(path, '{"a": 2}', 10 ** 18 + 10 ** 9)
+    # 変更を検出した確認では通知せず，次の確認まで内容が変わらなければ通知する
+    assert watcher.check() == set()
+    assert watcher.check() == {path}
+    assert watcher.check() == set()
+
+
+def test_waits_while_file_is_being_written(tmp_path):
+    path = str(tmp_path / "led_config.json")
+    write(path, '{"a": 1}', 10 ** 18)
+    watcher = FileWatcher([path], callback=None)
+
+    write(path, '{"a": ', 10 ** 18 + 10 ** 9)
+    assert watcher.check() == set()
+    write(path, '{"a": 2}', 10 ** 18 + 2 * 10 ** 9)
+    assert watcher.check() == set()
+    assert watcher.check() == {path}
+
+
+def test_ignores_touch_without_content_change(tmp_path):
+    path = str(tmp_path / "led_config.json")
+    write(path, '{"a": 1}', 10 ** 18)
+    watcher = FileWatcher([path], callback=None)
+
+    write(path, '{"a": 1}', 10 ** 18 + 10 ** 9)
+    assert watcher.check() == set()
+    assert watcher.check() == set()
+
+
+def test_ignores_missing_file(tmp_path):
+    path = str(tmp_path / "led_config.json")
+    write(path, '{"a": 1}', 10 ** 18)
+    watcher = FileWatcher([path], callback=None)
+
+    os.remove(path)
+    assert watcher.check() == set()
+
+    write(path, '{"a": 2}', 10 ** 18 + 10 ** 9)
+    assert watcher.check() == set()
+    assert watcher.check() == {path}
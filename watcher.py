@@ -0,0 +1,156 @@
+import json
+import os
+import threading
+import traceback
+
+from log import Log
+from cache import intern_keys, source_signature
+
+
+class FileWatcher():
+    '''ファイルの変更の監視 (更新時刻・サイズのポーリング)
+
+    更新時刻・サイズが変わった場合は内容(ハッシュ値)を比較し，内容が変わった場合のみ通知する.
+    保存途中のファイルを読み込まないよう，次の確認まで内容が変わらなかった場合に通知する
+
+    Parameters
+    ----------
+    paths : list of str
+        監視するファイルのパスのリスト
+    callback : callable
+        変更時に呼ぶ関数 (引数: 変更されたファイルのパスのset)
+    interval : float
+        確認の間隔[s]
+    '''
+
+    def __init__(self, paths, callback, interval=2):
+        self.paths = list(paths)
+        self.callback = callback
+        self.interval = interval
+
+        self.__stop = threading.Event()
+        self.__signatures = {path: self.__signature(path) for path in self.paths}
+        # 変更を検出し，内容が落ち着くのを待っているファイル
+        self.__settling = {}
+
+    def start(self):
+        '''監視スレッドを開始する
+        '''
+        th = threading.Thread(target=self.__watch_thread)
+        th.setDaemon(True)
+        th.start()
+
+    def stop(self):
+        self.__stop.set()
+
+    def check(self):
+        '''変更を1回確認する
+
+        Returns
+        -------
+        changed : set of str
+            内容が変わったファイルのパス
+        '''
+        changed = set()
+        for path in self.paths:
+            current = self.__signatures[path]
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if current is not None and st.st_mtime_ns == current["mtime"] and st.st_size == current["size"]:
+                self.__settling.pop(path, None)
+                continue
+
+            signature = self.__signature(path)
+            if signature is None:
+                continue
+
+            # 前回の確認から内容が変わっていない場合のみ変更とする
+            settling = self.__settling.get(path)
+            if settling is None or settling["sha1"] != signature["sha1"] or \
+                    settling["mtime"] != signature["mtime"]:
+                self.__settling[path] = signature
+                continue
+
+            del self.__settling[path]
+            self.__signatures[path] = signature
+            if current is None or signature["sha1"] != current["sha1"]:
+                changed.add(path)
+
+        return changed
+
+    def __watch_thread(self):
+        while not self.__stop.wait(self.interval):
+            changed = self.check()
+            if not changed:
+                continue
+            try:
+                self.callback(changed)
+            except Exception:
+                Log.error(f"Watcher: Could not apply changes of {sorted(changed)}.",
+                          traceback=traceback.format_exc())
+
+    @staticmethod
+    def __signature(path):
+        try:
+            return source_signature(path)
+        except OSError:
+            return None
+
+
+class ConfigReloader():
+    '''設定ファイル・駅テーブルの変更をLEDテープに反映する
+
+    プロセスを再起動せずに，led_config.jsonの色・明るさ・reverse等と駅テーブルの変更を反映する.
+    内容に誤りがある場合は，現在の設定で表示を続ける
+
+    Parameters
+    ----------
+    leds : list of LEDCtrl
+        ChannelごとのLED制御 (表示路線がないChannelは[])
+    led_config : str
+        led_config.jsonのパス
+    station_table : str
+        station_table.jsonのパス
+    segment_table : str
+        segment_table.jsonのパス
+    interval : float
+        確認の間隔[s]
+    '''
+
+    def __init__(self, leds, led_config, station_table, segment_table="./data/segment_table.json", interval=2):
+        self.leds = [led for led in leds if led]
+        self.station_table = station_table
+        self.__watcher = FileWatcher([led_config, station_table, segment_table], self.__reload, interval)
+
+    def start(self):
+        self.__watcher.start()
+        Log.info(f"Watching config files for changes.")
+
+    def stop(self):
+        self.__watcher.stop()
+
+    def __reload(self, changed):
+        Log.info(f"Reloading {', '.join(sorted(changed))}...")
+
+        stations = None
+        if self.station_table in changed:
+            with open(self.station_table, 'r') as sf:
+                stations = intern_keys(json.load(sf))
+            for led in self.leds:
+                missing = [line for line in led.use_lines if line not in stations]
+                if missing:
+                    raise KeyError(f"Lines {missing} are not in {self.station_table}")
+
+        for led in self.leds:
+            try:
+                changes = led.reload(stations)
+            except (KeyError, ValueError, TypeError) as e:
+                Log.error(f"Strip{led.channel}: Could not reload config ({type(e).__name__}: {e}). "
+                          f"Keep current config.")
+                continue
+            if changes:
+                Log.info(f"Strip{led.channel}: Reloaded {', '.join(changes)}.")
+            else:
+                Log.info(f"Strip{led.channel}: No changes to apply.")